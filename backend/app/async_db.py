@@ -0,0 +1,231 @@
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncpg
+
+from .db import (
+    CATALOG_REVISION_BUMP,
+    CATALOG_REVISION_TABLE,
+    VEHICLE_KEYSET_INDEX,
+    VEHICLE_ORDER_BY,
+    decode_cursor,
+    encode_cursor,
+)
+
+# Variante asíncrona de db.py sobre asyncpg, con su propio pool
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+_pool: Optional[asyncpg.Pool] = None
+_stats = {"acquired": 0, "wait_time_total": 0.0, "wait_time_max": 0.0}
+
+
+async def open_pool() -> asyncpg.Pool:
+    """Crea el pool asíncrono de conexiones (llamado en el arranque de la aplicación)"""
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            os.environ.get("DATABASE_URL", DATABASE_URL),
+            min_size=int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+            max_size=int(os.environ.get("DB_POOL_MAX_SIZE", "10")),
+            max_inactive_connection_lifetime=float(os.environ.get("DB_POOL_MAX_IDLE", "60")),
+        )
+    return _pool
+
+
+async def close_pool() -> None:
+    """Cierra el pool asíncrono (llamado al apagar la aplicación)"""
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Estadísticas del pool asíncrono: conexiones en uso, ociosas y tiempos de espera"""
+    acquired = _stats["acquired"]
+    stats = {
+        "opened": _pool is not None,
+        "acquired": acquired,
+        "wait_time_total": round(_stats["wait_time_total"], 6),
+        "wait_time_avg": round(_stats["wait_time_total"] / acquired, 6) if acquired else 0.0,
+        "wait_time_max": round(_stats["wait_time_max"], 6),
+    }
+    if _pool is not None:
+        size, idle = _pool.get_size(), _pool.get_idle_size()
+        stats.update({
+            "min_size": _pool.get_min_size(),
+            "max_size": _pool.get_max_size(),
+            "in_use": size - idle,
+            "idle": idle,
+        })
+    return stats
+
+
+@asynccontextmanager
+async def connection():
+    """Presta una conexión del pool asíncrono (lo abre si aún no existe)"""
+    pool = _pool or await open_pool()
+    start = time.monotonic()
+    async with pool.acquire(timeout=float(os.environ.get("DB_POOL_TIMEOUT", "30"))) as conn:
+        elapsed = time.monotonic() - start
+        _stats["acquired"] += 1
+        _stats["wait_time_total"] += elapsed
+        _stats["wait_time_max"] = max(_stats["wait_time_max"], elapsed)
+        yield conn
+
+
+def _build_where(filters: List[tuple]) -> tuple:
+    """Construye una cláusula WHERE con parámetros posicionales de asyncpg ($1, $2, ...)"""
+    clauses, params = [], []
+    for column, value in filters:
+        if value:
+            params.append(value)
+            clauses.append(f"{column} = ${len(params)}")
+    where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+    return where, params
+
+
+# Funciones para acceder a los datos de vehículos
+async def get_vehicle_years() -> List[int]:
+    """Obtiene todos los años de vehículos disponibles ordenados de manera descendente"""
+    async with connection() as conn:
+        try:
+            rows = await conn.fetch("SELECT DISTINCT year FROM vehicles ORDER BY year DESC")
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f"Error al obtener años de vehículos: {e}")
+            return []
+
+
+async def get_vehicle_makes(year: Optional[int] = None) -> List[str]:
+    """Obtiene todas las marcas de vehículos disponibles para un año específico"""
+    async with connection() as conn:
+        try:
+            where, params = _build_where([("year", year)])
+            rows = await conn.fetch(f"SELECT DISTINCT make FROM vehicles{where} ORDER BY make", *params)
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f"Error al obtener marcas de vehículos: {e}")
+            return []
+
+
+async def get_vehicle_models(year: Optional[int] = None, make: Optional[str] = None) -> List[str]:
+    """Obtiene todos los modelos de vehículos disponibles para un año y marca específicos"""
+    async with connection() as conn:
+        try:
+            where, params = _build_where([("year", year), ("make", make)])
+            rows = await conn.fetch(f"SELECT DISTINCT model FROM vehicles{where} ORDER BY model", *params)
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f"Error al obtener modelos de vehículos: {e}")
+            return []
+
+
+async def get_vehicle_engines(year: Optional[int] = None, make: Optional[str] = None, model: Optional[str] = None) -> List[str]:
+    """Obtiene todos los motores de vehículos disponibles para un año, marca y modelo específicos"""
+    async with connection() as conn:
+        try:
+            where, params = _build_where([("year", year), ("make", make), ("model", model)])
+            rows = await conn.fetch(f"SELECT DISTINCT engine FROM vehicles{where} ORDER BY engine", *params)
+            return [row[0] for row in rows if row[0]]  # Filtrar valores nulos
+        except Exception as e:
+            print(f"Error al obtener motores de vehículos: {e}")
+            return []
+
+
+async def get_vehicle_by_attributes(year: int, make: str, model: str, engine: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Obtiene un vehículo específico por sus atributos"""
+    async with connection() as conn:
+        try:
+            query = "SELECT * FROM vehicles WHERE year = $1 AND make = $2 AND model = $3"
+            params: List[Any] = [year, make, model]
+
+            if engine:
+                query += " AND engine = $4"
+                params.append(engine)
+
+            vehicle = await conn.fetchrow(query, *params)
+            return dict(vehicle) if vehicle else None
+        except Exception as e:
+            print(f"Error al obtener vehículo por atributos: {e}")
+            return None
+
+
+async def get_all_vehicles(limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
+    """Obtiene todos los vehículos con paginación"""
+    async with connection() as conn:
+        try:
+            rows = await conn.fetch(
+                f"SELECT * FROM vehicles ORDER BY {VEHICLE_ORDER_BY} LIMIT $1 OFFSET $2",
+                limit, offset
+            )
+            return [dict(v) for v in rows]
+        except Exception as e:
+            print(f"Error al obtener todos los vehículos: {e}")
+            return []
+
+
+async def get_vehicles_page(limit: int = 100, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Obtiene una página de vehículos por cursor (keyset) y el token de la página siguiente"""
+    after = decode_cursor(cursor) if cursor else None
+    async with connection() as conn:
+        try:
+            if after:
+                # `year <= $1` acota el recorrido del índice al año del cursor en adelante
+                rows = await conn.fetch(
+                    "SELECT * FROM vehicles WHERE year <= $1 AND (year < $1 OR (year = $1 AND "
+                    "(make, model, COALESCE(engine, ''), id) > ($2, $3, $4, $5))) "
+                    f"ORDER BY {VEHICLE_ORDER_BY} LIMIT $6",
+                    *after, limit
+                )
+            else:
+                rows = await conn.fetch(f"SELECT * FROM vehicles ORDER BY {VEHICLE_ORDER_BY} LIMIT $1", limit)
+            vehicles = [dict(v) for v in rows]
+            next_cursor = encode_cursor(vehicles[-1]) if len(vehicles) == limit else None
+            return vehicles, next_cursor
+        except Exception as e:
+            print(f"Error al obtener página de vehículos: {e}")
+            return [], None
+
+
+async def count_vehicles(exact: bool = True) -> int:
+    """Cuenta el número total de vehículos; con exact=False usa la estimación de pg_class"""
+    async with connection() as conn:
+        try:
+            if not exact:
+                estimate = await conn.fetchval("SELECT reltuples::bigint FROM pg_class WHERE oid = 'vehicles'::regclass")
+                # reltuples es -1 (o 0) si la tabla nunca se ha analizado
+                if estimate and estimate > 0:
+                    return estimate
+            return await conn.fetchval("SELECT COUNT(*) FROM vehicles")
+        except Exception as e:
+            print(f"Error al contar vehículos: {e}")
+            return 0
+
+
+async def get_catalog_rows() -> List[Dict[str, Any]]:
+    """Obtiene todas las filas de vehículos para construir el índice del catálogo (propaga errores)"""
+    async with connection() as conn:
+        rows = await conn.fetch("SELECT * FROM vehicles ORDER BY id")
+        return [dict(v) for v in rows]
+
+
+async def get_catalog_revision() -> Optional[str]:
+    """Revisión vigente del catálogo en la base de datos; None si nunca se ha importado (propaga errores)"""
+    async with connection() as conn:
+        return await conn.fetchval("SELECT revision FROM catalog_revision")
+
+
+async def bump_catalog_revision() -> str:
+    """Marca el catálogo como cambiado para que todos los workers recarguen su índice"""
+    async with connection() as conn:
+        return await conn.fetchval(CATALOG_REVISION_BUMP)
+
+
+async def ensure_indexes() -> None:
+    """Crea los índices que necesitan las consultas del backend si aún no existen"""
+    async with connection() as conn:
+        await conn.execute(VEHICLE_KEYSET_INDEX)
+        await conn.execute(CATALOG_REVISION_TABLE)
@@ -0,0 +1,40 @@
+import hmac
+import os
+from typing import Optional
+
+from fastapi import HTTPException, Request, Response
+
+# Cookie con la sesión emitida al conectar Smartcar (también se acepta como Authorization: Bearer)
+SESSION_COOKIE = "autologic_session"
+# Vigencia de la cookie: la misma que el refresh token de Smartcar (60 días)
+SESSION_MAX_AGE = int(os.environ.get("SESSION_MAX_AGE", str(60 * 24 * 3600)))
+# Enviar la cookie solo por HTTPS (desactivar únicamente en desarrollo local)
+SESSION_COOKIE_SECURE = os.environ.get("SESSION_COOKIE_SECURE", "true").lower() in ("1", "true", "yes")
+# Clave de servicio de las rutas administrativas (flota, recarga del catálogo); sin ella esas rutas quedan deshabilitadas
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY")
+
+
+def session_token(request: Request) -> Optional[str]:
+    """Sesión del cliente: cabecera Authorization: Bearer o cookie de sesión"""
+    authorization = request.headers.get("Authorization", "")
+    if authorization.lower().startswith("bearer "):
+        return authorization[7:].strip() or None
+    return request.cookies.get(SESSION_COOKIE) or None
+
+
+def set_session_cookie(response: Response, session: str) -> None:
+    response.set_cookie(SESSION_COOKIE, session, max_age=SESSION_MAX_AGE, httponly=True,
+                        secure=SESSION_COOKIE_SECURE, samesite="lax")
+
+
+def clear_session_cookie(response: Response) -> None:
+    response.delete_cookie(SESSION_COOKIE, httponly=True, secure=SESSION_COOKIE_SECURE, samesite="lax")
+
+
+def require_admin(request: Request) -> None:
+    """Dependencia de las rutas administrativas: exige la cabecera X-Admin-Key"""
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=503, detail="Las rutas administrativas requieren configurar ADMIN_API_KEY")
+    provided = request.headers.get("X-Admin-Key", "")
+    if not hmac.compare_digest(provided.encode(), ADMIN_API_KEY.encode()):
+        raise HTTPException(status_code=401, detail="Clave de administración inválida")
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+# Marca para distinguir "no está en caché" de un valor None almacenado
+MISSING = object()
+
+
+class TTLCache:
+    """Caché en memoria acotada por tamaño (LRU) con expiración por TTL"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = MISSING, max_age: Optional[float] = None) -> Any:
+        """Devuelve el valor si existe y no ha expirado (ni supera max_age segundos)"""
+        entry = self.get_entry(key, max_age)
+        return default if entry is None else entry[1]
+
+    def get_entry(self, key: Hashable, max_age: Optional[float] = None) -> Optional[Tuple[float, Any]]:
+        """Devuelve (momento de almacenamiento, valor) o None si no hay entrada vigente"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, _ = entry
+            age = now - stored_at
+            if age >= self.ttl:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if max_age is not None and age > max_age:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key: Hashable, value: Any, stored_at: Optional[float] = None) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() if stored_at is None else stored_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SingleFlight:
+    """Coalesce llamadas concurrentes con la misma clave en una sola ejecución
+
+    La ejecución compartida sobrevive a la cancelación de cualquier llamador mientras quede
+    otro esperándola; si se cancela el último, se cancela también la ejecución.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._waiters: Dict[asyncio.Future, int] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Ejecuta fn() una sola vez por clave; los demás llamadores esperan el mismo resultado"""
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.coalesced += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # shield: si un llamador se cancela, la ejecución compartida sigue para los demás
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                # Nadie espera ya el resultado (p. ej. todos los clientes se desconectaron)
+                if not task.done():
+                    task.cancel()
+                    self.cancelled += 1
+
+    def _finish(self, key: Hashable, task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Marcar la excepción como recuperada aunque todos los llamadores se hayan cancelado
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._inflight), "calls": self.calls, "coalesced": self.coalesced,
+                "cancelled": self.cancelled}
@@ -0,0 +1,612 @@
+import asyncio
+import bisect
+import csv
+import hashlib
+import heapq
+import json
+import re
+import os
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .text import fold, words
+
+# Directorio con los CSV del catálogo (data/ en la raíz del repositorio)
+DEFAULT_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "data"))
+CATALOG_CSV_FILES = ("mexican_vehicles.csv", "historical_vehicles.csv")
+# Segundos que navegadores y CDN pueden reutilizar una respuesta del catálogo sin revalidarla
+CATALOG_CACHE_MAX_AGE = int(os.environ.get("CATALOG_CACHE_MAX_AGE", "300"))
+# Segundos entre consultas a la revisión del catálogo en la base de datos (0 = sin sondeo)
+CATALOG_REVISION_POLL_INTERVAL = float(os.environ.get("CATALOG_REVISION_POLL_INTERVAL", "10"))
+
+# Columnas de los CSV (camelCase) → columnas de la tabla vehicles (snake_case)
+CSV_COLUMNS = {
+    "year": "year",
+    "make": "make",
+    "model": "model",
+    "trim": "trim",
+    "engine": "engine",
+    "transmission": "transmission",
+    "bodyType": "body_type",
+    "originCountry": "origin_country",
+    "isImported": "is_imported",
+    "availableInMexico": "available_in_mexico",
+    "mexicanName": "mexican_name",
+    "fuelType": "fuel_type",
+    "cylinderCount": "cylinder_count",
+    "displacement": "displacement",
+    "driveType": "drive_type",
+}
+BOOLEAN_COLUMNS = ("is_imported", "available_in_mexico")
+INTEGER_COLUMNS = ("year", "cylinder_count")
+
+
+def normalize_csv_row(record: Dict[str, str]) -> Dict[str, Any]:
+    """Convierte un registro CSV al formato de una fila de la tabla vehicles"""
+    row: Dict[str, Any] = {}
+    for csv_name, column in CSV_COLUMNS.items():
+        value = (record.get(csv_name) or "").strip()
+        if column in BOOLEAN_COLUMNS:
+            row[column] = value.lower() in ("true", "1") if value else None
+        elif column in INTEGER_COLUMNS:
+            row[column] = int(value) if value else None
+        else:
+            row[column] = value or None
+    return row
+
+
+def read_catalog_csv(data_dir: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Lee los vehículos de los archivos CSV de data/"""
+    data_dir = data_dir or os.environ.get("CATALOG_DATA_DIR", DEFAULT_DATA_DIR)
+    rows = []
+    for filename in CATALOG_CSV_FILES:
+        path = os.path.join(data_dir, filename)
+        if not os.path.exists(path):
+            continue
+        with open(path, newline="", encoding="utf-8") as f:
+            for record in csv.DictReader(f):
+                row = normalize_csv_row(record)
+                if row["year"] and row["make"] and row["model"]:
+                    rows.append(row)
+    return rows
+
+
+# Apodos comunes en México que no aparecen en el catálogo: (marca, modelo o None) → palabras extra
+VEHICLE_ALIASES = {
+    ("Volkswagen", "Sedan"): ("vocho", "vochito", "bocho"),
+    ("Volkswagen", None): ("vw",),
+    ("Chevrolet", None): ("chevy",),
+    ("Mercedes-Benz", None): ("mercedes", "benz"),
+}
+# Similitud mínima de trigramas para aceptar una palabra con errores de escritura
+SEARCH_MIN_SIMILARITY = 0.4
+_PIECES = re.compile(r"[a-z]+|[0-9]+")
+
+
+def trigrams(word: str) -> set:
+    """Trigramas de la palabra con relleno, como pg_trgm ("aveo" → {"  a", " av", "ave", "veo", "eo "})"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def within_one_edit(a: str, b: str) -> bool:
+    """Verdadero si b se obtiene de a con a lo sumo una inserción, borrado, sustitución o
+    transposición de letras vecinas ("avoe" → "aveo")"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:] or (a[i + 1:i + 2] == b[i:i + 1] and a[i:i + 1] == b[i + 1:i + 2] and a[i + 2:] == b[i + 2:])
+    shorter, longer = (a, b) if len(a) < len(b) else (b, a)
+    return shorter[i:] == longer[i + 1:]
+
+
+class VehicleSearchIndex:
+    """Búsqueda tolerante a errores sobre año, marca, modelo, versión y nombre comercial en México
+
+    Cada palabra de la búsqueda se compara con el vocabulario del catálogo: exacta, por prefijo
+    (autocompletado) o por similitud de trigramas (errores de escritura). Todas las palabras deben
+    coincidir; los resultados se ordenan por la calidad de las coincidencias y el año más reciente.
+    """
+
+    EXACT, PREFIX, ALIAS, TYPO = 3.0, 2.0, 2.5, 1.0
+
+    def __init__(self, vehicles: List[Dict[str, Any]]):
+        entries: Dict[Tuple, Dict[str, Any]] = {}
+        for v in vehicles:
+            key = (v.get("year"), v.get("make"), v.get("model"), v.get("trim") or None)
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = {
+                    "year": v.get("year"),
+                    "make": v.get("make"),
+                    "model": v.get("model"),
+                    "trim": v.get("trim") or None,
+                    "mexican_name": v.get("mexican_name") or None,
+                }
+            elif not entry["mexican_name"]:
+                entry["mexican_name"] = v.get("mexican_name") or None
+        self.entries = sorted(entries.values(), key=lambda e: (-(e["year"] or 0), e["make"], e["model"], e["trim"] or ""))
+
+        postings: Dict[str, set] = {}
+        alias_postings: Dict[str, set] = {}
+        for position, entry in enumerate(self.entries):
+            found = self._entry_words(entry)
+            for word in found:
+                postings.setdefault(word, set()).add(position)
+            for word in self._entry_aliases(entry) - found:
+                alias_postings.setdefault(word, set()).add(position)
+        self.postings = {word: frozenset(positions) for word, positions in postings.items()}
+        self.alias_postings = {word: frozenset(positions) for word, positions in alias_postings.items()}
+        self.vocabulary = sorted(set(self.postings) | set(self.alias_postings))
+        self._trigrams: Dict[str, set] = {}
+        self._by_initial: Dict[str, List[str]] = {}
+        for word in self.vocabulary:
+            if not word.isdigit():
+                self._by_initial.setdefault(word[0], []).append(word)
+                for gram in trigrams(word):
+                    self._trigrams.setdefault(gram, set()).add(word)
+
+    @staticmethod
+    def _entry_words(entry: Dict[str, Any]) -> set:
+        text = " ".join(str(entry[field]) for field in ("year", "make", "model", "trim", "mexican_name") if entry[field])
+        found = set()
+        for word in words(text):
+            found.add(word)
+            # "mazda3" también se encuentra como "mazda 3"
+            found.update(_PIECES.findall(word))
+        return found
+
+    @staticmethod
+    def _entry_aliases(entry: Dict[str, Any]) -> set:
+        aliases = set()
+        for (make, model), names in VEHICLE_ALIASES.items():
+            if entry["make"] == make and model in (None, entry["model"]):
+                aliases.update(names)
+        return aliases
+
+    def _matches(self, term: str) -> Dict[str, float]:
+        """Palabras del vocabulario que corresponden a term, con su peso"""
+        found: Dict[str, float] = {}
+        if term in self.postings or term in self.alias_postings:
+            found[term] = self.EXACT
+        start = bisect.bisect_left(self.vocabulary, term)
+        end = bisect.bisect_left(self.vocabulary, term + "\uffff")
+        for word in self.vocabulary[start:end]:
+            found.setdefault(word, self.PREFIX)
+        # Los números (años, "F-150", "208") solo coinciden exactos o por prefijo
+        if len(term) >= 3 and not term.isdigit():
+            grams = trigrams(term)
+            shared: Dict[str, int] = {}
+            for gram in grams:
+                for word in self._trigrams.get(gram, ()):
+                    shared[word] = shared.get(word, 0) + 1
+            for word, count in shared.items():
+                similarity = count / (len(grams) + len(trigrams(word)) - count)
+                if similarity >= SEARCH_MIN_SIMILARITY and word not in found:
+                    found[word] = similarity
+        # Letras cambiadas de lugar u omitidas que los trigramas no alcanzan ("avoe" → "aveo")
+        if len(term) >= 4 and not term.isdigit():
+            for word in self._by_initial.get(term[0], ()):
+                if word not in found and within_one_edit(term, word):
+                    found[word] = self.TYPO
+        return found
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        terms = list(dict.fromkeys(words(query)))
+        if not terms:
+            return []
+        scores: Optional[Dict[int, float]] = None
+        for term in terms:
+            best: Dict[int, float] = {}
+            for word, weight in self._matches(term).items():
+                for position in self.postings.get(word, ()):
+                    if weight > best.get(position, 0.0):
+                        best[position] = weight
+                # Un apodo pesa menos que el nombre real ("chevy" prefiere el Chevrolet Chevy)
+                alias_weight = min(weight, self.ALIAS)
+                for position in self.alias_postings.get(word, ()):
+                    if alias_weight > best.get(position, 0.0):
+                        best[position] = alias_weight
+            if scores is None:
+                scores = best
+            else:
+                scores = {p: score + best[p] for p, score in scores.items() if p in best}
+            if not scores:
+                return []
+        # Mayor puntaje primero; a igual puntaje, el orden del índice (año más reciente)
+        ranked = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [{**self.entries[p], "score": round(score, 3)} for p, score in ranked]
+
+
+# Atributos del catálogo que se pueden filtrar y contar como facetas
+FACET_FIELDS = (
+    "year", "make", "model", "fuel_type", "drive_type", "transmission", "body_type",
+    "cylinder_count", "origin_country", "is_imported", "available_in_mexico",
+)
+
+
+def facet_value(value: Any) -> Optional[str]:
+    """Valor de faceta como texto (booleanos "true"/"false"); None si el vehículo no lo tiene"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+class FacetIndex:
+    """Bitsets precalculados por faceta y valor: el bit i indica si el vehículo i tiene ese valor
+
+    Un filtro es OR de los valores elegidos dentro de cada faceta y AND entre facetas. Los conteos
+    de cada faceta aplican los filtros de las demás (así se ven las alternativas) y salen de
+    contar bits, sin agrupar filas en cada petición.
+    """
+
+    def __init__(self, vehicles: List[Dict[str, Any]]):
+        self.vehicles = sorted(vehicles, key=lambda v: (
+            -(v.get("year") or 0), v.get("make") or "", v.get("model") or "", v.get("trim") or "", v.get("engine") or ""
+        ))
+        self.all = (1 << len(self.vehicles)) - 1
+        # Primero las posiciones de cada valor; cada bitset se arma una sola vez al final, porque
+        # acumular con `bits | bit` copia el entero completo en cada fila (tiempo cuadrático)
+        size = (len(self.vehicles) + 7) // 8
+        bitsets: Dict[str, Dict[str, int]] = {}
+        for field in FACET_FIELDS:
+            raw: Dict[Any, List[int]] = {}
+            for position, vehicle in enumerate(self.vehicles):
+                raw.setdefault(vehicle.get(field), []).append(position)
+            # facet_value una vez por valor distinto; valores que dan el mismo texto (4 y "4") se unen
+            positions: Dict[str, List[int]] = {}
+            for value, found in raw.items():
+                key = facet_value(value)
+                if key is not None:
+                    positions.setdefault(key, []).extend(found)
+            bitsets[field] = {key: self._bitset(found, size) for key, found in positions.items()}
+        self.bitsets = bitsets
+        # Los filtros se aceptan sin distinguir mayúsculas ni acentos ("diesel" = "Diésel")
+        self._lookup = {field: {fold(value): value for value in values} for field, values in bitsets.items()}
+
+    @staticmethod
+    def _bitset(positions: List[int], size: int) -> int:
+        flags = bytearray(size)
+        for position in positions:
+            flags[position >> 3] |= 1 << (position & 7)
+        return int.from_bytes(flags, "little")
+
+    def _facet_mask(self, field: str, values: List[str]) -> int:
+        mask = 0
+        for value in values:
+            key = self._lookup[field].get(fold(value))
+            if key is not None:
+                mask |= self.bitsets[field][key]
+        return mask
+
+    def query(self, filters: Dict[str, List[str]], limit: int = 50, offset: int = 0) -> Dict[str, Any]:
+        """Vehículos que cumplen los filtros (paginados) y conteos por valor de cada faceta"""
+        masks = {field: self._facet_mask(field, values) for field, values in filters.items() if field in self.bitsets and values}
+        matched = self.all
+        for mask in masks.values():
+            matched &= mask
+
+        facets: Dict[str, Dict[str, int]] = {}
+        for field in FACET_FIELDS:
+            # Base de la faceta: todos los filtros salvo el suyo
+            base = self.all
+            for other, mask in masks.items():
+                if other != field:
+                    base &= mask
+            counts = {value: (bits & base).bit_count() for value, bits in self.bitsets[field].items()}
+            facets[field] = {value: count for value, count in sorted(counts.items()) if count}
+
+        return {
+            "total": matched.bit_count(),
+            "vehicles": [self.vehicles[p] for p in self._positions(matched, offset, limit)],
+            "facets": facets,
+        }
+
+    @staticmethod
+    def _positions(bits: int, offset: int, limit: int) -> List[int]:
+        """Posiciones de los bits encendidos, en orden, a partir del número offset"""
+        flags = bin(bits)[:1:-1]  # bit 0 primero
+        positions: List[int] = []
+        index = flags.find("1")
+        skipped = 0
+        while index >= 0 and len(positions) < limit:
+            if skipped < offset:
+                skipped += 1
+            else:
+                positions.append(index)
+            index = flags.find("1", index + 1)
+        return positions
+
+
+class CatalogSnapshot:
+    """Índice inmutable año → marca → modelo → motor con listas preordenadas"""
+
+    def __init__(self, vehicles: List[Dict[str, Any]], version: int = 0, source: str = "empty"):
+        self.vehicles = vehicles
+        self.version = version
+        self.source = source
+        self.loaded_at = datetime.now().isoformat()
+        self.revision = self._compute_revision(vehicles)
+
+        makes: Dict[Optional[int], set] = {}
+        models: Dict[Tuple, set] = {}
+        engines: Dict[Tuple, set] = {}
+        vehicles_by_model: Dict[Tuple, List[Dict[str, Any]]] = {}
+        years = set()
+
+        for v in vehicles:
+            year, make, model, engine = v.get("year"), v.get("make"), v.get("model"), v.get("engine")
+            years.add(year)
+            vehicles_by_model.setdefault((year, make, model), []).append(v)
+            # Registrar el valor bajo todas las combinaciones de filtros opcionales
+            for y in (year, None):
+                makes.setdefault(y, set()).add(make)
+                for m in (make, None):
+                    models.setdefault((y, m), set()).add(model)
+                    if engine:
+                        for mo in (model, None):
+                            engines.setdefault((y, m, mo), set()).add(engine)
+
+        self.years: List[int] = sorted(years, reverse=True)
+        self._makes = {k: sorted(v) for k, v in makes.items()}
+        self._models = {k: sorted(v) for k, v in models.items()}
+        self._engines = {k: sorted(v) for k, v in engines.items()}
+        self._vehicles_by_model = vehicles_by_model
+        # El índice de búsqueda se reconstruye junto con el snapshot en cada recarga
+        self.search_index = VehicleSearchIndex(vehicles)
+        self.facet_index = FacetIndex(vehicles)
+
+    @staticmethod
+    def _compute_revision(vehicles: List[Dict[str, Any]]) -> str:
+        digest = hashlib.sha1()
+        for line in sorted(json.dumps(v, sort_keys=True, default=str) for v in vehicles):
+            digest.update(line.encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    @property
+    def etag(self) -> str:
+        """ETag fuerte: la revisión depende solo del contenido, así que coincide entre workers"""
+        return f'"{self.revision}"'
+
+    def makes(self, year: Optional[int] = None) -> List[str]:
+        return self._makes.get(year or None, [])
+
+    def models(self, year: Optional[int] = None, make: Optional[str] = None) -> List[str]:
+        return self._models.get((year or None, make or None), [])
+
+    def engines(self, year: Optional[int] = None, make: Optional[str] = None, model: Optional[str] = None) -> List[str]:
+        return self._engines.get((year or None, make or None, model or None), [])
+
+    def vehicle(self, year: int, make: str, model: str, engine: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Primer vehículo con esos atributos (como /api/vehicles/details, sin ir a la base de datos)"""
+        for v in self._vehicles_by_model.get((year, make, model), []):
+            if not engine or v.get("engine") == engine:
+                return v
+        return None
+
+    def selector(self, year: Optional[int] = None, make: Optional[str] = None, model: Optional[str] = None,
+                 engine: Optional[str] = None) -> Dict[str, Any]:
+        """Estado completo del selector para una selección parcial: cada lista se abre cuando el
+        nivel anterior está elegido y el vehículo se resuelve con año, marca y modelo"""
+        year, make, model, engine = year or None, make or None, model or None, engine or None
+        return {
+            "selection": {"year": year, "make": make, "model": model, "engine": engine},
+            "years": self.years,
+            "makes": self.makes(year) if year else [],
+            "models": self.models(year, make) if year and make else [],
+            "engines": self.engines(year, make, model) if year and make and model else [],
+            "vehicle": self.vehicle(year, make, model, engine) if year and make and model else None,
+        }
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        return self.search_index.search(query, limit)
+
+    def facets(self, filters: Dict[str, List[str]], limit: int = 50, offset: int = 0) -> Dict[str, Any]:
+        return self.facet_index.query(filters, limit, offset)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "revision": self.revision,
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+            "vehicles": len(self.vehicles),
+            "years": len(self.years),
+        }
+
+
+class CatalogUnavailable(RuntimeError):
+    """El índice aún no está construido; se está construyendo en segundo plano"""
+
+
+class CatalogIndex:
+    """Catálogo de vehículos en memoria del proceso, recargable sin reiniciar
+
+    Con base de datos, cada worker sondea la revisión de la tabla catalog_revision y se recarga
+    cuando cambia, así una importación o una recarga pedida a un worker llega a todos.
+    """
+
+    def __init__(self, loader: Optional[Callable[[], Tuple[Iterable[Dict[str, Any]], str]]] = None):
+        self._loader = loader or load_catalog_rows
+        self._lock = threading.Lock()
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._version = 0
+        self._task: Optional[asyncio.Task] = None
+        self._rebuild: Optional[asyncio.Task] = None
+        # Revisión de la base de datos con la que se construyó el snapshot y la última observada
+        self.loaded_revision: Optional[str] = None
+        self.db_revision: Optional[str] = None
+
+    @property
+    def snapshot(self) -> CatalogSnapshot:
+        """Snapshot vigente. Si aún no existe, fuera del event loop se construye en el acto; dentro
+        (p. ej. falló la carga al arrancar) se programa en segundo plano y se lanza CatalogUnavailable"""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            with self._lock:
+                if self._snapshot is None:
+                    self._build()
+            return self._snapshot
+        if self._rebuild is None or self._rebuild.done():
+            self._rebuild = asyncio.ensure_future(self._rebuild_in_background())
+        raise CatalogUnavailable("El catálogo se está cargando; reintente en unos segundos")
+
+    async def _rebuild_in_background(self) -> None:
+        try:
+            await self.reload_async()
+        except Exception as e:
+            print(f"⚠️ Advertencia: no se pudo construir el índice del catálogo: {e}")
+
+    @property
+    def loaded(self) -> bool:
+        return self._snapshot is not None
+
+    def reload(self, rows: Optional[Iterable[Dict[str, Any]]] = None, source: str = "manual") -> Dict[str, Any]:
+        """Reconstruye el índice y lo intercambia atómicamente por el anterior"""
+        with self._lock:
+            previous = self._snapshot.revision if self._snapshot else None
+            self._build(rows, source)
+            info = self._snapshot.info()
+        info["changed"] = info["revision"] != previous
+        return info
+
+    async def reload_async(self) -> Dict[str, Any]:
+        """Como reload(), pero leyendo la tabla vehicles con el pool asíncrono; el snapshot (revisión,
+        índice de búsqueda y facetas) se construye en un hilo para no bloquear el event loop"""
+        # La revisión se lee antes que las filas: si una importación termina en medio, la
+        # siguiente comprobación verá una revisión distinta y volverá a recargar
+        try:
+            revision = await _read_db_revision()
+        except Exception as e:
+            print(f"⚠️ Advertencia: no se pudo leer la revisión del catálogo: {e}")
+            revision = None
+        rows, source = await load_catalog_rows_async()
+        info = await asyncio.to_thread(self.reload, rows, source)
+        self.loaded_revision = self.db_revision = revision
+        return info
+
+    async def check_revision(self) -> bool:
+        """Recarga el índice si la revisión de la base de datos cambió desde la última carga"""
+        self.db_revision = await _read_db_revision()
+        if self.db_revision == self.loaded_revision:
+            return False
+        await self.reload_async()
+        return True
+
+    async def run(self, interval: float = CATALOG_REVISION_POLL_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.check_revision()
+            except Exception as e:
+                print(f"Error al comprobar la revisión del catálogo: {e}")
+
+    def start(self) -> None:
+        if CATALOG_REVISION_POLL_INTERVAL > 0 and os.environ.get("DATABASE_URL") and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        for task in (self._task, self._rebuild):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._rebuild = None
+
+    def _build(self, rows: Optional[Iterable[Dict[str, Any]]] = None, source: str = "manual") -> None:
+        if rows is None:
+            rows, source = self._loader()
+        self._version += 1
+        self._snapshot = CatalogSnapshot(list(rows), version=self._version, source=source)
+
+    # Consultas de la cascada del selector
+    def years(self) -> List[int]:
+        return self.snapshot.years
+
+    def makes(self, year: Optional[int] = None) -> List[str]:
+        return self.snapshot.makes(year)
+
+    def models(self, year: Optional[int] = None, make: Optional[str] = None) -> List[str]:
+        return self.snapshot.models(year, make)
+
+    def engines(self, year: Optional[int] = None, make: Optional[str] = None, model: Optional[str] = None) -> List[str]:
+        return self.snapshot.engines(year, make, model)
+
+    def selector(self, year: Optional[int] = None, make: Optional[str] = None, model: Optional[str] = None,
+                 engine: Optional[str] = None) -> Dict[str, Any]:
+        """Años, marcas, modelos, motores y vehículo de una selección en una sola consulta al snapshot"""
+        return self.snapshot.selector(year, make, model, engine)
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Autocompletado de vehículos por texto libre ("tsuru", "vocho", "chevy aveo 2012")"""
+        return self.snapshot.search(query, limit)
+
+    def facets(self, filters: Dict[str, List[str]], limit: int = 50, offset: int = 0) -> Dict[str, Any]:
+        """Vehículos filtrados por atributos y conteos por faceta (ver FacetIndex)"""
+        return self.snapshot.facets(filters, limit, offset)
+
+    def etag(self, from_db: bool = False) -> str:
+        """ETag de las respuestas del catálogo: las que salen del índice usan la revisión de su
+        contenido; las que leen la base de datos, la revisión compartida que cambia al importar"""
+        if from_db and self.db_revision:
+            return f'"db-{self.db_revision}"'
+        return self.snapshot.etag
+
+    def info(self) -> Dict[str, Any]:
+        return {**self.snapshot.info(), "db_revision": self.loaded_revision}
+
+
+def load_catalog_rows() -> Tuple[List[Dict[str, Any]], str]:
+    """Carga las filas del catálogo desde la tabla vehicles o, si no hay base de datos, desde los CSV"""
+    source = os.environ.get("CATALOG_SOURCE", "auto")
+    if source == "csv" or (source == "auto" and not os.environ.get("DATABASE_URL")):
+        return read_catalog_csv(), "csv"
+
+    from . import db
+    try:
+        return db.get_catalog_rows(), "db"
+    except Exception as e:
+        if source == "db":
+            raise
+        print(f"⚠️ Advertencia: no se pudo cargar el catálogo desde la base de datos, usando CSV: {e}")
+        return read_catalog_csv(), "csv"
+
+
+async def _read_db_revision() -> Optional[str]:
+    """Revisión del catálogo en la base de datos, o None si el catálogo no viene de ella"""
+    source = os.environ.get("CATALOG_SOURCE", "auto")
+    if source == "csv" or not os.environ.get("DATABASE_URL"):
+        return None
+    from . import async_db
+    return await async_db.get_catalog_revision()
+
+
+async def load_catalog_rows_async() -> Tuple[List[Dict[str, Any]], str]:
+    """Variante asíncrona de load_catalog_rows() para usarse dentro del event loop"""
+    source = os.environ.get("CATALOG_SOURCE", "auto")
+    if source == "csv" or (source == "auto" and not os.environ.get("DATABASE_URL")):
+        return await asyncio.to_thread(read_catalog_csv), "csv"
+
+    from . import async_db
+    try:
+        return await async_db.get_catalog_rows(), "db"
+    except Exception as e:
+        if source == "db":
+            raise
+        print(f"⚠️ Advertencia: no se pudo cargar el catálogo desde la base de datos, usando CSV: {e}")
+        return await asyncio.to_thread(read_catalog_csv), "csv"
+
+
+# Índice compartido por las rutas de vehículos
+catalog_index = CatalogIndex()
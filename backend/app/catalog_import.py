@@ -0,0 +1,224 @@
+import argparse
+import csv
+import os
+import time
+from typing import Any, Dict, IO, List, Optional, Sequence
+
+from . import db
+from .db import CATALOG_REVISION_BUMP, CATALOG_REVISION_TABLE
+from .catalog import CATALOG_CSV_FILES, CSV_COLUMNS, DEFAULT_DATA_DIR
+
+# Identidad de un vehículo del catálogo: la misma versión y motor de un modelo en un año
+VEHICLE_NATURAL_KEY = "year, make, model, (COALESCE(\"trim\", '')), (COALESCE(engine, ''))"
+VEHICLE_NATURAL_KEY_INDEX = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS vehicles_natural_key_idx "
+    f"ON vehicles ({VEHICLE_NATURAL_KEY})"
+)
+# Vehículos repetidos que impedirían crear el índice (p. ej. cargados por los importadores de TS)
+DUPLICATE_NATURAL_KEYS = f"""
+    SELECT year, make, model, COALESCE("trim", ''), COALESCE(engine, ''),
+           array_agg(id ORDER BY id), count(*) OVER ()
+    FROM vehicles
+    GROUP BY {VEHICLE_NATURAL_KEY}
+    HAVING count(*) > 1
+    ORDER BY 1, 2, 3, 4, 5
+    LIMIT 20
+"""
+
+# Columnas de vehicles que carga el importador (todas las del CSV)
+VEHICLE_COLUMNS = list(CSV_COLUMNS.values())
+# Columnas que se comparan para decidir si una fila existente cambió
+COMPARED_COLUMNS = [c for c in VEHICLE_COLUMNS if c not in ("year", "make", "model", "trim", "engine")]
+
+# Tabla temporal donde COPY vuelca los CSV tal cual (texto); ord conserva el orden de llegada
+STAGING_TABLE = "vehicles_staging"
+STAGING_DDL = (
+    f"CREATE TEMP TABLE {STAGING_TABLE} (ord BIGSERIAL, "
+    + ", ".join(f'"{c}" TEXT' for c in VEHICLE_COLUMNS)
+    + ") ON COMMIT DROP"
+)
+
+
+class DuplicateVehiclesError(ValueError):
+    """vehicles ya tiene filas repetidas por (año, marca, modelo, versión, motor)"""
+
+    def __init__(self, duplicates: List[tuple]):
+        self.duplicates = duplicates
+        total = duplicates[0][-1] if duplicates else 0
+        lines = [f"  {year} {make} {model} {trim!r} {engine!r}: ids {list(ids)}"
+                 for year, make, model, trim, engine, ids, _ in duplicates]
+        super().__init__(
+            f"vehicles tiene {total} vehículos repetidos; elimínelos o fusiónelos (sus ids pueden estar "
+            f"referenciados) antes de importar. Primeros casos:\n" + "\n".join(lines)
+        )
+
+
+def ensure_natural_key_index(cur: Any) -> None:
+    """Crea el índice único de la identidad del vehículo; si ya hay repetidos lanza
+    DuplicateVehiclesError con los casos en lugar del IntegrityError de CREATE INDEX"""
+    cur.execute("SELECT to_regclass('vehicles_natural_key_idx')")
+    if cur.fetchone()[0] is not None:
+        return
+    cur.execute(DUPLICATE_NATURAL_KEYS)
+    duplicates = cur.fetchall()
+    if duplicates:
+        raise DuplicateVehiclesError(duplicates)
+    cur.execute(VEHICLE_NATURAL_KEY_INDEX)
+
+
+def _quote(column: str) -> str:
+    return f'"{column}"'
+
+
+def _cast(column: str) -> str:
+    """Conversión de la columna de texto del staging al tipo de vehicles (vacío = NULL)"""
+    value = f"NULLIF(btrim({_quote(column)}), '')"
+    if column in ("year", "cylinder_count"):
+        return f"{value}::integer"
+    if column == "is_imported":
+        return f"COALESCE(lower({value}) IN ('true', '1'), false)"
+    if column == "available_in_mexico":
+        return f"COALESCE(lower({value}) IN ('true', '1'), true)"
+    return value
+
+
+def merge_sql(present: Sequence[str] = VEHICLE_COLUMNS) -> str:
+    """Upsert por conjuntos: inserta lo nuevo, actualiza solo lo que cambió y cuenta cada caso
+
+    `present` son las columnas que trae el archivo: las filas existentes solo se comparan y
+    actualizan en esas, así un CSV sin transmisión no borra la transmisión ya cargada.
+    """
+    columns = ", ".join(_quote(c) for c in VEHICLE_COLUMNS)
+    casts = ", ".join(f"{_cast(c)} AS {_quote(c)}" for c in VEHICLE_COLUMNS)
+    compared = [c for c in COMPARED_COLUMNS if c in present]
+    key = "year, make, model, COALESCE(\"trim\", ''), COALESCE(engine, '')"
+    if compared:
+        updates = ", ".join(f"{_quote(c)} = EXCLUDED.{_quote(c)}" for c in compared)
+        current = ", ".join(f"v.{_quote(c)}" for c in compared)
+        incoming = ", ".join(f"EXCLUDED.{_quote(c)}" for c in compared)
+        conflict = (f"DO UPDATE SET {updates}, updated_at = now() "
+                    f"WHERE ({current}) IS DISTINCT FROM ({incoming})")
+    else:
+        conflict = "DO NOTHING"
+    return f"""
+        WITH typed AS (
+            SELECT ord, {casts} FROM {STAGING_TABLE}
+        ),
+        source AS (
+            -- Si un vehículo aparece varias veces gana la última fila importada
+            SELECT DISTINCT ON ({key}) {columns}
+            FROM typed
+            WHERE year IS NOT NULL AND make IS NOT NULL AND model IS NOT NULL
+            ORDER BY {key}, ord DESC
+        ),
+        merged AS (
+            INSERT INTO vehicles AS v ({columns})
+            SELECT {columns} FROM source
+            ON CONFLICT ({VEHICLE_NATURAL_KEY}) {conflict}
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT
+            (SELECT count(*) FROM {STAGING_TABLE}) AS staged,
+            (SELECT count(*) FROM source) AS vehicles,
+            count(*) FILTER (WHERE inserted) AS inserted,
+            count(*) FILTER (WHERE NOT inserted) AS updated
+        FROM merged
+    """
+
+
+def copy_columns(header: Sequence[str]) -> List[str]:
+    """Columnas de vehicles en el orden del encabezado del CSV"""
+    unknown = [name for name in header if name.strip() not in CSV_COLUMNS]
+    if unknown:
+        raise ValueError(f"Columnas desconocidas en el CSV: {', '.join(unknown)}")
+    return [CSV_COLUMNS[name.strip()] for name in header]
+
+
+def copy_csv(cur: Any, f: IO[str]) -> List[str]:
+    """Envía el CSV a la tabla de staging con COPY, sin interpretarlo fila por fila en Python;
+    devuelve las columnas que trae el archivo"""
+    header = next(csv.reader([f.readline()]))
+    present = copy_columns(header)
+    columns = ", ".join(_quote(c) for c in present)
+    cur.copy_expert(f"COPY {STAGING_TABLE} ({columns}) FROM STDIN WITH (FORMAT csv)", f)
+    return present
+
+
+def import_catalog(paths: Sequence[str], conn: Optional[Any] = None) -> Dict[str, Any]:
+    """Importa los CSV a vehicles en una transacción y devuelve cuántas filas se insertaron,
+    actualizaron o quedaron igual
+
+    Si algo cambió, en la misma transacción cambia la revisión de catalog_revision: los workers
+    del API la sondean, recargan su índice y sus ETag dejan de coincidir con las cachés viejas.
+    """
+    started = time.monotonic()
+    own_connection = conn is None
+    conn = conn or db.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            ensure_natural_key_index(cur)
+            cur.execute(STAGING_DDL)
+            rows = vehicles = inserted = updated = 0
+            # Un merge por archivo: cada uno actualiza solo las columnas de su encabezado, y el
+            # archivo posterior gana si repite un vehículo
+            for path in paths:
+                with open(path, newline="", encoding="utf-8") as f:
+                    present = copy_csv(cur, f)
+                cur.execute(f"ANALYZE {STAGING_TABLE}")
+                cur.execute(merge_sql(present))
+                counts = cur.fetchone()
+                rows, vehicles, inserted, updated = (a + b for a, b in zip((rows, vehicles, inserted, updated), counts))
+                cur.execute(f"TRUNCATE {STAGING_TABLE}")
+            revision = None
+            if inserted or updated:
+                cur.execute(CATALOG_REVISION_TABLE)
+                cur.execute(CATALOG_REVISION_BUMP)
+                revision = cur.fetchone()[0]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if own_connection:
+            conn.close()
+    return {
+        "files": len(paths),
+        "rows": rows,
+        "skipped": rows - vehicles,
+        "inserted": inserted,
+        "updated": updated,
+        "unchanged": vehicles - inserted - updated,
+        "revision": revision,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+def default_paths(data_dir: Optional[str] = None) -> List[str]:
+    data_dir = data_dir or os.environ.get("CATALOG_DATA_DIR", DEFAULT_DATA_DIR)
+    paths = [os.path.join(data_dir, name) for name in CATALOG_CSV_FILES]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def main() -> None:
+    """Importa el catálogo: cd backend && python -m app.catalog_import [archivo.csv ...]"""
+    parser = argparse.ArgumentParser(description="Importa el catálogo de vehículos a PostgreSQL con COPY")
+    parser.add_argument("files", nargs="*", help="CSV a importar (por omisión los de data/)")
+    args = parser.parse_args()
+    paths = args.files or default_paths()
+    if not paths:
+        parser.error("No se encontraron archivos CSV para importar")
+    try:
+        result = import_catalog(paths)
+    except DuplicateVehiclesError as e:
+        print(f"Error al importar el catálogo: {e}")
+        raise SystemExit(1)
+    print(
+        f"{result['rows']} filas en {result['seconds']}s: {result['inserted']} insertadas, "
+        f"{result['updated']} actualizadas, {result['unchanged']} sin cambios, {result['skipped']} omitidas"
+    )
+    if result["revision"]:
+        print(f"Nueva revisión del catálogo: {result['revision']} (los workers del API se recargan solos)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,68 @@
 import os
-from typing import List, Optional, Dict, Any
+import base64
+import json
+from typing import List, Optional, Dict, Any, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from .pool import pool_from_env
 
 # Utilizar la variable de entorno DATABASE_URL
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
+# Pool compartido de conexiones; se abre en el arranque de la app (o al primer uso)
+db_pool = pool_from_env()
+
+def open_pool():
+    """Abre el pool de conexiones (llamado en el arranque de la aplicación)"""
+    db_pool.open()
+
+def close_pool():
+    """Cierra el pool de conexiones (llamado al apagar la aplicación)"""
+    db_pool.close()
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Estadísticas del pool: conexiones en uso, ociosas y tiempos de espera"""
+    return db_pool.stats()
+
+# Orden estable y único del catálogo para paginación por cursor (keyset)
+VEHICLE_ORDER_BY = "year DESC, make, model, COALESCE(engine, ''), id"
+# Índice compuesto que respalda ese orden
+VEHICLE_KEYSET_INDEX = (
+    "CREATE INDEX IF NOT EXISTS vehicles_keyset_idx "
+    "ON vehicles (year DESC, make, model, (COALESCE(engine, '')), id)"
+)
+
+# Revisión del catálogo compartida por todos los workers: una sola fila que cambia con cada
+# importación o recarga; cada worker la sondea y reconstruye su índice cuando cambia
+CATALOG_REVISION_TABLE = """
+CREATE TABLE IF NOT EXISTS catalog_revision (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    revision TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+CATALOG_REVISION_BUMP = (
+    "INSERT INTO catalog_revision (id, revision) VALUES (true, md5(random()::text || clock_timestamp()::text)) "
+    "ON CONFLICT (id) DO UPDATE SET revision = EXCLUDED.revision, updated_at = now() RETURNING revision"
+)
+
+def encode_cursor(vehicle: Dict[str, Any]) -> str:
+    """Codifica la tupla (year, make, model, engine, id) del último vehículo como token opaco"""
+    key = [vehicle["year"], vehicle["make"], vehicle["model"], vehicle.get("engine") or "", vehicle["id"]]
+    raw = json.dumps(key, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[int, str, str, str, int]:
+    """Decodifica un token de continuación; lanza ValueError si es inválido"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        year, make, model, engine, vehicle_id = json.loads(raw)
+        return int(year), str(make), str(model), str(engine), int(vehicle_id)
+    except Exception:
+        raise ValueError("Cursor de paginación inválido")
+
 def get_db_connection():
-    """Establece conexión con la base de datos PostgreSQL"""
+    """Establece una conexión dedicada (fuera del pool) con la base de datos PostgreSQL"""
     try:
         conn = psycopg2.connect(DATABASE_URL)
         return conn
@@ -18,146 +73,177 @@ def get_db_connection():
 # Funciones para acceder a los datos de vehículos
 def get_vehicle_years() -> List[int]:
     """Obtiene todos los años de vehículos disponibles ordenados de manera descendente"""
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT DISTINCT year FROM vehicles ORDER BY year DESC")
-            years = [row[0] for row in cur.fetchall()]
-            return years
-    except Exception as e:
-        print(f"Error al obtener años de vehículos: {e}")
-        return []
-    finally:
-        conn.close()
+    with db_pool.connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT DISTINCT year FROM vehicles ORDER BY year DESC")
+                years = [row[0] for row in cur.fetchall()]
+                return years
+        except Exception as e:
+            print(f"Error al obtener años de vehículos: {e}")
+            return []
 
 def get_vehicle_makes(year: Optional[int] = None) -> List[str]:
     """Obtiene todas las marcas de vehículos disponibles para un año específico"""
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            if year:
-                cur.execute("SELECT DISTINCT make FROM vehicles WHERE year = %s ORDER BY make", (year,))
-            else:
-                cur.execute("SELECT DISTINCT make FROM vehicles ORDER BY make")
-            makes = [row[0] for row in cur.fetchall()]
-            return makes
-    except Exception as e:
-        print(f"Error al obtener marcas de vehículos: {e}")
-        return []
-    finally:
-        conn.close()
+    with db_pool.connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                if year:
+                    cur.execute("SELECT DISTINCT make FROM vehicles WHERE year = %s ORDER BY make", (year,))
+                else:
+                    cur.execute("SELECT DISTINCT make FROM vehicles ORDER BY make")
+                makes = [row[0] for row in cur.fetchall()]
+                return makes
+        except Exception as e:
+            print(f"Error al obtener marcas de vehículos: {e}")
+            return []
 
 def get_vehicle_models(year: Optional[int] = None, make: Optional[str] = None) -> List[str]:
     """Obtiene todos los modelos de vehículos disponibles para un año y marca específicos"""
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            query = "SELECT DISTINCT model FROM vehicles"
-            params = []
+    with db_pool.connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                query = "SELECT DISTINCT model FROM vehicles"
+                params = []
             
-            where_clauses = []
-            if year:
-                where_clauses.append("year = %s")
-                params.append(year)
-            if make:
-                where_clauses.append("make = %s")
-                params.append(make)
+                where_clauses = []
+                if year:
+                    where_clauses.append("year = %s")
+                    params.append(year)
+                if make:
+                    where_clauses.append("make = %s")
+                    params.append(make)
             
-            if where_clauses:
-                query += " WHERE " + " AND ".join(where_clauses)
+                if where_clauses:
+                    query += " WHERE " + " AND ".join(where_clauses)
             
-            query += " ORDER BY model"
+                query += " ORDER BY model"
             
-            cur.execute(query, params)
-            models = [row[0] for row in cur.fetchall()]
-            return models
-    except Exception as e:
-        print(f"Error al obtener modelos de vehículos: {e}")
-        return []
-    finally:
-        conn.close()
+                cur.execute(query, params)
+                models = [row[0] for row in cur.fetchall()]
+                return models
+        except Exception as e:
+            print(f"Error al obtener modelos de vehículos: {e}")
+            return []
 
 def get_vehicle_engines(year: Optional[int] = None, make: Optional[str] = None, model: Optional[str] = None) -> List[str]:
     """Obtiene todos los motores de vehículos disponibles para un año, marca y modelo específicos"""
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            query = "SELECT DISTINCT engine FROM vehicles"
-            params = []
+    with db_pool.connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                query = "SELECT DISTINCT engine FROM vehicles"
+                params = []
             
-            where_clauses = []
-            if year:
-                where_clauses.append("year = %s")
-                params.append(year)
-            if make:
-                where_clauses.append("make = %s")
-                params.append(make)
-            if model:
-                where_clauses.append("model = %s")
-                params.append(model)
+                where_clauses = []
+                if year:
+                    where_clauses.append("year = %s")
+                    params.append(year)
+                if make:
+                    where_clauses.append("make = %s")
+                    params.append(make)
+                if model:
+                    where_clauses.append("model = %s")
+                    params.append(model)
             
-            if where_clauses:
-                query += " WHERE " + " AND ".join(where_clauses)
+                if where_clauses:
+                    query += " WHERE " + " AND ".join(where_clauses)
             
-            query += " ORDER BY engine"
+                query += " ORDER BY engine"
             
-            cur.execute(query, params)
-            engines = [row[0] for row in cur.fetchall() if row[0]]  # Filtrar valores nulos
-            return engines
-    except Exception as e:
-        print(f"Error al obtener motores de vehículos: {e}")
-        return []
-    finally:
-        conn.close()
+                cur.execute(query, params)
+                engines = [row[0] for row in cur.fetchall() if row[0]]  # Filtrar valores nulos
+                return engines
+        except Exception as e:
+            print(f"Error al obtener motores de vehículos: {e}")
+            return []
 
 def get_vehicle_by_attributes(year: int, make: str, model: str, engine: Optional[str] = None) -> Optional[Dict[str, Any]]:
     """Obtiene un vehículo específico por sus atributos"""
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            query = "SELECT * FROM vehicles WHERE year = %s AND make = %s AND model = %s"
-            params = [year, make, model]
+    with db_pool.connection() as conn:
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                query = "SELECT * FROM vehicles WHERE year = %s AND make = %s AND model = %s"
+                params = [year, make, model]
             
-            if engine:
-                query += " AND engine = %s"
-                params.append(engine)
+                if engine:
+                    query += " AND engine = %s"
+                    params.append(engine)
             
-            cur.execute(query, params)
-            vehicle = cur.fetchone()
-            return dict(vehicle) if vehicle else None
-    except Exception as e:
-        print(f"Error al obtener vehículo por atributos: {e}")
-        return None
-    finally:
-        conn.close()
+                cur.execute(query, params)
+                vehicle = cur.fetchone()
+                return dict(vehicle) if vehicle else None
+        except Exception as e:
+            print(f"Error al obtener vehículo por atributos: {e}")
+            return None
 
 def get_all_vehicles(limit: int = 100, offset: int = 0) -> List[Dict[str, Any]]:
     """Obtiene todos los vehículos con paginación"""
-    conn = get_db_connection()
-    try:
+    with db_pool.connection() as conn:
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"SELECT * FROM vehicles ORDER BY {VEHICLE_ORDER_BY} LIMIT %s OFFSET %s",
+                    (limit, offset)
+                )
+                vehicles = cur.fetchall()
+                return [dict(v) for v in vehicles]
+        except Exception as e:
+            print(f"Error al obtener todos los vehículos: {e}")
+            return []
+
+def get_vehicles_page(limit: int = 100, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Obtiene una página de vehículos por cursor (keyset) y el token de la página siguiente"""
+    after = decode_cursor(cursor) if cursor else None
+    with db_pool.connection() as conn:
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if after:
+                    # `year <= año` acota el recorrido del índice al año del cursor en adelante;
+                    # sin él, el OR hace revisar las filas de todas las páginas anteriores
+                    cur.execute(
+                        "SELECT * FROM vehicles WHERE year <= %s AND (year < %s OR (year = %s AND "
+                        "(make, model, COALESCE(engine, ''), id) > (%s, %s, %s, %s))) "
+                        f"ORDER BY {VEHICLE_ORDER_BY} LIMIT %s",
+                        (after[0], after[0], after[0], after[1], after[2], after[3], after[4], limit)
+                    )
+                else:
+                    cur.execute(f"SELECT * FROM vehicles ORDER BY {VEHICLE_ORDER_BY} LIMIT %s", (limit,))
+                vehicles = [dict(v) for v in cur.fetchall()]
+                next_cursor = encode_cursor(vehicles[-1]) if len(vehicles) == limit else None
+                return vehicles, next_cursor
+        except Exception as e:
+            print(f"Error al obtener página de vehículos: {e}")
+            return [], None
+
+def count_vehicles(exact: bool = True) -> int:
+    """Cuenta el número total de vehículos; con exact=False usa la estimación de pg_class"""
+    with db_pool.connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                if not exact:
+                    cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'vehicles'::regclass")
+                    estimate = cur.fetchone()[0]
+                    # reltuples es -1 (o 0) si la tabla nunca se ha analizado
+                    if estimate and estimate > 0:
+                        return estimate
+                cur.execute("SELECT COUNT(*) FROM vehicles")
+                count = cur.fetchone()[0]
+                return count
+        except Exception as e:
+            print(f"Error al contar vehículos: {e}")
+            return 0
+
+def get_catalog_rows() -> List[Dict[str, Any]]:
+    """Obtiene todas las filas de vehículos para construir el índice del catálogo (propaga errores)"""
+    with db_pool.connection() as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                "SELECT * FROM vehicles ORDER BY year DESC, make, model LIMIT %s OFFSET %s",
-                (limit, offset)
-            )
-            vehicles = cur.fetchall()
-            return [dict(v) for v in vehicles]
-    except Exception as e:
-        print(f"Error al obtener todos los vehículos: {e}")
-        return []
-    finally:
-        conn.close()
-
-def count_vehicles() -> int:
-    """Cuenta el número total de vehículos en la base de datos"""
-    conn = get_db_connection()
-    try:
+            cur.execute("SELECT * FROM vehicles ORDER BY id")
+            return [dict(v) for v in cur.fetchall()]
+
+def ensure_indexes() -> None:
+    """Crea los índices que necesitan las consultas del backend si aún no existen"""
+    with db_pool.connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM vehicles")
-            count = cur.fetchone()[0]
-            return count
-    except Exception as e:
-        print(f"Error al contar vehículos: {e}")
-        return 0
-    finally:
-        conn.close()
\ No newline at end of file
+            cur.execute(VEHICLE_KEYSET_INDEX)
+            cur.execute(CATALOG_REVISION_TABLE)
+        conn.commit()
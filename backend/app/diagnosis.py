@@ -0,0 +1,287 @@
+import asyncio
+import json
+import os
+import re
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Dict, List, Optional
+
+import anthropic
+from fastapi import Request
+from pydantic import BaseModel
+
+from .dtc import dtc_database
+
+# Modelos Pydantic para validación de datos
+class VehicleInfo(BaseModel):
+    year: int
+    make: str
+    model: str
+    engine: Optional[str] = None
+
+class DiagnosticRequest(BaseModel):
+    vehicle: VehicleInfo
+    symptoms: str
+    code: Optional[str] = None
+    language: Optional[str] = "es"
+
+class DiagnosticResponse(BaseModel):
+    analysis: str
+    recommended_actions: List[str]
+    possible_causes: List[str]
+    severity: str
+    parts: List[Dict[str, Any]]
+
+
+class DiagnosisError(Exception):
+    """La respuesta del modelo no pudo convertirse en un diagnóstico"""
+
+
+class ClientDisconnected(Exception):
+    """El cliente HTTP cerró la conexión antes de recibir el diagnóstico"""
+
+
+# Configuración de las llamadas al modelo
+DIAGNOSIS_MODEL = os.environ.get("DIAGNOSIS_MODEL", "claude-3-7-sonnet-20250219")
+DIAGNOSIS_MAX_TOKENS = 2000
+# Segundos máximos por llamada a Claude
+DIAGNOSE_TIMEOUT = float(os.environ.get("DIAGNOSE_TIMEOUT", "60"))
+# Diagnósticos simultáneos permitidos por worker
+DIAGNOSE_MAX_CONCURRENCY = int(os.environ.get("DIAGNOSE_MAX_CONCURRENCY", "32"))
+# Cada cuánto se comprueba si el cliente HTTP sigue conectado
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# Cliente asíncrono de Anthropic (Claude); los reintentos y el timeout los gestiona este módulo
+client = anthropic.AsyncAnthropic(
+    api_key=os.environ.get("ANTHROPIC_API_KEY"),
+    max_retries=1,
+)
+
+_semaphore = asyncio.Semaphore(DIAGNOSE_MAX_CONCURRENCY)
+_stats = {"in_flight": 0, "waiting": 0, "completed": 0, "failed": 0, "timeouts": 0, "cancelled": 0}
+# Uso de tokens reportado por la API, para verificar el efecto del prompt caching
+_usage = {
+    "responses": 0,
+    "input_tokens": 0,
+    "output_tokens": 0,
+    "cache_creation_input_tokens": 0,
+    "cache_read_input_tokens": 0,
+    "cache_hits": 0,
+    "streams": 0,
+    "time_to_first_token_total": 0.0,
+}
+
+
+def response_language(language: Optional[str]) -> str:
+    """Idioma de la respuesta: español para "es", inglés para cualquier otro valor"""
+    return "español" if language == "es" else "inglés"
+
+
+def build_system_prompt(language: Optional[str]) -> str:
+    """Construye el prompt de sistema para el idioma solicitado"""
+    language = response_language(language)
+    return f"""
+        Eres un mecánico automotriz experto especializado en diagnóstico de vehículos.
+        Tu tarea es analizar los síntomas y/o códigos OBD-II proporcionados por el usuario y ofrecer un diagnóstico detallado.
+        Debes responder únicamente en {language}.
+
+        Para cada diagnóstico, debes proporcionar:
+        1. Un análisis detallado del problema
+        2. Una lista de posibles causas
+        3. Acciones recomendadas para solucionar el problema
+        4. Nivel de severidad (Bajo, Medio, Alto, Crítico)
+        5. Piezas que podrían necesitar reemplazo
+
+        Tu respuesta debe estar estrictamente estructurada en formato JSON con las siguientes claves:
+        {{
+            "analysis": "texto detallado explicando el problema",
+            "possible_causes": ["causa 1", "causa 2", ...],
+            "recommended_actions": ["acción 1", "acción 2", ...],
+            "severity": "nivel de severidad",
+            "parts": [
+                {{"name": "nombre de la pieza", "description": "descripción breve", "urgency": "urgencia de reemplazo"}}
+            ]
+        }}
+
+        No incluyas información adicional fuera de este formato JSON. Sé preciso y utiliza terminología técnica apropiada.
+        """
+
+
+# Prompts de sistema precompilados una sola vez por idioma, con marca de caché del proveedor
+# para que el prefijo estático se reutilice entre solicitudes
+SYSTEM_PROMPTS: Dict[str, List[Dict[str, Any]]] = {
+    response_language(code): [
+        {"type": "text", "text": build_system_prompt(code), "cache_control": {"type": "ephemeral"}}
+    ]
+    for code in ("es", "en")
+}
+
+
+def get_system_prompt(language: Optional[str]) -> List[Dict[str, Any]]:
+    """Bloques de sistema precompilados (con cache_control) para el idioma solicitado"""
+    return SYSTEM_PROMPTS[response_language(language)]
+
+
+def record_usage(usage: Any, time_to_first_token: Optional[float] = None) -> None:
+    """Acumula el uso de tokens de una respuesta, incluidas las lecturas y escrituras de caché"""
+    if usage is None:
+        return
+    _usage["responses"] += 1
+    for field in ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"):
+        _usage[field] += getattr(usage, field, None) or 0
+    if getattr(usage, "cache_read_input_tokens", None):
+        _usage["cache_hits"] += 1
+    if time_to_first_token is not None:
+        _usage["streams"] += 1
+        _usage["time_to_first_token_total"] += time_to_first_token
+
+
+def get_prompt_cache_stats() -> Dict[str, Any]:
+    """Métricas del prompt caching: tokens leídos de caché frente a tokens de entrada totales"""
+    prompt_tokens = _usage["input_tokens"] + _usage["cache_creation_input_tokens"] + _usage["cache_read_input_tokens"]
+    streams = _usage["streams"]
+    return {
+        **{k: v for k, v in _usage.items() if k != "time_to_first_token_total"},
+        "cache_hit_ratio": round(_usage["cache_hits"] / _usage["responses"], 4) if _usage["responses"] else 0.0,
+        "cached_token_ratio": round(_usage["cache_read_input_tokens"] / prompt_tokens, 4) if prompt_tokens else 0.0,
+        "time_to_first_token_avg": round(_usage["time_to_first_token_total"] / streams, 4) if streams else None,
+    }
+
+
+def build_user_message(request: DiagnosticRequest) -> str:
+    """Construye el mensaje del usuario con el vehículo, el código y los síntomas"""
+    vehicle_info = f"{request.vehicle.year} {request.vehicle.make} {request.vehicle.model}"
+    if request.vehicle.engine:
+        vehicle_info += f" {request.vehicle.engine}"
+
+    user_message = f"Vehículo: {vehicle_info}\n"
+
+    if request.code:
+        user_message += f"Código de error: {request.code}\n"
+        user_message += dtc_context(request.code)
+
+    user_message += f"Síntomas: {request.symptoms}\n"
+    user_message += "\nPor favor, proporciona un diagnóstico detallado."
+    return user_message
+
+
+def dtc_context(code: str) -> str:
+    """Contexto verificado de la tabla local de códigos DTC para acompañar el mensaje al modelo"""
+    entry = dtc_database.lookup(code)
+    if entry is None:
+        return ""
+    if not entry.verified:
+        return f"Familia del código (referencia SAE): {entry.description}\n"
+    context = f"Definición verificada del código (SAE): {entry.description} (sistema: {entry.system})\n"
+    if entry.possible_causes:
+        context += f"Causas comunes conocidas: {'; '.join(entry.possible_causes)}\n"
+    return context
+
+
+def quick_diagnosis(request: DiagnosticRequest) -> Optional[Dict[str, Any]]:
+    """Diagnóstico inmediato desde la tabla local para solicitudes en español que solo traen un código conocido"""
+    if request.symptoms.strip() or response_language(request.language) != "español":
+        return None
+    entry = dtc_database.get(request.code)
+    if entry is None:
+        return None
+    vehicle = f"{request.vehicle.year} {request.vehicle.make} {request.vehicle.model}"
+    return {
+        "analysis": (
+            f"El código {entry.code} indica: {entry.description}. Pertenece al sistema de {entry.system.lower()}. "
+            f"Este diagnóstico proviene de la definición genérica del código; para un análisis específico "
+            f"de su {vehicle}, describa los síntomas que presenta."
+        ),
+        "possible_causes": entry.possible_causes,
+        "recommended_actions": entry.recommended_actions,
+        "severity": entry.severity or "Medio",
+        "parts": [
+            {"name": part, "description": f"Pieza relacionada con el código {entry.code}", "urgency": entry.severity or "Media"}
+            for part in entry.parts
+        ],
+    }
+
+
+def parse_diagnostic_response(response_text: str) -> Dict[str, Any]:
+    """Parsea el JSON de la respuesta del modelo, extrayéndolo del texto si hace falta"""
+    try:
+        return json.loads(response_text)
+    except json.JSONDecodeError:
+        # Si la respuesta no es un JSON válido, intentar extraer la parte JSON
+        json_match = re.search(r'{[\s\S]*}', response_text)
+        if json_match:
+            try:
+                return json.loads(json_match.group(0))
+            except json.JSONDecodeError:
+                pass
+    raise DiagnosisError("No se pudo procesar la respuesta del modelo")
+
+
+@asynccontextmanager
+async def diagnosis_slot():
+    """Reserva un lugar del semáforo de concurrencia y contabiliza el resultado de la llamada"""
+    _stats["waiting"] += 1
+    try:
+        await _semaphore.acquire()
+    finally:
+        _stats["waiting"] -= 1
+
+    _stats["in_flight"] += 1
+    try:
+        yield
+        _stats["completed"] += 1
+    except asyncio.TimeoutError:
+        _stats["timeouts"] += 1
+        raise
+    except asyncio.CancelledError:
+        _stats["cancelled"] += 1
+        raise
+    except Exception:
+        _stats["failed"] += 1
+        raise
+    finally:
+        _stats["in_flight"] -= 1
+        _semaphore.release()
+
+
+async def run_diagnosis(request: DiagnosticRequest) -> Dict[str, Any]:
+    """Llama a Claude sin bloquear el event loop, respetando el límite de concurrencia y el timeout"""
+    async with diagnosis_slot():
+        response = await asyncio.wait_for(
+            client.messages.create(
+                model=DIAGNOSIS_MODEL,
+                system=get_system_prompt(request.language),
+                max_tokens=DIAGNOSIS_MAX_TOKENS,
+                messages=[
+                    {"role": "user", "content": build_user_message(request)}
+                ]
+            ),
+            timeout=DIAGNOSE_TIMEOUT,
+        )
+        record_usage(getattr(response, "usage", None))
+        return parse_diagnostic_response(response.content[0].text)
+
+
+async def cancel_on_disconnect(awaitable: Awaitable[Any], http_request: Request) -> Any:
+    """Ejecuta la corrutina y la cancela si el cliente HTTP se desconecta antes de que termine"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                task.cancel()
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def get_diagnosis_stats() -> Dict[str, Any]:
+    """Estadísticas de las llamadas de diagnóstico en este worker"""
+    return {
+        **_stats,
+        "max_concurrency": DIAGNOSE_MAX_CONCURRENCY,
+        "timeout": DIAGNOSE_TIMEOUT,
+        "prompt_cache": get_prompt_cache_stats(),
+    }
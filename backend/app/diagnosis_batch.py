@@ -0,0 +1,262 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, ValidationError
+
+from . import diagnosis
+from .cache import TTLCache
+from .diagnosis import DiagnosticRequest, DiagnosticResponse, parse_diagnostic_response
+from .diagnosis_cache import diagnosis_cache, diagnosis_cache_key
+
+# Máximo de vehículos por lote y diagnósticos simultáneos por lote
+DIAGNOSE_BATCH_MAX_ITEMS = int(os.environ.get("DIAGNOSE_BATCH_MAX_ITEMS", "100"))
+DIAGNOSE_BATCH_CONCURRENCY = int(os.environ.get("DIAGNOSE_BATCH_CONCURRENCY", "8"))
+# Máximo de vehículos por trabajo diferido (la API Message Batches admite hasta 100.000)
+DIAGNOSE_BATCH_JOB_MAX_ITEMS = int(os.environ.get("DIAGNOSE_BATCH_JOB_MAX_ITEMS", "10000"))
+# Trabajos diferidos retenidos por worker y segundos que se conservan desde su envío o su fin
+DIAGNOSE_BATCH_MAX_JOBS = int(os.environ.get("DIAGNOSE_BATCH_MAX_JOBS", "1000"))
+DIAGNOSE_BATCH_JOB_TTL = float(os.environ.get("DIAGNOSE_BATCH_JOB_TTL", str(48 * 3600)))
+# Backend de los trabajos diferidos: "anthropic" (Message Batches) o "local" (sin red)
+DIAGNOSE_BATCH_BACKEND = os.environ.get("DIAGNOSE_BATCH_BACKEND")
+
+
+class BatchDiagnosticRequest(BaseModel):
+    requests: List[DiagnosticRequest]
+
+class BatchItemResult(BaseModel):
+    index: int
+    status: str  # "ok" o "error"
+    result: Optional[DiagnosticResponse] = None
+    error: Optional[str] = None
+
+class BatchDiagnosticResponse(BaseModel):
+    results: List[BatchItemResult]
+    unique: int
+    duplicates: int
+
+class BatchJobStatus(BaseModel):
+    job_id: str
+    backend: str
+    status: str  # "in_progress" o "ended"
+    created_at: str
+    ended_at: Optional[str] = None
+    total: int
+    unique: int
+    results: Optional[List[BatchItemResult]] = None
+
+
+def deduplicate(requests: List[DiagnosticRequest]) -> Tuple[Dict[str, DiagnosticRequest], List[str]]:
+    """Agrupa solicitudes equivalentes: devuelve las únicas por clave y la clave de cada posición"""
+    unique: Dict[str, DiagnosticRequest] = {}
+    keys = []
+    for request in requests:
+        key = diagnosis_cache_key(request)
+        unique.setdefault(key, request)
+        keys.append(key)
+    return unique, keys
+
+
+def expand_results(keys: List[str], outcomes: Dict[str, Tuple[Optional[Dict[str, Any]], Optional[str]]]) -> List[BatchItemResult]:
+    """Reparte el resultado de cada solicitud única entre todas las posiciones que la repiten"""
+    results = []
+    for index, key in enumerate(keys):
+        result, error = outcomes.get(key, (None, "Sin resultado"))
+        if error is None:
+            try:
+                results.append(BatchItemResult(index=index, status="ok", result=DiagnosticResponse.model_validate(result)))
+                continue
+            except ValidationError:
+                error = "No se pudo procesar la respuesta del modelo"
+        results.append(BatchItemResult(index=index, status="error", error=error))
+    return results
+
+
+async def diagnose_batch(
+    requests: List[DiagnosticRequest],
+    concurrency: int = DIAGNOSE_BATCH_CONCURRENCY,
+) -> BatchDiagnosticResponse:
+    """Diagnostica un lote en línea: deduplica, reparte con concurrencia acotada y aísla los errores"""
+    unique, keys = deduplicate(requests)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(key: str, request: DiagnosticRequest) -> Tuple[str, Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+        async with semaphore:
+            try:
+                return key, (await diagnosis_cache.get_or_compute(request), None)
+            except asyncio.TimeoutError:
+                return key, (None, "El diagnóstico excedió el tiempo máximo de espera")
+            except Exception as e:
+                return key, (None, f"Error en el diagnóstico: {str(e)}")
+
+    outcomes = dict(await asyncio.gather(*(run(key, request) for key, request in unique.items())))
+    return BatchDiagnosticResponse(
+        results=expand_results(keys, outcomes),
+        unique=len(unique),
+        duplicates=len(requests) - len(unique),
+    )
+
+
+# Backends para trabajos diferidos (submit/poll)
+class AnthropicBatchBackend:
+    """Trabajos diferidos sobre la API Message Batches de Anthropic"""
+
+    name = "anthropic"
+
+    async def submit(self, items: Dict[str, DiagnosticRequest]) -> str:
+        batch = await diagnosis.client.messages.batches.create(
+            requests=[
+                {
+                    "custom_id": key,
+                    "params": {
+                        "model": diagnosis.DIAGNOSIS_MODEL,
+                        "max_tokens": diagnosis.DIAGNOSIS_MAX_TOKENS,
+                        "system": diagnosis.get_system_prompt(request.language),
+                        "messages": [{"role": "user", "content": diagnosis.build_user_message(request)}],
+                    },
+                }
+                for key, request in items.items()
+            ]
+        )
+        return batch.id
+
+    async def poll(self, provider_id: str) -> Optional[Dict[str, Tuple[Optional[Dict[str, Any]], Optional[str]]]]:
+        """Devuelve None mientras el lote siga en proceso; al terminar, el resultado por clave"""
+        batch = await diagnosis.client.messages.batches.retrieve(provider_id)
+        if batch.processing_status != "ended":
+            return None
+
+        outcomes = {}
+        async for entry in await diagnosis.client.messages.batches.results(provider_id):
+            if entry.result.type == "succeeded":
+                diagnosis.record_usage(entry.result.message.usage)
+                try:
+                    outcomes[entry.custom_id] = (parse_diagnostic_response(entry.result.message.content[0].text), None)
+                except Exception as e:
+                    outcomes[entry.custom_id] = (None, str(e))
+            else:
+                outcomes[entry.custom_id] = (None, f"Solicitud {entry.result.type} en el lote")
+        return outcomes
+
+
+class LocalBatchBackend:
+    """Sustituto local de la API de lotes: procesa en segundo plano dentro del proceso, sin red propia"""
+
+    name = "local"
+
+    def __init__(self, compute: Optional[Callable[[DiagnosticRequest], Awaitable[Dict[str, Any]]]] = None):
+        self._compute = compute
+        # Acotado como los trabajos: las tareas que nadie consulta no se acumulan
+        self._tasks = TTLCache(maxsize=DIAGNOSE_BATCH_MAX_JOBS, ttl=DIAGNOSE_BATCH_JOB_TTL)
+
+    async def submit(self, items: Dict[str, DiagnosticRequest]) -> str:
+        provider_id = f"localbatch_{uuid.uuid4().hex}"
+        self._tasks.set(provider_id, asyncio.ensure_future(self._process(items)))
+        return provider_id
+
+    async def _process(self, items: Dict[str, DiagnosticRequest]) -> Dict[str, Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+        semaphore = asyncio.Semaphore(DIAGNOSE_BATCH_CONCURRENCY)
+
+        async def run(key: str, request: DiagnosticRequest):
+            async with semaphore:
+                try:
+                    if self._compute is not None:
+                        return key, (await self._compute(request), None)
+                    return key, (await diagnosis_cache.get_or_compute(request), None)
+                except Exception as e:
+                    return key, (None, f"Error en el diagnóstico: {str(e)}")
+
+        return dict(await asyncio.gather(*(run(key, request) for key, request in items.items())))
+
+    async def poll(self, provider_id: str) -> Optional[Dict[str, Tuple[Optional[Dict[str, Any]], Optional[str]]]]:
+        task = self._tasks.get(provider_id, None)
+        if task is None:
+            raise KeyError(provider_id)
+        if not task.done():
+            return None
+        self._tasks.delete(provider_id)
+        return task.result()
+
+
+def default_backend():
+    """Backend configurado por DIAGNOSE_BATCH_BACKEND; sin clave de Anthropic se usa el local"""
+    name = DIAGNOSE_BATCH_BACKEND or ("anthropic" if os.environ.get("ANTHROPIC_API_KEY") else "local")
+    return AnthropicBatchBackend() if name == "anthropic" else LocalBatchBackend()
+
+
+class BatchJobManager:
+    """Registro en memoria de los trabajos diferidos de este worker
+
+    Cada trabajo solo puede consultarse en el worker que lo recibió. El registro
+    está acotado: los más antiguos se descartan al superar DIAGNOSE_BATCH_MAX_JOBS
+    y cada trabajo caduca DIAGNOSE_BATCH_JOB_TTL segundos después de enviarse o
+    de terminar.
+    """
+
+    def __init__(self, backend=None, maxsize: int = DIAGNOSE_BATCH_MAX_JOBS, ttl: float = DIAGNOSE_BATCH_JOB_TTL):
+        self._backend = backend
+        self._jobs = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = default_backend()
+        return self._backend
+
+    async def submit(self, requests: List[DiagnosticRequest]) -> BatchJobStatus:
+        unique, keys = deduplicate(requests)
+        provider_id = await self.backend.submit(unique)
+        job = {
+            "job_id": provider_id,
+            "backend": self.backend.name,
+            "status": "in_progress",
+            "created_at": datetime.now().isoformat(),
+            "ended_at": None,
+            "keys": keys,
+            "unique": unique,
+            "results": None,
+            # Serializa las consultas: solo la primera que ve el lote terminado recoge sus resultados
+            "lock": asyncio.Lock(),
+        }
+        self._jobs.set(provider_id, job)
+        return self._status(job)
+
+    async def poll(self, job_id: str) -> BatchJobStatus:
+        """Consulta el estado del trabajo; lanza KeyError si no existe en este worker o ya caducó"""
+        job = self._jobs.get(job_id, None)
+        if job is None:
+            raise KeyError(job_id)
+        async with job["lock"]:
+            if job["status"] != "ended":
+                outcomes = await self.backend.poll(job_id)
+                if outcomes is not None:
+                    # Los resultados del lote también alimentan la caché de diagnósticos
+                    for key, request in job["unique"].items():
+                        result, error = outcomes.get(key, (None, "Sin resultado"))
+                        if error is None:
+                            diagnosis_cache.memory.set(key, result)
+                    job["results"] = expand_results(job["keys"], outcomes)
+                    job["status"] = "ended"
+                    job["ended_at"] = datetime.now().isoformat()
+                    # Los resultados se conservan el TTL completo desde que el lote termina
+                    self._jobs.set(job_id, job)
+        return self._status(job)
+
+    @staticmethod
+    def _status(job: Dict[str, Any]) -> BatchJobStatus:
+        return BatchJobStatus(
+            job_id=job["job_id"],
+            backend=job["backend"],
+            status=job["status"],
+            created_at=job["created_at"],
+            ended_at=job["ended_at"],
+            total=len(job["keys"]),
+            unique=len(job["unique"]),
+            results=job["results"],
+        )
+
+
+# Trabajos diferidos compartidos por las rutas de diagnóstico por lotes
+batch_jobs = BatchJobManager()
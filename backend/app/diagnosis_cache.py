@@ -0,0 +1,138 @@
+import copy
+import hashlib
+import json
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from . import async_db
+from .cache import MISSING, SingleFlight, TTLCache
+from .diagnosis import DiagnosticRequest, quick_diagnosis, response_language, run_diagnosis
+
+# Configuración de la caché de diagnósticos
+DIAGNOSIS_CACHE_SIZE = int(os.environ.get("DIAGNOSIS_CACHE_SIZE", "1024"))
+DIAGNOSIS_CACHE_TTL = float(os.environ.get("DIAGNOSIS_CACHE_TTL", str(24 * 3600)))
+# Nivel persistente opcional en PostgreSQL (tabla diagnosis_cache)
+DIAGNOSIS_CACHE_PERSIST = os.environ.get("DIAGNOSIS_CACHE_PERSIST", "false").lower() in ("1", "true", "yes")
+
+DIAGNOSIS_CACHE_TABLE = """
+CREATE TABLE IF NOT EXISTS diagnosis_cache (
+    key TEXT PRIMARY KEY,
+    response JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+
+def _fold(value: Optional[str]) -> str:
+    """Normaliza texto libre: minúsculas (casefold) y espacios colapsados"""
+    return " ".join((value or "").casefold().split())
+
+
+def normalize_request(request: DiagnosticRequest) -> Dict[str, Any]:
+    """Forma canónica de una solicitud: dos solicitudes equivalentes producen el mismo dict"""
+    return {
+        "year": request.vehicle.year,
+        "make": _fold(request.vehicle.make),
+        "model": _fold(request.vehicle.model),
+        "engine": _fold(request.vehicle.engine),
+        "code": (request.code or "").strip().upper(),
+        "symptoms": _fold(request.symptoms),
+        # El idioma en que se responderá, no el texto recibido ("ES" y None se responden en inglés)
+        "language": response_language(request.language),
+    }
+
+
+def diagnosis_cache_key(request: DiagnosticRequest) -> str:
+    """Clave de caché estable derivada de la solicitud normalizada"""
+    canonical = json.dumps(normalize_request(request), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class DiagnosisCache:
+    """Caché de diagnósticos: LRU con TTL en memoria, nivel opcional en Postgres y coalescencia"""
+
+    def __init__(self, maxsize: int = DIAGNOSIS_CACHE_SIZE, ttl: float = DIAGNOSIS_CACHE_TTL, persist: bool = DIAGNOSIS_CACHE_PERSIST):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.flight = SingleFlight()
+        self.persist = persist
+        self.persistent_hits = 0
+        self.upstream_calls = 0
+        self.quick_answers = 0
+
+    async def get_or_compute(
+        self,
+        request: DiagnosticRequest,
+        compute: Callable[[DiagnosticRequest], Awaitable[Dict[str, Any]]] = run_diagnosis,
+    ) -> Dict[str, Any]:
+        """Devuelve el diagnóstico en caché o lo calcula una sola vez para solicitudes idénticas"""
+        # Los códigos conocidos sin síntomas se responden desde la tabla local, sin llamar al modelo
+        quick = quick_diagnosis(request)
+        if quick is not None:
+            self.quick_answers += 1
+            return quick
+
+        key = diagnosis_cache_key(request)
+        cached = self.memory.get(key)
+        if cached is not MISSING:
+            return copy.deepcopy(cached)
+
+        async def load() -> Dict[str, Any]:
+            result = await self._load_persistent(key)
+            if result is None:
+                self.upstream_calls += 1
+                result = await compute(request)
+                await self._store_persistent(key, result)
+            else:
+                self.persistent_hits += 1
+            self.memory.set(key, result)
+            return result
+
+        return copy.deepcopy(await self.flight.do(key, load))
+
+    async def _load_persistent(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.persist:
+            return None
+        try:
+            async with async_db.connection() as conn:
+                value = await conn.fetchval(
+                    "SELECT response FROM diagnosis_cache WHERE key = $1 "
+                    "AND created_at > now() - make_interval(secs => $2)",
+                    key, self.memory.ttl
+                )
+            return json.loads(value) if value else None
+        except Exception as e:
+            print(f"Error al leer la caché persistente de diagnósticos: {e}")
+            return None
+
+    async def _store_persistent(self, key: str, result: Dict[str, Any]) -> None:
+        if not self.persist:
+            return
+        try:
+            async with async_db.connection() as conn:
+                await conn.execute(
+                    "INSERT INTO diagnosis_cache (key, response) VALUES ($1, $2::jsonb) "
+                    "ON CONFLICT (key) DO UPDATE SET response = EXCLUDED.response, created_at = now()",
+                    key, json.dumps(result)
+                )
+        except Exception as e:
+            print(f"Error al guardar en la caché persistente de diagnósticos: {e}")
+
+    async def ensure_table(self) -> None:
+        """Crea la tabla del nivel persistente si está habilitado"""
+        if not self.persist:
+            return
+        async with async_db.connection() as conn:
+            await conn.execute(DIAGNOSIS_CACHE_TABLE)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory": self.memory.stats(),
+            "persistent": {"enabled": self.persist, "hits": self.persistent_hits},
+            "singleflight": self.flight.stats(),
+            "upstream_calls": self.upstream_calls,
+            "quick_answers": self.quick_answers,
+        }
+
+
+# Caché compartida por las rutas de diagnóstico
+diagnosis_cache = DiagnosisCache()
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from . import diagnosis
+from .cache import MISSING
+from .diagnosis import DiagnosticRequest, DiagnosticResponse, DiagnosisError, parse_diagnostic_response
+from .diagnosis_cache import diagnosis_cache, diagnosis_cache_key
+
+# Nombre del evento SSE emitido por cada elemento de los campos de tipo lista
+ITEM_EVENTS = {
+    "possible_causes": "possible_cause",
+    "recommended_actions": "recommended_action",
+    "parts": "part",
+}
+
+Event = Tuple[str, Dict[str, Any]]
+
+
+class IncrementalDiagnosisParser:
+    """Parser incremental del JSON de diagnóstico que emite cada campo en cuanto se completa.
+
+    Los campos escalares del objeto raíz (``analysis``, ``severity``) se emiten al cerrarse;
+    los campos de tipo lista (``possible_causes``, ``recommended_actions``, ``parts``) emiten
+    un evento por elemento. El texto previo al primer ``{`` (p. ej. una cerca ```json) se ignora.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.finished = False
+        self.result: Optional[Dict[str, Any]] = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expect_key = True
+        self._key: Optional[str] = None
+        self._string_start = 0
+        self._value_start: Optional[int] = None   # inicio del valor de un campo raíz
+        self._item_start: Optional[int] = None    # inicio del elemento actual de una lista raíz
+        self._in_array = False
+        self._item_index = 0
+
+    def feed(self, chunk: str) -> List[Event]:
+        """Agrega texto recibido del modelo y devuelve los eventos que quedaron completos"""
+        events: List[Event] = []
+        if self.finished:
+            return events
+        if not self.started:
+            start = chunk.find("{")
+            if start < 0:
+                return events
+            chunk = chunk[start:]
+            self.started = True
+        self.buffer += chunk
+
+        buf = self.buffer
+        while self._pos < len(buf):
+            i, ch = self._pos, buf[self._pos]
+            self._pos += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._end_string(i, events)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+                self._begin_value(i)
+            elif ch in "{[":
+                self._begin_value(i)
+                self._depth += 1
+                if ch == "[" and self._depth == 2:
+                    self._in_array = True
+                    self._item_index = 0
+            elif ch in "}]":
+                self._close_scalar(i, events)
+                self._depth -= 1
+                if self._depth == 0:
+                    self.finished = True
+                    self.result = json.loads(buf[:i + 1])
+                    break
+                if self._depth == 1:
+                    if self._in_array and ch == "]":
+                        self._in_array = False
+                        self._finish_field(i, events)
+                elif self._depth == 2 and self._in_array and self._item_start is not None:
+                    # Se cerró un objeto que era elemento de una lista raíz
+                    self._emit_item(buf[self._item_start:i + 1], events)
+            elif ch == ",":
+                self._close_scalar(i, events)
+                if self._depth == 1:
+                    self._expect_key = True
+            elif ch == ":" and self._depth == 1:
+                self._expect_key = False
+            elif not ch.isspace():
+                self._begin_value(i)
+        return events
+
+    # Utilidades internas
+    def _begin_value(self, i: int) -> None:
+        if self._depth == 1 and not self._expect_key and self._value_start is None:
+            self._value_start = i
+        elif self._depth == 2 and self._in_array and self._item_start is None:
+            self._item_start = i
+
+    def _end_string(self, i: int, events: List[Event]) -> None:
+        if self._depth == 1 and self._expect_key and self._value_start is None:
+            self._key = json.loads(self.buffer[self._string_start:i + 1])
+        elif self._depth == 1 and self._value_start == self._string_start:
+            self._finish_field(i, events)
+        elif self._depth == 2 and self._in_array and self._item_start == self._string_start:
+            self._emit_item(self.buffer[self._item_start:i + 1], events)
+
+    def _close_scalar(self, i: int, events: List[Event]) -> None:
+        """Cierra números o literales (true/false/null) que terminan en ',' '}' o ']'"""
+        if self._depth == 1 and self._value_start is not None:
+            self._finish_field(i - 1, events)
+        elif self._depth == 2 and self._in_array and self._item_start is not None:
+            self._emit_item(self.buffer[self._item_start:i], events)
+
+    def _finish_field(self, end: int, events: List[Event]) -> None:
+        if self._value_start is None:
+            return
+        raw = self.buffer[self._value_start:end + 1].strip()
+        if self._key not in ITEM_EVENTS:
+            events.append((self._key, {"value": json.loads(raw)}))
+        self._value_start = None
+
+    def _emit_item(self, raw: str, events: List[Event]) -> None:
+        event = ITEM_EVENTS.get(self._key, f"{self._key}_item")
+        events.append((event, {"index": self._item_index, "value": json.loads(raw.strip())}))
+        self._item_index += 1
+        self._item_start = None
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Serializa un evento en formato server-sent events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def replay_events(result: Dict[str, Any]) -> List[Event]:
+    """Eventos equivalentes a un diagnóstico ya completo (p. ej. servido desde caché)"""
+    events: List[Event] = []
+    for key, value in result.items():
+        if key in ITEM_EVENTS and isinstance(value, list):
+            events.extend((ITEM_EVENTS[key], {"index": i, "value": item}) for i, item in enumerate(value))
+        else:
+            events.append((key, {"value": value}))
+    return events
+
+
+def validate_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Valida el diagnóstico final contra DiagnosticResponse"""
+    return DiagnosticResponse.model_validate(result).model_dump()
+
+
+async def stream_diagnosis(request: DiagnosticRequest) -> AsyncIterator[str]:
+    """Genera el diagnóstico como eventos SSE a medida que el modelo produce el JSON"""
+    key = diagnosis_cache_key(request)
+    # Los códigos conocidos sin síntomas se responden desde la tabla local de códigos DTC
+    cached = diagnosis.quick_diagnosis(request)
+    if cached is None:
+        cached = diagnosis_cache.memory.get(key)
+    if cached is not MISSING:
+        for event, data in replay_events(cached):
+            yield format_sse(event, data)
+        yield format_sse("result", {"value": validate_result(cached), "cached": True})
+        return
+
+    parser = IncrementalDiagnosisParser()
+    text = ""
+    started = time.monotonic()
+    first_token: Optional[float] = None
+    try:
+        async with diagnosis.diagnosis_slot():
+            async with asyncio.timeout(diagnosis.DIAGNOSE_TIMEOUT):
+                async with diagnosis.client.messages.stream(
+                    model=diagnosis.DIAGNOSIS_MODEL,
+                    system=diagnosis.get_system_prompt(request.language),
+                    max_tokens=diagnosis.DIAGNOSIS_MAX_TOKENS,
+                    messages=[
+                        {"role": "user", "content": diagnosis.build_user_message(request)}
+                    ]
+                ) as stream:
+                    async for chunk in stream.text_stream:
+                        if first_token is None:
+                            first_token = time.monotonic() - started
+                        text += chunk
+                        for event, data in parser.feed(chunk):
+                            yield format_sse(event, data)
+                    final = await stream.get_final_message()
+                    diagnosis.record_usage(getattr(final, "usage", None), first_token)
+
+        result = parser.result if parser.finished else parse_diagnostic_response(text)
+        value = validate_result(result)
+        diagnosis_cache.memory.set(key, value)
+        yield format_sse("result", {"value": value, "cached": False})
+    except asyncio.TimeoutError:
+        yield format_sse("error", {"status": 504, "detail": "El diagnóstico excedió el tiempo máximo de espera"})
+    except (DiagnosisError, ValidationError, json.JSONDecodeError):
+        yield format_sse("error", {"status": 500, "detail": "No se pudo procesar la respuesta del modelo"})
+    except Exception as e:
+        yield format_sse("error", {"status": 500, "detail": f"Error en el diagnóstico: {str(e)}"})
@@ -0,0 +1,186 @@
+import bisect
+import csv
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+# Tabla local de códigos OBD-II genéricos (SAE J2012)
+DEFAULT_DTC_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "data", "dtc_codes.csv"))
+DTC_FILE = os.environ.get("DTC_FILE", DEFAULT_DTC_FILE)
+
+DTC_PATTERN = re.compile(r"^[PBCU][0-3][0-9A-F]{3}$")
+LIST_SEPARATOR = "|"
+
+SYSTEM_LETTERS = {
+    "P": "Tren motriz",
+    "B": "Carrocería",
+    "C": "Chasis",
+    "U": "Red de comunicación",
+}
+
+# Familias de códigos por prefijo; se usa el prefijo más largo que coincida
+DTC_FAMILIES = {
+    "P00": "Medición de combustible y aire y controles auxiliares de emisiones",
+    "P01": "Medición de combustible y aire",
+    "P02": "Medición de combustible y aire (circuito de inyectores)",
+    "P03": "Sistema de encendido o fallas de encendido (misfire)",
+    "P04": "Controles auxiliares de emisiones",
+    "P05": "Control de velocidad del vehículo, control de ralentí y entradas auxiliares",
+    "P06": "Módulo de control y salidas auxiliares",
+    "P07": "Transmisión",
+    "P08": "Transmisión",
+    "P09": "Transmisión",
+    "P0A": "Propulsión híbrida",
+    "P1": "Tren motriz, código específico del fabricante",
+    "P20": "Medición de combustible y aire y controles auxiliares de emisiones",
+    "P21": "Medición de combustible y aire y controles auxiliares de emisiones",
+    "P22": "Medición de combustible y aire y controles auxiliares de emisiones",
+    "P23": "Sistema de encendido o fallas de encendido (misfire)",
+    "P24": "Controles auxiliares de emisiones",
+    "P25": "Entradas auxiliares",
+    "P26": "Módulo de control y salidas auxiliares",
+    "P27": "Transmisión",
+    "P3": "Tren motriz, código específico del fabricante o reservado",
+    "P34": "Desactivación de cilindros",
+    "B0": "Carrocería, código genérico",
+    "B1": "Carrocería, código específico del fabricante",
+    "B2": "Carrocería, código específico del fabricante",
+    "B3": "Carrocería, reservado",
+    "C0": "Chasis, código genérico",
+    "C1": "Chasis, código específico del fabricante",
+    "C2": "Chasis, código específico del fabricante",
+    "C3": "Chasis, reservado",
+    "U0": "Red de comunicación, código genérico",
+    "U1": "Red de comunicación, código específico del fabricante",
+    "U2": "Red de comunicación, código específico del fabricante",
+    "U3": "Red de comunicación, reservado",
+}
+
+
+class DTCInfo(BaseModel):
+    code: str
+    system: str
+    description: str
+    severity: Optional[str] = None
+    possible_causes: List[str] = []
+    recommended_actions: List[str] = []
+    parts: List[str] = []
+    family: Optional[str] = None
+    verified: bool = True  # False cuando solo se conoce la familia del código
+
+
+def normalize_code(code: Optional[str]) -> str:
+    """Normaliza un código DTC: sin espacios ni guiones y en mayúsculas"""
+    return re.sub(r"[\s-]", "", code or "").upper()
+
+
+def is_valid_code(code: str) -> bool:
+    """Indica si el texto tiene el formato de un código OBD-II (p. ej. P0420)"""
+    return bool(DTC_PATTERN.match(code))
+
+
+def code_family(code: str) -> Optional[str]:
+    """Descripción de la familia del código según su prefijo"""
+    for length in (3, 2):
+        family = DTC_FAMILIES.get(code[:length])
+        if family:
+            return family
+    return None
+
+
+def _split(value: Optional[str]) -> List[str]:
+    return [item.strip() for item in (value or "").split(LIST_SEPARATOR) if item.strip()]
+
+
+class DTCDatabase:
+    """Tabla de códigos DTC en memoria, ordenada por código para búsquedas por prefijo y rango"""
+
+    def __init__(self, path: str = DTC_FILE):
+        self.path = path
+        self._codes: List[str] = []
+        self._entries: Dict[str, DTCInfo] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def load(self) -> int:
+        """Carga (o recarga) la tabla desde el CSV; devuelve el número de códigos"""
+        entries: Dict[str, DTCInfo] = {}
+        try:
+            with open(self.path, newline="", encoding="utf-8") as f:
+                for record in csv.DictReader(f):
+                    code = normalize_code(record.get("code"))
+                    if not is_valid_code(code):
+                        continue
+                    entries[code] = DTCInfo(
+                        code=code,
+                        system=record.get("system") or SYSTEM_LETTERS[code[0]],
+                        description=record.get("description") or "",
+                        severity=record.get("severity") or None,
+                        possible_causes=_split(record.get("causes")),
+                        recommended_actions=_split(record.get("actions")),
+                        parts=_split(record.get("parts")),
+                        family=code_family(code),
+                    )
+        except FileNotFoundError:
+            print(f"⚠️ Advertencia: no se encontró la tabla de códigos DTC en {self.path}")
+        with self._lock:
+            self._entries = entries
+            self._codes = sorted(entries)
+            self._loaded = True
+        return len(entries)
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.load()
+
+    def get(self, code: Optional[str]) -> Optional[DTCInfo]:
+        """Entrada verificada para el código exacto, o None si no está en la tabla"""
+        self._ensure_loaded()
+        return self._entries.get(normalize_code(code))
+
+    def lookup(self, code: Optional[str]) -> Optional[DTCInfo]:
+        """Entrada exacta o, si el código no está en la tabla, la descripción de su familia"""
+        code = normalize_code(code)
+        if not is_valid_code(code):
+            return None
+        entry = self.get(code)
+        if entry is not None:
+            return entry
+        family = code_family(code)
+        return DTCInfo(
+            code=code,
+            system=SYSTEM_LETTERS[code[0]],
+            description=family or SYSTEM_LETTERS[code[0]],
+            family=family,
+            verified=False,
+        )
+
+    def prefix(self, prefix: str, limit: int = 50) -> List[DTCInfo]:
+        """Códigos que empiezan con el prefijo, en orden"""
+        self._ensure_loaded()
+        prefix = normalize_code(prefix)
+        start = bisect.bisect_left(self._codes, prefix)
+        result = []
+        for code in self._codes[start:]:
+            if not code.startswith(prefix) or len(result) >= limit:
+                break
+            result.append(self._entries[code])
+        return result
+
+    def range(self, start: str, end: str, limit: int = 50) -> List[DTCInfo]:
+        """Códigos entre start y end (inclusive), en orden"""
+        self._ensure_loaded()
+        lo = bisect.bisect_left(self._codes, normalize_code(start))
+        hi = bisect.bisect_right(self._codes, normalize_code(end))
+        return [self._entries[code] for code in self._codes[lo:hi][:limit]]
+
+    def info(self) -> Dict[str, object]:
+        self._ensure_loaded()
+        return {"path": self.path, "codes": len(self._codes)}
+
+
+# Tabla compartida de códigos DTC, cargada al arrancar la aplicación
+dtc_database = DTCDatabase()
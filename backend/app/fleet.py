@@ -0,0 +1,304 @@
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .smartcar_client import SmartcarVehicleClient
+from .smartcar_tokens import token_manager
+from . import async_db
+from .telemetry import SECTION_SIGNALS, telemetry_cache
+from .telemetry_store import telemetry_store
+
+# Peticiones por segundo hacia Smartcar y ráfaga máxima permitida
+FLEET_RATE_LIMIT = float(os.environ.get("FLEET_RATE_LIMIT", "2"))
+FLEET_BURST = int(os.environ.get("FLEET_BURST", "10"))
+# Intervalo de sondeo por omisión (segundos) y sondeos simultáneos
+FLEET_DEFAULT_INTERVAL = float(os.environ.get("FLEET_DEFAULT_INTERVAL", "300"))
+FLEET_MAX_CONCURRENCY = int(os.environ.get("FLEET_MAX_CONCURRENCY", "8"))
+# Las lecturas sondeadas se sirven a las rutas hasta este múltiplo del intervalo (admite un sondeo retrasado)
+FLEET_STALE_FACTOR = float(os.environ.get("FLEET_STALE_FACTOR", "2"))
+# Espera máxima tras fallos consecutivos de un vehículo
+FLEET_MAX_BACKOFF = float(os.environ.get("FLEET_MAX_BACKOFF", "3600"))
+# Activar el sondeo dentro del proceso de la API
+FLEET_POLLING = os.environ.get("FLEET_POLLING", "false").lower() in ("1", "true", "yes")
+# Vehículos a registrar al arrancar (lista JSON de FleetVehicleRequest)
+FLEET_VEHICLES_FILE = os.environ.get("FLEET_VEHICLES_FILE")
+
+
+class FleetVehicleRequest(BaseModel):
+    vehicle_id: str
+    access_token: Optional[str] = None
+    interval: Optional[float] = None
+    critical: bool = False
+
+class FleetVehicleStatus(BaseModel):
+    vehicle_id: str
+    interval: float
+    critical: bool
+    next_poll_in: float
+    last_polled_at: Optional[str] = None
+    last_error: Optional[str] = None
+    failures: int = 0
+    polls: int = 0
+
+
+class TokenBucket:
+    """Limitador de tasa: `rate` permisos por segundo con ráfagas de hasta `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.waited = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Espera hasta que haya un permiso disponible y lo consume"""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            delay = (1 - self.tokens) / self.rate
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+
+class _Entry:
+    def __init__(self, request: FleetVehicleRequest):
+        self.vehicle_id = request.vehicle_id
+        self.access_token = request.access_token
+        self.interval = request.interval or FLEET_DEFAULT_INTERVAL
+        self.critical = request.critical
+        self.next_due = time.monotonic()  # un vehículo recién registrado se sondea de inmediato
+        self.generation = 0
+        self.last_polled_at: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self.failures = 0
+        self.polls = 0
+
+
+Sink = Callable[[str, Dict[str, Any]], Awaitable[None]]
+TokenResolver = Callable[[str], Awaitable[Optional[str]]]
+
+
+async def cache_sink(vehicle_id: str, sections: Dict[str, Any]) -> None:
+    """Destino por omisión: la caché de telemetría que leen las rutas de Smartcar"""
+    for section, value in sections.items():
+        telemetry_cache.put(vehicle_id, SECTION_SIGNALS[section], value)
+
+
+class FleetScheduler:
+    """Sondeo en segundo plano de los vehículos registrados, con token bucket y prioridades
+
+    Los vehículos vencidos se atienden primero si son críticos y, entre iguales, el más atrasado.
+    Cada sondeo es una sola petición batch de Smartcar; los resultados se entregan a los sinks.
+    """
+
+    def __init__(self, rate: float = FLEET_RATE_LIMIT, burst: int = FLEET_BURST,
+                 concurrency: int = FLEET_MAX_CONCURRENCY, sinks: Optional[List[Sink]] = None,
+                 token_resolver: Optional[TokenResolver] = None):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.sinks: List[Sink] = sinks if sinks is not None else [cache_sink]
+        self.token_resolver = token_resolver
+        self._vehicles: Dict[str, _Entry] = {}
+        self._timeline: List[Tuple[float, int, str, int]] = []   # (next_due, seq, vehicle_id, generation)
+        self._ready: List[Tuple[int, float, int, str, int]] = []  # (rango, next_due, seq, vehicle_id, generation)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._workers: set = set()
+        self.polls = 0
+        self.failures = 0
+
+    # Registro de vehículos
+    def register(self, request: FleetVehicleRequest) -> FleetVehicleStatus:
+        entry = self._vehicles.get(request.vehicle_id)
+        if entry is None:
+            entry = self._vehicles[request.vehicle_id] = _Entry(request)
+        else:
+            entry.access_token = request.access_token or entry.access_token
+            entry.interval = request.interval or entry.interval
+            entry.critical = request.critical
+            entry.next_due = min(entry.next_due, time.monotonic() + entry.interval)
+        telemetry_cache.track(entry.vehicle_id, entry.interval * FLEET_STALE_FACTOR)
+        self._schedule(entry)
+        return self._status(entry)
+
+    def unregister(self, vehicle_id: str) -> bool:
+        telemetry_cache.untrack(vehicle_id)
+        return self._vehicles.pop(vehicle_id, None) is not None
+
+    def vehicles(self) -> List[FleetVehicleStatus]:
+        return [self._status(entry) for entry in self._vehicles.values()]
+
+    def _schedule(self, entry: _Entry) -> None:
+        entry.generation += 1
+        heapq.heappush(self._timeline, (entry.next_due, next(self._seq), entry.vehicle_id, entry.generation))
+        self._wakeup.set()
+
+    def _current(self, vehicle_id: str, generation: int) -> Optional[_Entry]:
+        entry = self._vehicles.get(vehicle_id)
+        return entry if entry is not None and entry.generation == generation else None
+
+    def next_ready(self) -> Optional[_Entry]:
+        """Saca el vehículo vencido de mayor prioridad, o None si ninguno está vencido"""
+        now = time.monotonic()
+        while self._timeline and self._timeline[0][0] <= now:
+            due, seq, vehicle_id, generation = heapq.heappop(self._timeline)
+            entry = self._current(vehicle_id, generation)
+            if entry is not None:
+                heapq.heappush(self._ready, (0 if entry.critical else 1, due, seq, vehicle_id, generation))
+        while self._ready:
+            _, _, _, vehicle_id, generation = heapq.heappop(self._ready)
+            entry = self._current(vehicle_id, generation)
+            if entry is not None:
+                return entry
+        return None
+
+    def _next_wait(self) -> Optional[float]:
+        if not self._timeline:
+            return None
+        return max(0.0, self._timeline[0][0] - time.monotonic())
+
+    # Sondeo
+    async def poll(self, entry: _Entry) -> None:
+        """Sondea un vehículo y reprograma el siguiente sondeo (con espera creciente si falla)"""
+        try:
+            token = entry.access_token
+            if token is None and self.token_resolver is not None:
+                token = await self.token_resolver(entry.vehicle_id)
+            if token is None:
+                raise ValueError("No hay token de acceso para el vehículo")
+            status = await SmartcarVehicleClient(token).get_complete_vehicle_status(entry.vehicle_id)
+            sections = {k: v for k, v in status.items() if k in SECTION_SIGNALS and "error" not in v}
+            for sink in self.sinks:
+                await sink(entry.vehicle_id, sections)
+            entry.failures = 0
+            entry.last_error = None
+            entry.next_due = time.monotonic() + entry.interval
+        except Exception as e:
+            entry.failures += 1
+            entry.last_error = str(e)
+            self.failures += 1
+            entry.next_due = time.monotonic() + min(entry.interval * 2 ** entry.failures, FLEET_MAX_BACKOFF)
+            print(f"Error al sondear el vehículo {entry.vehicle_id}: {e}")
+        finally:
+            entry.polls += 1
+            self.polls += 1
+            entry.last_polled_at = datetime.now().isoformat()
+            if entry.vehicle_id in self._vehicles:
+                self._schedule(entry)
+
+    async def run(self) -> None:
+        """Bucle principal: espera al siguiente vencimiento, pide un permiso y lanza el sondeo"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            entry = self.next_ready()
+            if entry is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._next_wait())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await semaphore.acquire()
+            await self.bucket.acquire()
+            worker = asyncio.ensure_future(self.poll(entry))
+            self._workers.add(worker)
+
+            def finished(task: asyncio.Task) -> None:
+                self._workers.discard(task)
+                semaphore.release()
+            worker.add_done_callback(finished)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        for task in [self._task, *self._workers]:
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*(t for t in [self._task, *self._workers] if t is not None), return_exceptions=True)
+        self._task = None
+
+    def _status(self, entry: _Entry) -> FleetVehicleStatus:
+        return FleetVehicleStatus(
+            vehicle_id=entry.vehicle_id,
+            interval=entry.interval,
+            critical=entry.critical,
+            next_poll_in=round(max(0.0, entry.next_due - time.monotonic()), 3),
+            last_polled_at=entry.last_polled_at,
+            last_error=entry.last_error,
+            failures=entry.failures,
+            polls=entry.polls,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "vehicles": len(self._vehicles),
+            "in_flight": len(self._workers),
+            "polls": self.polls,
+            "failures": self.failures,
+            "rate_limit": self.bucket.rate,
+            "burst": self.bucket.capacity,
+            "rate_limited_seconds": round(self.bucket.waited, 3),
+        }
+
+
+def load_vehicles_file(scheduler: FleetScheduler, path: Optional[str] = FLEET_VEHICLES_FILE) -> int:
+    """Registra los vehículos listados en un archivo JSON"""
+    if not path:
+        return 0
+    with open(path, encoding="utf-8") as f:
+        vehicles = [FleetVehicleRequest.model_validate(item) for item in json.load(f)]
+    for vehicle in vehicles:
+        scheduler.register(vehicle)
+    return len(vehicles)
+
+
+# Planificador compartido por la API (se arranca en el lifespan si FLEET_POLLING está activo);
+# los vehículos registrados sin access_token usan el token guardado en el servidor
+fleet_scheduler = FleetScheduler(token_resolver=token_manager.token_for_vehicle)
+
+
+async def main() -> None:
+    """Proceso de sondeo independiente: cd backend && python -m app.fleet"""
+    count = load_vehicles_file(fleet_scheduler)
+    if token_manager.persist:
+        await token_manager.ensure_table()
+    token_manager.start()
+    # En un proceso aparte los resultados solo son útiles si quedan en el historial de PostgreSQL
+    if telemetry_store.enabled:
+        await telemetry_store.ensure_schema()
+        telemetry_store.start()
+        fleet_scheduler.sinks.append(telemetry_store.sink)
+    else:
+        print("⚠️ Advertencia: sin DATABASE_URL los resultados del sondeo solo quedan en memoria")
+    print(f"Sondeando {count} vehículos a {FLEET_RATE_LIMIT} peticiones/s")
+    fleet_scheduler.start()
+    try:
+        await fleet_scheduler._task
+    finally:
+        await fleet_scheduler.stop()
+        await token_manager.stop()
+        await telemetry_store.stop()
+        await async_db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,15 +1,101 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
-import os
+from datetime import datetime, timedelta, timezone
+from contextlib import asynccontextmanager
+import asyncio
 import json
-import anthropic
-from .smartcar_client import smartcar_config, SmartcarVehicleClient
+import os
+import time
+from .smartcar_client import smartcar_config, SmartcarVehicleClient, vehicle_registry
+from .smartcar_http import get_http_stats as get_smartcar_http_stats
+from .telemetry import telemetry_cache, SIGNAL_METHODS
+from .telemetry_store import HISTORY_SIGNALS, RESOLUTIONS, TelemetryHistory, telemetry_store
+from .smartcar_tokens import token_manager
+from .auth import clear_session_cookie, require_admin, session_token, set_session_cookie
+from .fleet import FLEET_POLLING, FleetVehicleRequest, FleetVehicleStatus, fleet_scheduler, load_vehicles_file
+from .webhooks import SMARTCAR_WEBHOOK_TOKEN, parse_event, sign, verify_signature, webhook_pipeline
+from .diagnosis import (
+    DiagnosticRequest,
+    DiagnosticResponse,
+    DiagnosisError,
+    ClientDisconnected,
+    cancel_on_disconnect,
+    get_diagnosis_stats,
+)
+from .diagnosis_cache import diagnosis_cache
+from .shopify import shopify_client
+from .diagnosis_stream import stream_diagnosis
+from .diagnosis_batch import (
+    BatchDiagnosticRequest,
+    BatchDiagnosticResponse,
+    BatchJobStatus,
+    DIAGNOSE_BATCH_JOB_MAX_ITEMS,
+    DIAGNOSE_BATCH_MAX_ITEMS,
+    batch_jobs,
+    diagnose_batch,
+)
+from . import db, async_db
+from .catalog import CATALOG_CACHE_MAX_AGE, FACET_FIELDS, CatalogUnavailable, catalog_index
+from .dtc import dtc_database, is_valid_code, normalize_code
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Abrir el pool asíncrono de conexiones al arrancar; el pool síncrono de db.py
+    # queda disponible para scripts y tareas en hilos y se abre en su primer uso
+    if os.environ.get("DATABASE_URL"):
+        try:
+            await async_db.open_pool()
+            await async_db.ensure_indexes()
+            await diagnosis_cache.ensure_table()
+            await token_manager.ensure_table()
+        except Exception as e:
+            print(f"⚠️ Advertencia: no se pudo abrir el pool de base de datos: {e}")
+        # Historial de telemetría: escrituras por lotes en segundo plano
+        if telemetry_store.enabled:
+            try:
+                await telemetry_store.ensure_schema()
+                telemetry_store.start()
+                fleet_scheduler.sinks.append(telemetry_store.sink)
+                webhook_pipeline.sinks.append(telemetry_store.sink)
+            except Exception as e:
+                telemetry_store.enabled = False
+                print(f"⚠️ Advertencia: no se pudo preparar el historial de telemetría: {e}")
+    # Cargar la tabla local de códigos DTC
+    dtc_database.load()
+    # Construir el índice del catálogo una sola vez por proceso
+    try:
+        await catalog_index.reload_async()
+    except Exception as e:
+        print(f"⚠️ Advertencia: no se pudo construir el índice del catálogo: {e}")
+    # Recargar el índice cuando otro worker o una importación cambie la revisión del catálogo
+    catalog_index.start()
+    # Consumidores de los webhooks de Smartcar
+    webhook_pipeline.start()
+    # Renovación anticipada de los tokens de Smartcar guardados en el servidor
+    token_manager.start()
+    # Sondeo de la flota en segundo plano (o en un proceso aparte: python -m app.fleet)
+    if FLEET_POLLING:
+        try:
+            load_vehicles_file(fleet_scheduler)
+        except Exception as e:
+            print(f"⚠️ Advertencia: no se pudieron cargar los vehículos de la flota: {e}")
+        fleet_scheduler.start()
+    yield
+    await catalog_index.stop()
+    await fleet_scheduler.stop()
+    await webhook_pipeline.stop()
+    await token_manager.stop()
+    await telemetry_store.stop()
+    await shopify_client.close()
+    # Cerrar los pools al apagar
+    await async_db.close_pool()
+    db.close_pool()
 
 # Inicializar FastAPI
-app = FastAPI(title="Autologic API", description="API para diagnóstico automotriz con Claude AI")
+app = FastAPI(title="Autologic API", description="API para diagnóstico automotriz con Claude AI", lifespan=lifespan)
 
 # Configurar CORS para permitir peticiones del frontend
 app.add_middleware(
@@ -20,30 +106,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Modelos Pydantic para validación de datos
-class VehicleInfo(BaseModel):
-    year: int
-    make: str
-    model: str
-    engine: Optional[str] = None
-
-class DiagnosticRequest(BaseModel):
-    vehicle: VehicleInfo
-    symptoms: str
-    code: Optional[str] = None
-    language: Optional[str] = "es"
-
-class DiagnosticResponse(BaseModel):
-    analysis: str
-    recommended_actions: List[str]
-    possible_causes: List[str]
-    severity: str
-    parts: List[Dict[str, Any]]
-
-# Cliente de Anthropic (Claude)
-client = anthropic.Anthropic(
-    api_key=os.environ.get("ANTHROPIC_API_KEY")
-)
+@app.exception_handler(CatalogUnavailable)
+async def catalog_unavailable(request: Request, exc: CatalogUnavailable):
+    """El índice del catálogo se construye en segundo plano: 503 en lugar de bloquear el event loop"""
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "5"})
 
 # Verificar que la clave API esté configurada
 @app.get("/api/status")
@@ -53,122 +119,217 @@ def check_status():
     return {"status": "ok", "message": "API lista para usar"}
 
 # Endpoint para obtener diagnóstico
+async def _diagnose_with_products(request: DiagnosticRequest, include_products: bool) -> Dict[str, Any]:
+    result = await diagnosis_cache.get_or_compute(request)
+    # Productos de la tienda para todas las piezas en una sola consulta a Shopify,
+    # en lugar de una búsqueda del frontend por pieza
+    if include_products and shopify_client.token and result.get("parts"):
+        await shopify_client.attach_products(result["parts"])
+    return result
+
 @app.post("/api/diagnose", response_model=DiagnosticResponse)
-async def get_diagnostic(request: DiagnosticRequest):
+async def get_diagnostic(request: DiagnosticRequest, http_request: Request, include_products: bool = True):
     try:
-        # Construir el prompt para Claude
-        vehicle_info = f"{request.vehicle.year} {request.vehicle.make} {request.vehicle.model}"
-        if request.vehicle.engine:
-            vehicle_info += f" {request.vehicle.engine}"
-        
-        language = "español" if request.language == "es" else "inglés"
-        
-        # Construir el sistema prompt para Claude
-        system_prompt = f"""
-        Eres un mecánico automotriz experto especializado en diagnóstico de vehículos.
-        Tu tarea es analizar los síntomas y/o códigos OBD-II proporcionados por el usuario y ofrecer un diagnóstico detallado.
-        Debes responder únicamente en {language}.
-        
-        Para cada diagnóstico, debes proporcionar:
-        1. Un análisis detallado del problema
-        2. Una lista de posibles causas
-        3. Acciones recomendadas para solucionar el problema
-        4. Nivel de severidad (Bajo, Medio, Alto, Crítico)
-        5. Piezas que podrían necesitar reemplazo
-
-        Tu respuesta debe estar estrictamente estructurada en formato JSON con las siguientes claves:
-        {
-            "analysis": "texto detallado explicando el problema",
-            "possible_causes": ["causa 1", "causa 2", ...],
-            "recommended_actions": ["acción 1", "acción 2", ...],
-            "severity": "nivel de severidad",
-            "parts": [
-                {"name": "nombre de la pieza", "description": "descripción breve", "urgency": "urgencia de reemplazo"}
-            ]
-        }
-        
-        No incluyas información adicional fuera de este formato JSON. Sé preciso y utiliza terminología técnica apropiada.
-        """
-        
-        # Crear el mensaje del usuario
-        user_message = f"Vehículo: {vehicle_info}\n"
-        
-        if request.code:
-            user_message += f"Código de error: {request.code}\n"
-        
-        user_message += f"Síntomas: {request.symptoms}\n"
-        user_message += "\nPor favor, proporciona un diagnóstico detallado."
-        
-        # Llamar a la API de Claude
-        response = client.messages.create(
-            model="claude-3-7-sonnet-20250219",  # Usar el modelo más reciente de Claude
-            system=system_prompt,
-            max_tokens=2000,
-            messages=[
-                {"role": "user", "content": user_message}
-            ]
-        )
-        
-        # Extraer el contenido de la respuesta
-        response_text = response.content[0].text
-        
-        # Parsear el JSON de la respuesta
-        try:
-            diagnostic_data = json.loads(response_text)
-            return diagnostic_data
-        except json.JSONDecodeError:
-            # Si la respuesta no es un JSON válido, intentar extraer la parte JSON
-            import re
-            json_match = re.search(r'{[\s\S]*}', response_text)
-            if json_match:
-                try:
-                    diagnostic_data = json.loads(json_match.group(0))
-                    return diagnostic_data
-                except:
-                    pass
-            
-            # Si todo falla, devolver un error
-            raise HTTPException(status_code=500, detail="No se pudo procesar la respuesta del modelo")
-        
+        # Solicitudes equivalentes se responden desde caché o comparten una sola llamada a Claude;
+        # la espera se cancela si el cliente se desconecta
+        return await cancel_on_disconnect(_diagnose_with_products(request, include_products), http_request)
+    except ClientDisconnected:
+        return Response(status_code=499)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="El diagnóstico excedió el tiempo máximo de espera")
+    except DiagnosisError as e:
+        raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error en el diagnóstico: {str(e)}")
 
+@app.post("/api/diagnose/stream")
+async def stream_diagnostic(request: DiagnosticRequest):
+    """Diagnóstico como server-sent events: cada campo se emite en cuanto el modelo lo completa"""
+    return StreamingResponse(
+        stream_diagnosis(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _check_batch_size(batch: BatchDiagnosticRequest, max_items: int = DIAGNOSE_BATCH_MAX_ITEMS):
+    if not batch.requests:
+        raise HTTPException(status_code=400, detail="El lote no contiene solicitudes")
+    if len(batch.requests) > max_items:
+        raise HTTPException(status_code=413, detail=f"El lote excede el máximo de {max_items} solicitudes")
+
+@app.post("/api/diagnose/batch", response_model=BatchDiagnosticResponse)
+async def get_batch_diagnostic(batch: BatchDiagnosticRequest):
+    """Diagnostica varios vehículos en una sola petición, con resultado o error por elemento"""
+    _check_batch_size(batch)
+    return await diagnose_batch(batch.requests)
+
+@app.post("/api/diagnose/batch/jobs", response_model=BatchJobStatus)
+async def submit_batch_job(batch: BatchDiagnosticRequest):
+    """Envía un lote grande para procesarse de forma diferida; consultar con GET .../jobs/{job_id}"""
+    _check_batch_size(batch, DIAGNOSE_BATCH_JOB_MAX_ITEMS)
+    try:
+        return await batch_jobs.submit(batch.requests)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al enviar el lote: {str(e)}")
+
+@app.get("/api/diagnose/batch/jobs/{job_id}", response_model=BatchJobStatus)
+async def get_batch_job(job_id: str):
+    """Estado de un lote diferido; incluye los resultados cuando terminó"""
+    try:
+        return await batch_jobs.poll(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Lote no encontrado en este worker o ya caducado")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al consultar el lote: {str(e)}")
+
+@app.get("/api/diagnose/stats")
+async def get_diagnostic_stats():
+    """Diagnósticos en curso, límites de concurrencia y aciertos de caché de este worker"""
+    return {**get_diagnosis_stats(), "cache": diagnosis_cache.stats()}
+
+# Rutas para códigos DTC (tabla local, sin llamadas al modelo)
+@app.get("/api/dtc")
+async def search_dtc_codes(prefix: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None, limit: int = 50):
+    """Códigos de la tabla local por prefijo (?prefix=P03) o por rango (?start=P0300&end=P0308)"""
+    limit = max(1, min(limit, 500))
+    if start or end:
+        codes = dtc_database.range(start or "", end or "Z", limit=limit)
+    else:
+        codes = dtc_database.prefix(prefix or "", limit=limit)
+    return {"codes": codes}
+
+@app.get("/api/dtc/{code}")
+async def get_dtc_code(code: str):
+    """Descripción de un código OBD-II; los códigos fuera de la tabla se describen por su familia"""
+    code = normalize_code(code)
+    if not is_valid_code(code):
+        raise HTTPException(status_code=400, detail="Formato de código DTC inválido (ej. P0420)")
+    return dtc_database.lookup(code)
+
 # Rutas para vehículos
-from . import db
+@app.get("/api/db/pool")
+async def get_db_pool_stats():
+    """Estadísticas de los pools de conexiones a la base de datos"""
+    return {"async": async_db.get_pool_stats(), "sync": db.get_pool_stats()}
 
 @app.get("/api/vehicles")
-def get_vehicles(limit: int = 100, offset: int = 0):
-    vehicles = db.get_all_vehicles(limit, offset)
+async def get_vehicles(limit: int = 100, offset: int = 0, cursor: Optional[str] = None):
+    # Con cursor (vacío para la primera página) se pagina por keyset y se devuelve el token siguiente
+    if cursor is not None:
+        try:
+            vehicles, next_cursor = await async_db.get_vehicles_page(limit, cursor or None)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"vehicles": vehicles, "next_cursor": next_cursor}
+    vehicles = await async_db.get_all_vehicles(limit, offset)
     return vehicles
 
-@app.get("/api/vehicles/count")
-def count_vehicles():
-    count = db.count_vehicles()
-    return {"count": count}
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparación débil de If-None-Match (lista separada por comas o "*")"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+def _catalog_not_modified(request: Request, response: Response, from_db: bool = False) -> Optional[Response]:
+    """Pone ETag y Cache-Control según la revisión del catálogo; si el cliente ya tiene esa
+    revisión devuelve un 304 sin cuerpo y sin consultar la base de datos"""
+    headers = {
+        "ETag": catalog_index.etag(from_db),
+        "Cache-Control": f"public, max-age={CATALOG_CACHE_MAX_AGE}, must-revalidate",
+    }
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
 
+@app.get("/api/vehicles/count")
+async def count_vehicles(request: Request, response: Response, exact: bool = True):
+    not_modified = _catalog_not_modified(request, response, from_db=True)
+    if not_modified:
+        return not_modified
+    count = await async_db.count_vehicles(exact)
+    return {"count": count, "exact": exact}
+
+# La cascada año → marca → modelo → motor se responde desde el índice en memoria; las respuestas
+# llevan un ETag con la revisión del catálogo, que cambia con cada importación
 @app.get("/api/vehicles/years")
-def get_vehicle_years():
-    years = db.get_vehicle_years()
+async def get_vehicle_years(request: Request, response: Response):
+    not_modified = _catalog_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    years = catalog_index.years()
     return years
 
 @app.get("/api/vehicles/makes")
-def get_vehicle_makes(year: Optional[int] = None):
-    makes = db.get_vehicle_makes(year)
+async def get_vehicle_makes(request: Request, response: Response, year: Optional[int] = None):
+    not_modified = _catalog_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    makes = catalog_index.makes(year)
     return makes
 
 @app.get("/api/vehicles/models")
-def get_vehicle_models(year: Optional[int] = None, make: Optional[str] = None):
-    models = db.get_vehicle_models(year, make)
+async def get_vehicle_models(request: Request, response: Response, year: Optional[int] = None, make: Optional[str] = None):
+    not_modified = _catalog_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    models = catalog_index.models(year, make)
     return models
 
 @app.get("/api/vehicles/engines")
-def get_vehicle_engines(year: Optional[int] = None, make: Optional[str] = None, model: Optional[str] = None):
-    engines = db.get_vehicle_engines(year, make, model)
+async def get_vehicle_engines(request: Request, response: Response, year: Optional[int] = None,
+                              make: Optional[str] = None, model: Optional[str] = None):
+    not_modified = _catalog_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    engines = catalog_index.engines(year, make, model)
     return engines
 
+@app.get("/api/vehicles/selector")
+async def get_vehicle_selector(request: Request, response: Response, year: Optional[int] = None,
+                               make: Optional[str] = None, model: Optional[str] = None, engine: Optional[str] = None):
+    """Todo el selector en una petición: las listas de la cascada para la selección parcial y el
+    vehículo resuelto (reemplaza years → makes → models → engines → details)"""
+    not_modified = _catalog_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    return catalog_index.selector(year, make, model, engine)
+
+@app.get("/api/vehicles/search")
+async def search_vehicles(q: str, limit: int = 10):
+    """Autocompletado tolerante a errores: año, marca, modelo, versión o nombre en México"""
+    return catalog_index.search(q, max(1, min(limit, 50)))
+
+@app.get("/api/vehicles/facets")
+async def filter_vehicles(request: Request, limit: int = 50, offset: int = 0):
+    """Filtrado por atributos (?fuel_type=Gasolina&drive_type=AWD&drive_type=4WD) con conteos por faceta"""
+    filters = {field: request.query_params.getlist(field) for field in FACET_FIELDS if field in request.query_params}
+    return catalog_index.facets(filters, max(1, min(limit, 500)), max(0, offset))
+
+@app.get("/api/vehicles/catalog")
+async def get_catalog_info():
+    """Versión y revisión del índice del catálogo cargado en este proceso"""
+    return catalog_index.info()
+
+@app.post("/api/vehicles/catalog/reload", dependencies=[Depends(require_admin)])
+async def reload_catalog():
+    """Recarga el índice del catálogo sin reiniciar el servidor; con base de datos también cambia
+    la revisión compartida, así que los demás workers se recargan en su siguiente sondeo"""
+    try:
+        if os.environ.get("DATABASE_URL"):
+            await async_db.bump_catalog_revision()
+        return await catalog_index.reload_async()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al recargar el catálogo: {str(e)}")
+
 @app.get("/api/vehicles/details")
-def get_vehicle_details(year: int, make: str, model: str, engine: Optional[str] = None):
-    vehicle = db.get_vehicle_by_attributes(year, make, model, engine)
+async def get_vehicle_details(request: Request, response: Response, year: int, make: str, model: str,
+                              engine: Optional[str] = None):
+    not_modified = _catalog_not_modified(request, response, from_db=True)
+    if not_modified:
+        return not_modified
+    vehicle = await async_db.get_vehicle_by_attributes(year, make, model, engine)
     if not vehicle:
         raise HTTPException(status_code=404, detail="Vehículo no encontrado")
     return vehicle
@@ -179,6 +340,8 @@ class SmartcarAuthResponse(BaseModel):
     refresh_token: str
     expires_in: int
     expires_at: str
+    # Sesión que da acceso a los tokens guardados en el servidor (también queda en una cookie)
+    session_token: Optional[str] = None
 
 class SmartcarVehicleRequest(BaseModel):
     vehicle_id: str
@@ -209,6 +372,17 @@ def smartcar_status():
     
     return status
 
+@app.get("/api/smartcar/stats")
+async def smartcar_stats():
+    """Reutilización de handles de vehículo, de la sesión HTTP y de la caché de telemetría"""
+    return {
+        "vehicles": vehicle_registry.stats(),
+        "http": get_smartcar_http_stats(),
+        "telemetry": telemetry_cache.stats(),
+        "history": telemetry_store.stats(),
+        "tokens": token_manager.stats(),
+    }
+
 @app.get("/api/smartcar/auth")
 def get_auth_url(state: Optional[str] = None):
     """Generar URL de autorización para SmartCar"""
@@ -219,44 +393,85 @@ def get_auth_url(state: Optional[str] = None):
         raise HTTPException(status_code=500, detail=f"Error al generar URL de autorización: {str(e)}")
 
 @app.get("/api/smartcar/callback")
-async def smartcar_callback(code: str, state: Optional[str] = None):
+async def smartcar_callback(code: str):
     """Callback para el flujo de autorización de SmartCar"""
     try:
         # Intercambiar código por token
-        tokens = smartcar_config.exchange_code(code)
+        tokens = await asyncio.to_thread(smartcar_config.exchange_code, code)
         
-        # En una aplicación real, guardaríamos los tokens en la base de datos
-        # asociados con la sesión o usuario actual
+        # Guardar los tokens en el servidor bajo una sesión nueva (cookie HttpOnly); las rutas de
+        # vehículos los resuelven con esa sesión sin que el frontend envíe access_token
+        session, _ = await token_manager.store(tokens)
         
         # Redirigir al frontend con un mensaje de éxito
         frontend_url = os.environ.get("FRONTEND_URL", "http://localhost:3000")
-        return RedirectResponse(url=f"{frontend_url}/connected?success=true")
+        redirect = RedirectResponse(url=f"{frontend_url}/connected?success=true")
+        set_session_cookie(redirect, session)
+        return redirect
     except Exception as e:
         # Redirigir al frontend con un mensaje de error
         frontend_url = os.environ.get("FRONTEND_URL", "http://localhost:3000")
         return RedirectResponse(url=f"{frontend_url}/connected?error={str(e)}")
 
 @app.post("/api/smartcar/exchange", response_model=SmartcarAuthResponse)
-async def exchange_code(code: str):
-    """Intercambiar código de autorización por tokens"""
+async def exchange_code(code: str, response: Response):
+    """Intercambiar código de autorización por tokens (quedan guardados en el servidor bajo una sesión)"""
     try:
-        tokens = smartcar_config.exchange_code(code)
-        return tokens
+        tokens = await asyncio.to_thread(smartcar_config.exchange_code, code)
+        session, _ = await token_manager.store(tokens)
+        set_session_cookie(response, session)
+        return {**tokens, "session_token": session}
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al intercambiar código: {str(e)}")
 
 @app.post("/api/smartcar/refresh", response_model=SmartcarAuthResponse)
 async def refresh_token(refresh_token: str):
-    """Actualizar token de acceso"""
+    """Actualizar token de acceso; peticiones concurrentes con el mismo token comparten la renovación"""
     try:
-        tokens = smartcar_config.refresh_access_token(refresh_token)
+        tokens = await token_manager.refresh_by_token(refresh_token)
         return tokens
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al actualizar token: {str(e)}")
 
+@app.delete("/api/smartcar/session")
+async def logout_smartcar(request: Request, response: Response):
+    """Cerrar la sesión: el servidor olvida los tokens de Smartcar asociados"""
+    session = session_token(request)
+    forgotten = bool(session) and await token_manager.forget(session)
+    clear_session_cookie(response)
+    return {"logged_out": forgotten}
+
+async def _resolve_token(request: Request, access_token: Optional[str], vehicle_id: Optional[str] = None) -> str:
+    """Token explícito del cliente o, si no viene, el guardado en el servidor para su sesión;
+    sin ninguna credencial responde 401 y con un vehículo ajeno al token o a la sesión 403"""
+    if access_token:
+        if vehicle_id is not None:
+            # La caché de telemetría es compartida: antes de servirla se verifica que el token
+            # (aunque sea válido) autorice este vehículo
+            try:
+                await token_manager.authorize(access_token, vehicle_id)
+            except PermissionError as e:
+                raise HTTPException(status_code=403, detail=str(e))
+            except Exception as e:
+                raise HTTPException(status_code=401, detail=f"access_token de Smartcar inválido: {getattr(e, 'detail', e)}")
+        return access_token
+    session = session_token(request)
+    if not session:
+        raise HTTPException(status_code=401, detail="Se requiere access_token o una sesión de Smartcar")
+    try:
+        token = await token_manager.get_access_token(session, vehicle_id)
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=f"No se pudo renovar el token de Smartcar: {str(e)}")
+    if not token:
+        raise HTTPException(status_code=401, detail="Sesión de Smartcar inválida o cerrada; conecte el vehículo de nuevo")
+    return token
+
 @app.get("/api/smartcar/vehicles")
-async def get_vehicles(access_token: str):
+async def get_vehicles(request: Request, access_token: Optional[str] = None):
     """Obtener lista de vehículos conectados"""
+    access_token = await _resolve_token(request, access_token)
     try:
         client = SmartcarVehicleClient(access_token)
         vehicles = await client.get_vehicles()
@@ -264,89 +479,128 @@ async def get_vehicles(access_token: str):
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener vehículos: {str(e)}")
 
+async def _get_signal(response: Response, vehicle_id: str, access_token: str, signal: str,
+                      force_refresh: bool, max_age: Optional[float]):
+    """Lee una señal a través de la caché de telemetría e informa su antigüedad en las cabeceras"""
+    client = SmartcarVehicleClient(access_token)
+    value, age, cached = await telemetry_cache.get(client, vehicle_id, signal, force_refresh=force_refresh, max_age=max_age)
+    if not cached:
+        telemetry_store.record(vehicle_id, signal, value)
+    response.headers["Age"] = str(int(age))
+    response.headers["X-Cache"] = "HIT" if cached else "MISS"
+    return value
+
 @app.get("/api/smartcar/vehicles/{vehicle_id}/info")
-async def get_vehicle_info(vehicle_id: str, access_token: str):
+async def get_vehicle_info(vehicle_id: str, request: Request, response: Response, access_token: Optional[str] = None,
+                           force_refresh: bool = False, max_age: Optional[float] = None):
     """Obtener información básica del vehículo"""
+    access_token = await _resolve_token(request, access_token, vehicle_id)
     try:
-        client = SmartcarVehicleClient(access_token)
-        info = await client.get_vehicle_info(vehicle_id)
-        return info
+        return await _get_signal(response, vehicle_id, access_token, "info", force_refresh, max_age)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener información del vehículo: {str(e)}")
 
 @app.get("/api/smartcar/vehicles/{vehicle_id}/odometer")
-async def get_vehicle_odometer(vehicle_id: str, access_token: str):
+async def get_vehicle_odometer(vehicle_id: str, request: Request, response: Response, access_token: Optional[str] = None,
+                           force_refresh: bool = False, max_age: Optional[float] = None):
     """Obtener lectura del odómetro"""
+    access_token = await _resolve_token(request, access_token, vehicle_id)
     try:
-        client = SmartcarVehicleClient(access_token)
-        odometer = await client.get_odometer(vehicle_id)
-        return odometer
+        return await _get_signal(response, vehicle_id, access_token, "odometer", force_refresh, max_age)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener odómetro: {str(e)}")
 
 @app.get("/api/smartcar/vehicles/{vehicle_id}/location")
-async def get_vehicle_location(vehicle_id: str, access_token: str):
+async def get_vehicle_location(vehicle_id: str, request: Request, response: Response, access_token: Optional[str] = None,
+                           force_refresh: bool = False, max_age: Optional[float] = None):
     """Obtener ubicación del vehículo"""
+    access_token = await _resolve_token(request, access_token, vehicle_id)
     try:
-        client = SmartcarVehicleClient(access_token)
-        location = await client.get_location(vehicle_id)
-        return location
+        return await _get_signal(response, vehicle_id, access_token, "location", force_refresh, max_age)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener ubicación: {str(e)}")
 
 @app.get("/api/smartcar/vehicles/{vehicle_id}/fuel")
-async def get_vehicle_fuel(vehicle_id: str, access_token: str):
+async def get_vehicle_fuel(vehicle_id: str, request: Request, response: Response, access_token: Optional[str] = None,
+                           force_refresh: bool = False, max_age: Optional[float] = None):
     """Obtener nivel de combustible"""
+    access_token = await _resolve_token(request, access_token, vehicle_id)
     try:
-        client = SmartcarVehicleClient(access_token)
-        fuel = await client.get_fuel(vehicle_id)
-        return fuel
+        return await _get_signal(response, vehicle_id, access_token, "fuel", force_refresh, max_age)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener nivel de combustible: {str(e)}")
 
 @app.get("/api/smartcar/vehicles/{vehicle_id}/battery")
-async def get_vehicle_battery(vehicle_id: str, access_token: str):
+async def get_vehicle_battery(vehicle_id: str, request: Request, response: Response, access_token: Optional[str] = None,
+                           force_refresh: bool = False, max_age: Optional[float] = None):
     """Obtener estado de la batería"""
+    access_token = await _resolve_token(request, access_token, vehicle_id)
     try:
-        client = SmartcarVehicleClient(access_token)
-        battery = await client.get_battery(vehicle_id)
-        return battery
+        return await _get_signal(response, vehicle_id, access_token, "battery", force_refresh, max_age)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener estado de la batería: {str(e)}")
 
 @app.get("/api/smartcar/vehicles/{vehicle_id}/tires")
-async def get_vehicle_tires(vehicle_id: str, access_token: str):
+async def get_vehicle_tires(vehicle_id: str, request: Request, response: Response, access_token: Optional[str] = None,
+                           force_refresh: bool = False, max_age: Optional[float] = None):
     """Obtener presión de neumáticos"""
+    access_token = await _resolve_token(request, access_token, vehicle_id)
     try:
-        client = SmartcarVehicleClient(access_token)
-        tires = await client.get_tire_pressure(vehicle_id)
-        return tires
+        return await _get_signal(response, vehicle_id, access_token, "tires", force_refresh, max_age)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener presión de neumáticos: {str(e)}")
 
 @app.get("/api/smartcar/vehicles/{vehicle_id}/oil")
-async def get_vehicle_oil(vehicle_id: str, access_token: str):
+async def get_vehicle_oil(vehicle_id: str, request: Request, response: Response, access_token: Optional[str] = None,
+                           force_refresh: bool = False, max_age: Optional[float] = None):
     """Obtener estado del aceite"""
+    access_token = await _resolve_token(request, access_token, vehicle_id)
     try:
-        client = SmartcarVehicleClient(access_token)
-        oil = await client.get_oil_status(vehicle_id)
-        return oil
+        return await _get_signal(response, vehicle_id, access_token, "oil", force_refresh, max_age)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener estado del aceite: {str(e)}")
 
 @app.get("/api/smartcar/vehicles/{vehicle_id}/engine")
-async def get_vehicle_engine(vehicle_id: str, access_token: str):
+async def get_vehicle_engine(vehicle_id: str, request: Request, response: Response, access_token: Optional[str] = None,
+                           force_refresh: bool = False, max_age: Optional[float] = None):
     """Obtener estado del motor"""
+    access_token = await _resolve_token(request, access_token, vehicle_id)
     try:
-        client = SmartcarVehicleClient(access_token)
-        engine = await client.get_engine_status(vehicle_id)
-        return engine
+        return await _get_signal(response, vehicle_id, access_token, "engine", force_refresh, max_age)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener estado del motor: {str(e)}")
 
+@app.get("/api/smartcar/vehicles/{vehicle_id}/history", response_model=TelemetryHistory)
+async def get_vehicle_history(
+    vehicle_id: str,
+    signal: str,
+    request: Request,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    resolution: str = "auto",
+    access_token: Optional[str] = None,
+):
+    """Historial de una señal (fuel, odometer, ...) en un rango; resolution = raw, hour, day o auto"""
+    # Mismo acceso que las lecturas en vivo: token o sesión que autorice el vehículo
+    await _resolve_token(request, access_token, vehicle_id)
+    if signal not in HISTORY_SIGNALS:
+        raise HTTPException(status_code=400, detail=f"Señal sin historial. Opciones: {', '.join(HISTORY_SIGNALS)}")
+    if resolution != "auto" and resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Resolución inválida. Opciones: auto, {', '.join(RESOLUTIONS)}")
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=1)
+    start, end = (d if d.tzinfo else d.replace(tzinfo=timezone.utc) for d in (start, end))
+    if start >= end:
+        raise HTTPException(status_code=400, detail="El inicio del rango debe ser anterior al final")
+    try:
+        return await telemetry_store.history(vehicle_id, signal, start, end, resolution)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al consultar el historial: {str(e)}")
+
 @app.get("/api/smartcar/vehicles/{vehicle_id}/all")
-async def get_all_vehicle_data(vehicle_id: str, access_token: str):
+async def get_all_vehicle_data(vehicle_id: str, request: Request, access_token: Optional[str] = None):
     """Obtener todos los datos disponibles del vehículo"""
+    access_token = await _resolve_token(request, access_token, vehicle_id)
     try:
         client = SmartcarVehicleClient(access_token)
         data = await client.get_complete_vehicle_status(vehicle_id)
@@ -354,6 +608,72 @@ async def get_all_vehicle_data(vehicle_id: str, access_token: str):
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error al obtener datos del vehículo: {str(e)}")
 
+# Rutas para la flota (sondeo en segundo plano): solo para servicios con ADMIN_API_KEY
+@app.post("/api/fleet/vehicles", response_model=FleetVehicleStatus, dependencies=[Depends(require_admin)])
+async def register_fleet_vehicle(vehicle: FleetVehicleRequest):
+    """Registrar (o actualizar) un vehículo para sondearlo en segundo plano"""
+    return fleet_scheduler.register(vehicle)
+
+@app.get("/api/fleet/vehicles", response_model=List[FleetVehicleStatus], dependencies=[Depends(require_admin)])
+async def list_fleet_vehicles():
+    """Vehículos registrados y el estado de su sondeo"""
+    return fleet_scheduler.vehicles()
+
+@app.delete("/api/fleet/vehicles/{vehicle_id}", dependencies=[Depends(require_admin)])
+async def unregister_fleet_vehicle(vehicle_id: str):
+    """Dejar de sondear un vehículo"""
+    if not fleet_scheduler.unregister(vehicle_id):
+        raise HTTPException(status_code=404, detail="Vehículo no registrado en la flota")
+    return {"vehicle_id": vehicle_id, "removed": True}
+
+@app.get("/api/fleet/vehicles/{vehicle_id}/telemetry", dependencies=[Depends(require_admin)])
+async def get_fleet_telemetry(vehicle_id: str):
+    """Última lectura conocida de cada señal, sin consultar Smartcar"""
+    now = time.monotonic()
+    signals = {}
+    for signal in SIGNAL_METHODS:
+        entry = telemetry_cache.peek(vehicle_id, signal)
+        if entry is not None:
+            stored_at, value = entry
+            signals[signal] = {"value": value, "age": round(now - stored_at, 3)}
+    return {"vehicle_id": vehicle_id, "signals": signals}
+
+@app.get("/api/fleet/stats", dependencies=[Depends(require_admin)])
+async def get_fleet_stats():
+    """Estado del planificador de sondeo de la flota"""
+    return fleet_scheduler.stats()
+
+# Webhooks de Smartcar: Smartcar envía la telemetría en lugar de sondear cada vehículo
+@app.post("/api/smartcar/webhooks")
+async def smartcar_webhook(request: Request):
+    """Receptor de webhooks: verifica la firma, encola las lecturas y responde de inmediato"""
+    if not SMARTCAR_WEBHOOK_TOKEN:
+        raise HTTPException(status_code=503, detail="Los webhooks de Smartcar no están configurados")
+    body = await request.body()
+    if not verify_signature(SMARTCAR_WEBHOOK_TOKEN, body, request.headers.get("SC-Signature")):
+        raise HTTPException(status_code=401, detail="Firma del webhook inválida")
+    try:
+        event = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="El cuerpo del webhook no es JSON válido")
+    # Verificación del endpoint al dar de alta el webhook en Smartcar
+    if event.get("eventName") == "verify":
+        challenge = (event.get("payload") or {}).get("challenge", "")
+        return {"challenge": sign(SMARTCAR_WEBHOOK_TOKEN, challenge.encode())}
+    readings = parse_event(event)
+    try:
+        accepted = webhook_pipeline.submit(readings)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not accepted:
+        raise HTTPException(status_code=503, detail="Cola de webhooks llena; reintente más tarde")
+    return {"accepted": len(readings)}
+
+@app.get("/api/smartcar/webhooks/stats")
+async def smartcar_webhook_stats():
+    """Estado de la cola y de los consumidores de webhooks"""
+    return webhook_pipeline.stats()
+
 # Para desarrollo local
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,228 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    """No se obtuvo una conexión libre del pool dentro del tiempo de espera"""
+
+
+class PoolClosed(Exception):
+    """Se intentó usar un pool que ya fue cerrado"""
+
+
+class ConnectionPool:
+    """Pool acotado de conexiones PostgreSQL con préstamo/devolución y chequeo de salud"""
+
+    def __init__(
+        self,
+        dsn: Optional[str],
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 30.0,
+        max_idle: float = 60.0,
+        connect: Callable[..., Any] = psycopg2.connect,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Tamaño de pool inválido: se requiere 0 <= min_size <= max_size y max_size >= 1")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        # Conexiones ociosas por más de este tiempo se verifican antes de prestarse
+        self.max_idle = max_idle
+        self._connect = connect
+
+        self._cond = threading.Condition()
+        self._idle: List[tuple] = []  # (conexión, momento en que quedó libre)
+        self._in_use = 0
+        self._opened = False
+        self._closed = False
+
+        # Estadísticas
+        self._borrowed = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+
+    # Ciclo de vida
+    def open(self) -> None:
+        """Abre el pool y crea las conexiones mínimas"""
+        with self._cond:
+            if self._opened:
+                return
+            self._closed = False
+            self._opened = True
+            for _ in range(self.min_size):
+                self._idle.append((self._connect(self.dsn), time.monotonic()))
+
+    def close(self) -> None:
+        """Cierra todas las conexiones ociosas; las prestadas se cierran al devolverse"""
+        with self._cond:
+            self._closed = True
+            self._opened = False
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    @property
+    def opened(self) -> bool:
+        return self._opened
+
+    # Préstamo y devolución
+    def getconn(self, timeout: Optional[float] = None) -> Any:
+        """Presta una conexión sana del pool, esperando si está agotado"""
+        if not self._opened:
+            if self._closed:
+                raise PoolClosed("El pool de conexiones está cerrado")
+            self.open()
+
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolClosed("El pool de conexiones está cerrado")
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use < self.max_size:
+                    conn, released_at = None, None
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"No hay conexiones disponibles tras {timeout:.1f}s (máximo {self.max_size})")
+                waited = True
+                self._cond.wait(remaining)
+
+            if waited:
+                elapsed = time.monotonic() - start
+                self._waits += 1
+                self._wait_time += elapsed
+                self._max_wait = max(self._max_wait, elapsed)
+            self._borrowed += 1
+
+        # Crear o verificar la conexión fuera del candado
+        try:
+            if conn is None:
+                conn = self._connect(self.dsn)
+            elif not self._is_healthy(conn, released_at):
+                self._discard(conn)
+                conn = self._connect(self.dsn)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn: Any, discard: bool = False) -> None:
+        """Devuelve una conexión al pool (o la descarta si está rota)"""
+        if not discard:
+            discard = not self._reset(conn)
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._discarded += 1
+                keep = False
+            elif self._closed or conn.closed:
+                keep = False
+            else:
+                self._idle.append((conn, time.monotonic()))
+                keep = True
+            self._cond.notify()
+        if not keep:
+            self._close_quietly(conn)
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """Context manager que presta una conexión y la devuelve al terminar"""
+        conn = self.getconn(timeout)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, discard=broken)
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas del pool para dimensionarlo frente a los workers de uvicorn"""
+        with self._cond:
+            return {
+                "opened": self._opened,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "borrowed": self._borrowed,
+                "waits": self._waits,
+                "wait_time_total": round(self._wait_time, 6),
+                "wait_time_avg": round(self._wait_time / self._waits, 6) if self._waits else 0.0,
+                "wait_time_max": round(self._max_wait, 6),
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+            }
+
+    # Utilidades internas
+    def _is_healthy(self, conn: Any, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.max_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _reset(self, conn: Any) -> bool:
+        """Deja la conexión sin transacción abierta; devuelve False si está inutilizable"""
+        if conn.closed:
+            return False
+        try:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn: Any) -> None:
+        with self._cond:
+            self._discarded += 1
+        self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn: Any) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def pool_from_env() -> ConnectionPool:
+    """Crea el pool a partir de las variables de entorno DB_POOL_*"""
+    return ConnectionPool(
+        os.environ.get("DATABASE_URL"),
+        min_size=int(os.environ.get("DB_POOL_MIN_SIZE", "1")),
+        max_size=int(os.environ.get("DB_POOL_MAX_SIZE", "10")),
+        timeout=float(os.environ.get("DB_POOL_TIMEOUT", "30")),
+        max_idle=float(os.environ.get("DB_POOL_MAX_IDLE", "60")),
+    )
@@ -0,0 +1,341 @@
+import argparse
+import asyncio
+import bisect
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from .shopify import SHOPIFY_PRODUCTS_URL, ShopifyClient, shopify_client
+from .text import words
+
+DEFAULT_DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "data"))
+# Copia local de los productos de la tienda (un JSON por línea)
+PRODUCT_MIRROR_FILE = os.environ.get("PRODUCT_MIRROR_FILE", os.path.join(DEFAULT_DATA_DIR, "shopify_products.jsonl"))
+# Segundos entre sincronizaciones incrementales (0 = sin sincronización en segundo plano)
+PRODUCT_MIRROR_SYNC_INTERVAL = float(os.environ.get("PRODUCT_MIRROR_SYNC_INTERVAL", "900"))
+# Segundos entre sincronizaciones completas, que descartan los productos eliminados o despublicados
+# (0 = solo incrementales); la primera del proceso siempre es completa
+PRODUCT_MIRROR_FULL_SYNC_INTERVAL = float(os.environ.get("PRODUCT_MIRROR_FULL_SYNC_INTERVAL", "86400"))
+# Productos por página al sincronizar con la Storefront API (máximo de Shopify: 250)
+PRODUCT_MIRROR_PAGE_SIZE = int(os.environ.get("PRODUCT_MIRROR_PAGE_SIZE", "250"))
+
+# Páginas ordenadas por fecha de actualización; `query` filtra las posteriores a la última sincronización
+SYNC_QUERY = """
+query SincronizarProductos($first: Int!, $after: String, $query: String) {
+  products(first: $first, after: $after, query: $query, sortKey: UPDATED_AT) {
+    pageInfo { hasNextPage endCursor }
+    edges {
+      node {
+        id
+        title
+        handle
+        productType
+        vendor
+        tags
+        updatedAt
+        images(first: 1) { edges { node { originalSrc } } }
+        variants(first: 1) { edges { node { price { amount } } } }
+      }
+    }
+  }
+}
+"""
+
+def tokenize(text: str) -> List[str]:
+    """Palabras sin acentos y en singular simple ("balatas" → "balata") para igualar búsquedas"""
+    tokens = []
+    for token in words(text):
+        if len(token) > 3 and token.endswith("s") and not token[-2].isdigit():
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def product_from_node(node: Dict[str, Any]) -> Dict[str, Any]:
+    """Producto de la Storefront API (o de una exportación bulk) al formato de la copia local"""
+    images = (node.get("images") or {}).get("edges") or []
+    variants = (node.get("variants") or {}).get("edges") or []
+    tags = node.get("tags") or []
+    return {
+        "id": node["id"],
+        "title": node.get("title") or "",
+        "handle": node.get("handle") or "",
+        "product_type": node.get("productType") or "",
+        "vendor": node.get("vendor") or "",
+        "tags": tags.split(", ") if isinstance(tags, str) else list(tags),
+        "image": (images[0]["node"].get("originalSrc") or images[0]["node"].get("url") or "") if images else "",
+        "price": variants[0]["node"]["price"]["amount"] if variants else None,
+        "updated_at": node.get("updatedAt"),
+    }
+
+
+def read_bulk_export(lines: Iterable[str]) -> List[Dict[str, Any]]:
+    """Productos de una exportación bulk de Shopify (JSONL): las imágenes y variantes vienen en
+    líneas aparte que apuntan a su producto con __parentId"""
+    nodes: Dict[str, Dict[str, Any]] = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        parent = item.get("__parentId")
+        if parent is None:
+            item.setdefault("images", {"edges": []})
+            item.setdefault("variants", {"edges": []})
+            nodes[item["id"]] = item
+        elif parent in nodes:
+            if "price" in item:
+                price = item["price"]
+                amount = price.get("amount") if isinstance(price, dict) else price
+                nodes[parent]["variants"]["edges"].append({"node": {"price": {"amount": amount}}})
+            elif "originalSrc" in item or "url" in item or "src" in item:
+                src = item.get("originalSrc") or item.get("url") or item.get("src")
+                nodes[parent]["images"]["edges"].append({"node": {"originalSrc": src}})
+    return [product_from_node(node) for node in nodes.values()]
+
+
+def to_producto(product: Dict[str, Any]) -> Dict[str, Any]:
+    """Mismo formato que las búsquedas en vivo de /api/shopify-search"""
+    return {
+        "nombre": product["title"],
+        "precio": product["price"],
+        "imagen": product["image"],
+        "url": f"{SHOPIFY_PRODUCTS_URL}/{product['handle']}",
+    }
+
+
+class ProductSearchIndex:
+    """Índice invertido inmutable: palabra → productos, con vocabulario ordenado para prefijos
+
+    Los productos se guardan ordenados por título, así que la posición sirve de desempate y
+    los resultados se eligen con operaciones de conjuntos sin puntuar cada candidato.
+    """
+
+    def __init__(self, products: List[Dict[str, Any]]):
+        self.products = products
+        postings: Dict[str, set] = {}
+        title_postings: Dict[str, set] = {}
+        for position, product in enumerate(products):
+            title = tokenize(product["title"])
+            for token in title:
+                title_postings.setdefault(token, set()).add(position)
+            text = " ".join([product["product_type"], product["vendor"], *product["tags"]])
+            for token in title + tokenize(text):
+                postings.setdefault(token, set()).add(position)
+        self.vocabulary = sorted(postings)
+        self.postings = {token: frozenset(positions) for token, positions in postings.items()}
+        self.title_postings = {token: frozenset(positions) for token, positions in title_postings.items()}
+
+    def _prefixed(self, term: str) -> frozenset:
+        """Productos con alguna palabra que empieza por term"""
+        start = bisect.bisect_left(self.vocabulary, term)
+        end = bisect.bisect_left(self.vocabulary, term + "\uffff")
+        if end - start == 1:
+            return self.postings[self.vocabulary[start]]
+        return frozenset().union(*(self.postings[t] for t in self.vocabulary[start:end]))
+
+    def search(self, query: str, limit: int = 3) -> List[Dict[str, Any]]:
+        """Productos que contienen todas las palabras de la búsqueda (como palabra o prefijo)
+
+        Primero los que tienen todas las palabras exactas en el título, luego los que las tienen
+        en cualquier campo y al final las coincidencias por prefijo.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        empty = frozenset()
+        tiers = [
+            frozenset.intersection(*(self.title_postings.get(term, empty) for term in terms)),
+            frozenset.intersection(*(self.postings.get(term, empty) for term in terms)),
+            frozenset.intersection(*(self._prefixed(term) for term in terms)),
+        ]
+        found: List[int] = []
+        for tier in tiers:
+            found.extend(heapq.nsmallest(limit - len(found), tier.difference(found)))
+            if len(found) >= limit:
+                break
+        return [self.products[p] for p in found]
+
+
+class ProductMirror:
+    """Copia local de los productos de Shopify con índice de búsqueda de texto
+
+    Se alimenta de una exportación bulk (JSONL) o de la Storefront API por páginas; las
+    sincronizaciones posteriores solo piden los productos con updated_at más reciente y,
+    cada PRODUCT_MIRROR_FULL_SYNC_INTERVAL, una completa reconcilia las bajas.
+    """
+
+    def __init__(self, path: Optional[str] = PRODUCT_MIRROR_FILE, client: ShopifyClient = shopify_client):
+        self.path = path
+        self.client = client
+        self._products: Dict[str, Dict[str, Any]] = {}
+        self._index = ProductSearchIndex([])
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.synced_at: Optional[str] = None
+        self.syncs = 0
+        self.full_syncs = 0
+        self.searches = 0
+        self.local_hits = 0
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._products)
+
+    def apply(self, products: Iterable[Dict[str, Any]], replace: bool = False) -> int:
+        """Incorpora productos nuevos o actualizados y reconstruye el índice; con replace=True
+        también descarta los que ya no vienen (productos eliminados o despublicados)"""
+        products = list(products)
+        with self._lock:
+            changed = 0
+            if replace:
+                current = {product["id"] for product in products}
+                for product_id in [i for i in self._products if i not in current]:
+                    del self._products[product_id]
+                    changed += 1
+            for product in products:
+                if self._products.get(product["id"]) != product:
+                    self._products[product["id"]] = product
+                    changed += 1
+                if product.get("updated_at") and (self.synced_at is None or product["updated_at"] > self.synced_at):
+                    self.synced_at = product["updated_at"]
+            if changed or not self._index.products:
+                self._index = ProductSearchIndex(sorted(self._products.values(), key=lambda p: p["title"]))
+            return changed
+
+    def search(self, query: str, limit: int = 3) -> List[Dict[str, Any]]:
+        self.searches += 1
+        found = [to_producto(product) for product in self._index.search(query, limit)]
+        if found:
+            self.local_hits += 1
+        return found
+
+    # Almacenamiento local
+    def load(self) -> int:
+        """Carga la copia guardada en disco, si existe"""
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path, encoding="utf-8") as f:
+            return self.apply(json.loads(line) for line in f if line.strip())
+
+    def save(self) -> None:
+        """Escribe la copia en un temporal propio y lo publica con os.replace, así que otros
+        workers o sincronizaciones simultáneas nunca dejan un archivo a medias"""
+        if not self.path:
+            return
+        with self._lock:
+            products = list(self._products.values())
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, prefix=".products-",
+                                         suffix=".tmp", delete=False) as f:
+            try:
+                for product in products:
+                    f.write(json.dumps(product, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, self.path)
+
+    # Sincronización
+    def import_bulk(self, path: str) -> int:
+        """Carga una exportación bulk de Shopify (resultado JSONL de bulkOperationRunQuery)"""
+        with open(path, encoding="utf-8") as f:
+            changed = self.apply(read_bulk_export(f))
+        self.save()
+        return changed
+
+    async def sync(self, full: bool = False) -> int:
+        """Pide a la Storefront API los productos actualizados desde la última sincronización"""
+        since = None if full else self.synced_at
+        variables: Dict[str, Any] = {"first": PRODUCT_MIRROR_PAGE_SIZE, "after": None,
+                                     "query": f"updated_at:>'{since}'" if since else None}
+        products: List[Dict[str, Any]] = []
+        while True:
+            data = await self.client.graphql(SYNC_QUERY, variables)
+            page = data.get("products") or {}
+            products.extend(product_from_node(edge["node"]) for edge in page.get("edges", []))
+            info = page.get("pageInfo") or {}
+            if not info.get("hasNextPage"):
+                break
+            variables["after"] = info["endCursor"]
+        # El índice se reconstruye una sola vez con todas las páginas, fuera del event loop
+        changed = await asyncio.to_thread(self.apply, products, full)
+        self.syncs += 1
+        if full:
+            self.full_syncs += 1
+        if changed:
+            await asyncio.to_thread(self.save)
+        return changed
+
+    async def run(self, interval: float = PRODUCT_MIRROR_SYNC_INTERVAL,
+                  full_interval: float = PRODUCT_MIRROR_FULL_SYNC_INTERVAL) -> None:
+        full_synced_at: Optional[float] = None
+        while True:
+            full = full_interval > 0 and (full_synced_at is None or time.monotonic() - full_synced_at >= full_interval)
+            try:
+                await self.sync(full=full)
+                if full:
+                    full_synced_at = time.monotonic()
+            except Exception as e:
+                print(f"Error al sincronizar los productos de Shopify: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self) -> None:
+        if PRODUCT_MIRROR_SYNC_INTERVAL > 0 and self.client.token and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "products": len(self._products),
+            "vocabulary": len(self._index.vocabulary),
+            "synced_at": self.synced_at,
+            "syncs": self.syncs,
+            "full_syncs": self.full_syncs,
+            "searches": self.searches,
+            "local_hits": self.local_hits,
+            "path": self.path,
+        }
+
+
+# Copia local compartida por /api/shopify-search
+product_mirror = ProductMirror()
+
+
+async def _sync_once(full: bool) -> int:
+    try:
+        return await product_mirror.sync(full=full)
+    finally:
+        await product_mirror.client.close()
+
+
+def main() -> None:
+    """Sincroniza la copia local: cd backend && python -m app.product_mirror [--bulk export.jsonl] [--full]"""
+    parser = argparse.ArgumentParser(description="Sincroniza la copia local de productos de Shopify")
+    parser.add_argument("--bulk", help="Exportación bulk de Shopify (JSONL) a importar")
+    parser.add_argument("--full", action="store_true", help="Descargar todos los productos, no solo los actualizados")
+    args = parser.parse_args()
+    started = datetime.now()
+    product_mirror.load()
+    if args.bulk:
+        changed = product_mirror.import_bulk(args.bulk)
+    else:
+        changed = asyncio.run(_sync_once(args.full))
+    seconds = (datetime.now() - started).total_seconds()
+    print(f"{changed} productos nuevos o actualizados en {seconds:.1f}s; {product_mirror.stats()['products']} en total")
+
+
+if __name__ == "__main__":
+    main()
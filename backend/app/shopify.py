@@ -0,0 +1,175 @@
+import os
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from .cache import MISSING, SingleFlight, TTLCache
+
+SHOPIFY_TOKEN = os.getenv("SHOPIFY_TOKEN")
+SHOPIFY_URL = os.getenv("SHOPIFY_URL", "https://autologic.myshopify.com/api/2023-10/graphql.json")
+# Tienda pública donde se abre cada producto
+SHOPIFY_PRODUCTS_URL = os.getenv("SHOPIFY_PRODUCTS_URL", "https://autologic.mx/products")
+# Segundos máximos por petición a la Storefront API y conexiones keep-alive conservadas
+SHOPIFY_TIMEOUT = float(os.getenv("SHOPIFY_TIMEOUT", "10"))
+SHOPIFY_MAX_CONNECTIONS = int(os.getenv("SHOPIFY_MAX_CONNECTIONS", "20"))
+# Vigencia (segundos) y tamaño de la caché de búsquedas
+SHOPIFY_CACHE_TTL = float(os.getenv("SHOPIFY_CACHE_TTL", "600"))
+SHOPIFY_CACHE_SIZE = int(os.getenv("SHOPIFY_CACHE_SIZE", "2048"))
+
+PRODUCT_FIELDS = """
+fragment ProductFields on Product {
+  title
+  handle
+  images(first: 1) { edges { node { originalSrc } } }
+  variants(first: 1) { edges { node { price { amount } } } }
+}
+"""
+
+# La búsqueda viaja como variable GraphQL, nunca interpolada en el texto de la consulta
+SEARCH_QUERY = """
+query BuscarProductos($query: String!, $first: Int!) {
+  products(first: $first, query: $query) { edges { node { ...ProductFields } } }
+}
+""" + PRODUCT_FIELDS
+
+
+def parts_query(count: int) -> str:
+    """Una sola consulta con un alias por pieza (p0, p1, ...), cada búsqueda como variable propia"""
+    params = ", ".join(f"$q{i}: String!" for i in range(count))
+    fields = "\n".join(
+        f"  p{i}: products(first: $first, query: $q{i}) {{ edges {{ node {{ ...ProductFields }} }} }}"
+        for i in range(count)
+    )
+    return f"query BuscarPiezas({params}, $first: Int!) {{\n{fields}\n}}\n" + PRODUCT_FIELDS
+
+
+class ShopifyError(Exception):
+    """Error de la Storefront API (HTTP o errores GraphQL)"""
+
+
+def normalize_query(query: str) -> str:
+    """Clave de caché: minúsculas y espacios colapsados ("Balatas  Delanteras" = "balatas delanteras")"""
+    return " ".join(query.lower().split())
+
+
+def to_producto(node: Dict[str, Any]) -> Dict[str, Any]:
+    images = node.get("images", {}).get("edges", [])
+    variants = node.get("variants", {}).get("edges", [])
+    return {
+        "nombre": node["title"],
+        "precio": variants[0]["node"]["price"]["amount"] if variants else None,
+        "imagen": images[0]["node"]["originalSrc"] if images else "",
+        "url": f"{SHOPIFY_PRODUCTS_URL}/{node['handle']}",
+    }
+
+
+def to_productos(connection: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [to_producto(edge["node"]) for edge in (connection or {}).get("edges", [])]
+
+
+class ShopifyClient:
+    """Cliente de la Storefront API con conexiones compartidas y caché de búsquedas normalizadas"""
+
+    def __init__(self, url: str = SHOPIFY_URL, token: Optional[str] = SHOPIFY_TOKEN,
+                 cache_ttl: float = SHOPIFY_CACHE_TTL, cache_size: int = SHOPIFY_CACHE_SIZE):
+        self.url = url
+        self.token = token
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.flight = SingleFlight()
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Se crea en el primer uso para quedar ligado al event loop del servidor
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=SHOPIFY_TIMEOUT,
+                limits=httpx.Limits(max_connections=SHOPIFY_MAX_CONNECTIONS,
+                                    max_keepalive_connections=SHOPIFY_MAX_CONNECTIONS),
+                headers={"Content-Type": "application/json",
+                         "X-Shopify-Storefront-Access-Token": self.token or ""},
+            )
+        return self._client
+
+    async def graphql(self, query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        """Ejecuta una consulta y devuelve `data`; lanza ShopifyError ante fallos HTTP o de GraphQL"""
+        self.requests += 1
+        try:
+            response = await self.client.post(self.url, json={"query": query, "variables": variables})
+            response.raise_for_status()
+            payload = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            self.errors += 1
+            raise ShopifyError(f"Error al consultar Shopify: {e}") from e
+        if payload.get("errors"):
+            self.errors += 1
+            raise ShopifyError(f"Error de GraphQL en Shopify: {payload['errors']}")
+        return payload.get("data") or {}
+
+    async def search(self, query: str, first: int = 3) -> List[Dict[str, Any]]:
+        """Productos para una búsqueda; las búsquedas repetidas se sirven desde la caché"""
+        key = (normalize_query(query), first)
+        cached = self.cache.get(key)
+        if cached is not MISSING:
+            return cached
+
+        async def load() -> List[Dict[str, Any]]:
+            data = await self.graphql(SEARCH_QUERY, {"query": key[0], "first": first})
+            productos = to_productos(data.get("products"))
+            self.cache.set(key, productos)
+            return productos
+
+        return await self.flight.do(key, load)
+
+    async def search_many(self, queries: List[str], first: int = 3) -> Dict[str, List[Dict[str, Any]]]:
+        """Productos para varias búsquedas en una sola petición; devuelve {búsqueda normalizada: productos}"""
+        results: Dict[str, List[Dict[str, Any]]] = {}
+        pending: List[str] = []
+        for query in queries:
+            key = normalize_query(query)
+            if not key or key in results or key in pending:
+                continue
+            cached = self.cache.get((key, first))
+            if cached is MISSING:
+                pending.append(key)
+            else:
+                results[key] = cached
+        if pending:
+            variables: Dict[str, Any] = {f"q{i}": key for i, key in enumerate(pending)}
+            data = await self.graphql(parts_query(len(pending)), {**variables, "first": first})
+            for i, key in enumerate(pending):
+                results[key] = to_productos(data.get(f"p{i}"))
+                self.cache.set((key, first), results[key])
+        return results
+
+    async def attach_products(self, parts: List[Dict[str, Any]], first: int = 3) -> List[Dict[str, Any]]:
+        """Agrega `products` a cada pieza del diagnóstico; si Shopify falla las piezas quedan igual"""
+        names = [part.get("name") or "" for part in parts]
+        try:
+            found = await self.search_many(names, first)
+        except ShopifyError as e:
+            print(f"Error al buscar las piezas del diagnóstico en Shopify: {e}")
+            return parts
+        for part, name in zip(parts, names):
+            part["products"] = found.get(normalize_query(name), [])
+        return parts
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "configured": bool(self.token),
+            "requests": self.requests,
+            "errors": self.errors,
+            "cache": self.cache.stats(),
+            "singleflight": self.flight.stats(),
+        }
+
+
+# Cliente compartido por las búsquedas de productos
+shopify_client = ShopifyClient()
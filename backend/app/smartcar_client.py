@@ -1,11 +1,22 @@
+import asyncio
 import os
-from typing import Dict, List, Optional, Union, Any
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
 import smartcar
 import json
 from fastapi import HTTPException
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 
+from . import smartcar_http
+
+# Todo el tráfico del SDK pasa por la sesión HTTP keep-alive compartida
+smartcar_http.install()
+
+# Máximo de handles de vehículo conservados entre peticiones
+SMARTCAR_VEHICLE_CACHE_SIZE = int(os.environ.get("SMARTCAR_VEHICLE_CACHE_SIZE", "1024"))
+
 # Modelos para la API de Smartcar
 class VehicleInfo(BaseModel):
     id: str
@@ -131,209 +142,282 @@ class SmartcarConfig:
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al actualizar token: {str(e)}")
 
+def _read(response: Any, key: str, attr: Optional[str] = None) -> Any:
+    """Lee un campo de una respuesta del SDK: dict (camelCase) o namedtuple (snake_case)"""
+    if isinstance(response, dict):
+        return response.get(key)
+    return getattr(response, attr or key, None)
+
+def _timestamp(response: Any) -> str:
+    """Marca de tiempo de la respuesta; el SDK actual la reporta en los metadatos (sc-data-age)"""
+    if isinstance(response, dict) and response.get("timestamp"):
+        return response["timestamp"]
+    meta = getattr(response, "meta", None)
+    return getattr(meta, "data_age", None) or getattr(meta, "fetched_at", None) or datetime.now().isoformat()
+
+# Conversión de las respuestas del SDK a los modelos de la API
+def to_vehicle_info(vehicle_id: str, attributes: Any, vin: Optional[str] = None) -> VehicleInfo:
+    return VehicleInfo(
+        id=vehicle_id,
+        make=_read(attributes, "make"),
+        model=_read(attributes, "model"),
+        year=_read(attributes, "year"),
+        vin=vin
+    )
+
+def to_odometer(response: Any) -> VehicleOdometer:
+    return VehicleOdometer(distance=_read(response, "distance"), timestamp=_timestamp(response))
+
+def to_location(response: Any) -> VehicleLocation:
+    return VehicleLocation(
+        latitude=_read(response, "latitude"),
+        longitude=_read(response, "longitude"),
+        timestamp=_timestamp(response)
+    )
+
+def to_battery(response: Any) -> VehicleBattery:
+    return VehicleBattery(
+        percent_remaining=_read(response, "percentRemaining", "percent_remaining"),
+        range=_read(response, "range"),
+        timestamp=_timestamp(response)
+    )
+
+def to_fuel(response: Any) -> VehicleFuel:
+    return VehicleFuel(
+        percent_remaining=_read(response, "percentRemaining", "percent_remaining"),
+        range=_read(response, "range"),
+        amount_remaining=_read(response, "amountRemaining", "amount_remaining"),
+        timestamp=_timestamp(response)
+    )
+
+def to_tire_pressure(response: Any) -> VehicleTirePressure:
+    return VehicleTirePressure(
+        front_left=_read(response, "frontLeft", "front_left"),
+        front_right=_read(response, "frontRight", "front_right"),
+        back_left=_read(response, "backLeft", "back_left"),
+        back_right=_read(response, "backRight", "back_right"),
+        timestamp=_timestamp(response)
+    )
+
+def to_oil_status(response: Any) -> VehicleOilStatus:
+    return VehicleOilStatus(
+        life_remaining=_read(response, "lifeRemaining", "life_remaining"),
+        timestamp=_timestamp(response)
+    )
+
+def to_engine_status(response: Any) -> VehicleEngineStatus:
+    return VehicleEngineStatus(running=_read(response, "running"), timestamp=_timestamp(response))
+
+# Secciones del estado completo que admite el endpoint batch de Smartcar:
+# clave del resultado → (ruta, atributo del resultado batch del SDK, conversión, método individual)
+STATUS_SECTIONS = {
+    "odometer": ("/odometer", "odometer", to_odometer, "get_odometer"),
+    "location": ("/location", "location", to_location, "get_location"),
+    "battery": ("/battery", "battery", to_battery, "get_battery"),
+    "fuel": ("/fuel", "fuel", to_fuel, "get_fuel"),
+    "tire_pressure": ("/tires/pressure", "tire_pressure", to_tire_pressure, "get_tire_pressure"),
+    "oil_status": ("/engine/oil", "engine_oil", to_oil_status, "get_oil_status"),
+}
+# La información básica ("/" y "/vin") viaja en la misma petición batch
+STATUS_BATCH_PATHS = ["/", "/vin"] + [path for path, _, _, _ in STATUS_SECTIONS.values()]
+
+def _section(build: Callable[[], BaseModel]) -> Dict[str, Any]:
+    """Sección del estado completo: el modelo serializado o el error de esa señal"""
+    try:
+        return build().model_dump()
+    except Exception as e:
+        return {"error": str(e)}
+
+async def _section_async(awaitable: Awaitable[BaseModel]) -> Dict[str, Any]:
+    try:
+        return (await awaitable).model_dump()
+    except Exception as e:
+        return {"error": str(e)}
+
+class VehicleRegistry:
+    """Handles de smartcar.Vehicle reutilizables por (vehículo, token), acotados por LRU"""
+
+    def __init__(self, maxsize: int = SMARTCAR_VEHICLE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._vehicles: "OrderedDict[str, smartcar.Vehicle]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.token_changes = 0
+
+    def get(self, vehicle_id: str, access_token: str) -> smartcar.Vehicle:
+        """Devuelve el handle del vehículo; si el token cambió, el anterior se descarta"""
+        with self._lock:
+            vehicle = self._vehicles.get(vehicle_id)
+            if vehicle is not None and vehicle.access_token == access_token:
+                self._vehicles.move_to_end(vehicle_id)
+                self.hits += 1
+                return vehicle
+            if vehicle is not None:
+                self.token_changes += 1
+            self.misses += 1
+            vehicle = smartcar.Vehicle(vehicle_id, access_token)
+            self._vehicles[vehicle_id] = vehicle
+            self._vehicles.move_to_end(vehicle_id)
+            while len(self._vehicles) > self.maxsize:
+                self._vehicles.popitem(last=False)
+                self.evictions += 1
+            return vehicle
+
+    def discard(self, vehicle_id: str) -> None:
+        with self._lock:
+            self._vehicles.pop(vehicle_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._vehicles.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._vehicles),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "token_changes": self.token_changes,
+        }
+
+
+# Handles de vehículo compartidos por todas las instancias de SmartcarVehicleClient
+vehicle_registry = VehicleRegistry()
+
 # Clase para interactuar con vehículos conectados
 class SmartcarVehicleClient:
+    """Cliente de vehículos conectados; las llamadas bloqueantes del SDK se ejecutan en hilos"""
+
     def __init__(self, access_token: str):
         self.access_token = access_token
-        
+
     async def get_vehicles(self) -> List[str]:
         """Obtiene la lista de IDs de vehículos conectados"""
         try:
-            vehicles = smartcar.get_vehicles(self.access_token)
-            return vehicles["vehicles"]
+            vehicles = await asyncio.to_thread(smartcar.get_vehicles, self.access_token)
+            return _read(vehicles, "vehicles")
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener vehículos: {str(e)}")
     
     async def get_vehicle_info(self, vehicle_id: str) -> VehicleInfo:
         """Obtiene información básica del vehículo"""
         try:
-            vehicle = smartcar.Vehicle(vehicle_id, self.access_token)
-            info = vehicle.info()
-            
-            # Intentar obtener el VIN si está disponible
-            vin = None
-            try:
-                vin_response = vehicle.vin()
-                vin = vin_response["vin"]
-            except:
-                pass
-            
-            return VehicleInfo(
-                id=vehicle_id,
-                make=info["make"],
-                model=info["model"],
-                year=info["year"],
-                vin=vin
+            vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+            info, vin_response = await asyncio.gather(
+                asyncio.to_thread(vehicle.attributes),
+                # El VIN es opcional: no todos los permisos lo incluyen
+                asyncio.to_thread(vehicle.vin),
+                return_exceptions=True,
             )
+            if isinstance(info, BaseException):
+                raise info
+            vin = None if isinstance(vin_response, BaseException) else _read(vin_response, "vin")
+            return to_vehicle_info(vehicle_id, info, vin)
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener información del vehículo: {str(e)}")
     
     async def get_odometer(self, vehicle_id: str) -> VehicleOdometer:
         """Obtiene la lectura del odómetro"""
         try:
-            vehicle = smartcar.Vehicle(vehicle_id, self.access_token)
-            response = vehicle.odometer()
-            return VehicleOdometer(
-                distance=response["distance"],
-                timestamp=response["timestamp"]
-            )
+            vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+            return to_odometer(await asyncio.to_thread(vehicle.odometer))
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener odómetro: {str(e)}")
     
     async def get_location(self, vehicle_id: str) -> VehicleLocation:
         """Obtiene la ubicación actual del vehículo"""
         try:
-            vehicle = smartcar.Vehicle(vehicle_id, self.access_token)
-            response = vehicle.location()
-            return VehicleLocation(
-                latitude=response["latitude"],
-                longitude=response["longitude"],
-                timestamp=response["timestamp"]
-            )
+            vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+            return to_location(await asyncio.to_thread(vehicle.location))
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener ubicación: {str(e)}")
     
     async def get_battery(self, vehicle_id: str) -> VehicleBattery:
         """Obtiene información de la batería para vehículos eléctricos"""
         try:
-            vehicle = smartcar.Vehicle(vehicle_id, self.access_token)
-            response = vehicle.battery()
-            return VehicleBattery(
-                percent_remaining=response["percentRemaining"],
-                range=response.get("range"),
-                timestamp=response["timestamp"]
-            )
+            vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+            return to_battery(await asyncio.to_thread(vehicle.battery))
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener batería: {str(e)}")
     
     async def get_fuel(self, vehicle_id: str) -> VehicleFuel:
         """Obtiene información del combustible"""
         try:
-            vehicle = smartcar.Vehicle(vehicle_id, self.access_token)
-            response = vehicle.fuel()
-            return VehicleFuel(
-                percent_remaining=response["percentRemaining"],
-                range=response.get("range"),
-                amount_remaining=response.get("amountRemaining"),
-                timestamp=response["timestamp"]
-            )
+            vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+            return to_fuel(await asyncio.to_thread(vehicle.fuel))
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener combustible: {str(e)}")
     
     async def get_tire_pressure(self, vehicle_id: str) -> VehicleTirePressure:
         """Obtiene presión de neumáticos"""
         try:
-            vehicle = smartcar.Vehicle(vehicle_id, self.access_token)
-            response = vehicle.tire_pressure()
-            return VehicleTirePressure(
-                front_left=response.get("frontLeft"),
-                front_right=response.get("frontRight"),
-                back_left=response.get("backLeft"),
-                back_right=response.get("backRight"),
-                timestamp=response["timestamp"]
-            )
+            vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+            return to_tire_pressure(await asyncio.to_thread(vehicle.tire_pressure))
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener presión de neumáticos: {str(e)}")
     
     async def get_oil_status(self, vehicle_id: str) -> VehicleOilStatus:
         """Obtiene estado del aceite del motor"""
         try:
-            vehicle = smartcar.Vehicle(vehicle_id, self.access_token)
-            response = vehicle.engine_oil()
-            return VehicleOilStatus(
-                life_remaining=response.get("lifeRemaining"),
-                timestamp=response["timestamp"]
-            )
+            vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+            return to_oil_status(await asyncio.to_thread(vehicle.engine_oil))
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener estado del aceite: {str(e)}")
     
     async def get_engine_status(self, vehicle_id: str) -> VehicleEngineStatus:
         """Obtiene estado del motor (encendido/apagado)"""
         try:
-            vehicle = smartcar.Vehicle(vehicle_id, self.access_token)
-            response = vehicle.engine()
-            return VehicleEngineStatus(
-                running=response["running"],
-                timestamp=response["timestamp"]
-            )
+            vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+            return to_engine_status(await asyncio.to_thread(vehicle.engine))
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener estado del motor: {str(e)}")
     
     async def get_security_status(self, vehicle_id: str) -> Dict[str, Any]:
         """Obtiene estado de seguridad (puertas, ventanas, etc.)"""
         try:
-            vehicle = smartcar.Vehicle(vehicle_id, self.access_token)
-            response = vehicle.security()
+            vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+            response = await asyncio.to_thread(vehicle.security)
             return response
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener estado de seguridad: {str(e)}")
     
     async def get_complete_vehicle_status(self, vehicle_id: str) -> Dict[str, Any]:
-        """Obtiene estado completo del vehículo (combina varias llamadas)"""
+        """Obtiene estado completo del vehículo en una petición batch, junto con el motor en paralelo"""
         try:
-            result = {}
-            
-            # Obtener información básica
-            try:
-                vehicle_info = await self.get_vehicle_info(vehicle_id)
-                result["info"] = vehicle_info.dict()
-            except Exception as e:
-                result["info"] = {"error": str(e)}
-            
-            # Obtener odómetro
-            try:
-                odometer = await self.get_odometer(vehicle_id)
-                result["odometer"] = odometer.dict()
-            except Exception as e:
-                result["odometer"] = {"error": str(e)}
-            
-            # Obtener ubicación
-            try:
-                location = await self.get_location(vehicle_id)
-                result["location"] = location.dict()
-            except Exception as e:
-                result["location"] = {"error": str(e)}
-            
-            # Obtener batería (vehículos eléctricos)
-            try:
-                battery = await self.get_battery(vehicle_id)
-                result["battery"] = battery.dict()
-            except Exception as e:
-                # La batería solo está disponible en vehículos eléctricos
-                result["battery"] = {"error": str(e)}
-            
-            # Obtener combustible
-            try:
-                fuel = await self.get_fuel(vehicle_id)
-                result["fuel"] = fuel.dict()
-            except Exception as e:
-                # El combustible no está disponible en todos los vehículos
-                result["fuel"] = {"error": str(e)}
-            
-            # Obtener presión de neumáticos
-            try:
-                tire_pressure = await self.get_tire_pressure(vehicle_id)
-                result["tire_pressure"] = tire_pressure.dict()
-            except Exception as e:
-                result["tire_pressure"] = {"error": str(e)}
-            
-            # Obtener estado del aceite
-            try:
-                oil_status = await self.get_oil_status(vehicle_id)
-                result["oil_status"] = oil_status.dict()
-            except Exception as e:
-                result["oil_status"] = {"error": str(e)}
-            
-            # Obtener estado del motor
-            try:
-                engine_status = await self.get_engine_status(vehicle_id)
-                result["engine_status"] = engine_status.dict()
-            except Exception as e:
-                result["engine_status"] = {"error": str(e)}
-            
-            return result
+            sections, engine_status = await asyncio.gather(
+                self._get_status_sections(vehicle_id),
+                # El estado del motor no forma parte del endpoint batch
+                _section_async(self.get_engine_status(vehicle_id)),
+            )
+            return {**sections, "engine_status": engine_status}
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error al obtener estado completo: {str(e)}")
 
+    async def _get_status_sections(self, vehicle_id: str) -> Dict[str, Dict[str, Any]]:
+        """Secciones del estado completo en un solo viaje; si el batch falla, una llamada por señal en paralelo"""
+        vehicle = vehicle_registry.get(vehicle_id, self.access_token)
+        try:
+            batch = await asyncio.to_thread(vehicle.batch, STATUS_BATCH_PATHS)
+        except Exception as e:
+            print(f"⚠️ Petición batch de Smartcar fallida, consultando señales en paralelo: {e}")
+            names = ["info", *STATUS_SECTIONS]
+            methods = [self.get_vehicle_info] + [getattr(self, section[3]) for section in STATUS_SECTIONS.values()]
+            results = await asyncio.gather(*(_section_async(method(vehicle_id)) for method in methods))
+            return dict(zip(names, results))
+
+        def vin() -> Optional[str]:
+            try:
+                return _read(batch.vin(), "vin")
+            except Exception:
+                return None
+
+        result = {"info": _section(lambda: to_vehicle_info(vehicle_id, batch.attributes(), vin()))}
+        for name, (_, attribute, convert, _) in STATUS_SECTIONS.items():
+            result[name] = _section(lambda: convert(getattr(batch, attribute)()))
+        return result
+
 # Inicializar cliente de Smartcar
 smartcar_config = SmartcarConfig()
\ No newline at end of file
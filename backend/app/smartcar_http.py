@@ -0,0 +1,63 @@
+import os
+import platform
+import threading
+from typing import Any, Dict
+
+import requests
+import smartcar
+import smartcar.exception as sce
+import smartcar.helpers
+from requests.adapters import HTTPAdapter
+
+# Conexiones keep-alive que se conservan hacia la API de Smartcar
+SMARTCAR_HTTP_POOL_SIZE = int(os.environ.get("SMARTCAR_HTTP_POOL_SIZE", "32"))
+# Segundos máximos por petición (el SDK usa 310: despertar un vehículo puede tardar)
+SMARTCAR_HTTP_TIMEOUT = float(os.environ.get("SMARTCAR_HTTP_TIMEOUT", "310"))
+
+USER_AGENT = (
+    f"Smartcar/{smartcar.__version__}({platform.system()}; "
+    f"{platform.machine()}) Python v{platform.python_version()}"
+)
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=SMARTCAR_HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Sesión compartida por todo el tráfico del SDK: reutiliza conexiones TLS entre peticiones
+session = _build_session()
+_stats = {"requests": 0, "errors": 0}
+_stats_lock = threading.Lock()
+
+
+def requester(method: str, url: str, **kwargs) -> requests.models.Response:
+    """Sustituto de smartcar.helpers.requester que envía la petición por la sesión compartida"""
+    kwargs.setdefault("headers", {})
+    kwargs["headers"]["User-Agent"] = USER_AGENT
+    kwargs.setdefault("timeout", SMARTCAR_HTTP_TIMEOUT)
+    with _stats_lock:
+        _stats["requests"] += 1
+    try:
+        response = session.request(method, url, **kwargs)
+        if response.ok:
+            return response
+        raise sce.exception_factory(response.status_code, response.headers, response.text)
+    except Exception as e:
+        with _stats_lock:
+            _stats["errors"] += 1
+        if isinstance(e, sce.SmartcarException):
+            raise e
+        raise sce.SmartcarException(message="SDK_ERROR") from e
+
+
+def install() -> None:
+    """Hace que el SDK de Smartcar use la sesión compartida (idempotente)"""
+    smartcar.helpers.requester = requester
+
+
+def get_http_stats() -> Dict[str, Any]:
+    return {**_stats, "pool_size": SMARTCAR_HTTP_POOL_SIZE, "timeout": SMARTCAR_HTTP_TIMEOUT}
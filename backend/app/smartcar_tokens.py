@@ -0,0 +1,392 @@
+import asyncio
+import hashlib
+import json
+import os
+import secrets
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from . import async_db
+from .cache import MISSING, SingleFlight, TTLCache
+from .smartcar_client import SmartcarVehicleClient, smartcar_config
+
+# Segundos de anticipación con que se renueva un token antes de expirar
+SMARTCAR_TOKEN_REFRESH_AHEAD = float(os.environ.get("SMARTCAR_TOKEN_REFRESH_AHEAD", "600"))
+# Cada cuánto revisa el proceso en segundo plano los tokens por vencer
+SMARTCAR_TOKEN_CHECK_INTERVAL = float(os.environ.get("SMARTCAR_TOKEN_CHECK_INTERVAL", "60"))
+# Guardar los tokens en PostgreSQL (tabla smartcar_tokens) para compartirlos entre workers
+SMARTCAR_TOKEN_PERSIST = os.environ.get("SMARTCAR_TOKEN_PERSIST", "false").lower() in ("1", "true", "yes")
+# Segundos que se recuerda qué vehículos autoriza un access token enviado por el cliente
+SMARTCAR_TOKEN_ACCESS_TTL = float(os.environ.get("SMARTCAR_TOKEN_ACCESS_TTL", "300"))
+# Renovaciones fallidas seguidas tras las que se descartan los tokens (hay que volver a conectar)
+SMARTCAR_TOKEN_MAX_FAILURES = int(os.environ.get("SMARTCAR_TOKEN_MAX_FAILURES", "5"))
+
+# key es el hash de la sesión emitida al conectar: la sesión en claro nunca se guarda;
+# previous_refresh_token permite responder a quien renueva con el refresh token ya rotado
+SMARTCAR_TOKENS_TABLE = [
+    """
+    CREATE TABLE IF NOT EXISTS smartcar_tokens (
+        key TEXT PRIMARY KEY,
+        access_token TEXT NOT NULL,
+        refresh_token TEXT NOT NULL,
+        previous_refresh_token TEXT,
+        expires_at TIMESTAMP NOT NULL,
+        vehicle_ids JSONB NOT NULL DEFAULT '[]',
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    "ALTER TABLE smartcar_tokens ADD COLUMN IF NOT EXISTS previous_refresh_token TEXT",
+    "CREATE INDEX IF NOT EXISTS smartcar_tokens_refresh_idx ON smartcar_tokens (refresh_token)",
+    "CREATE INDEX IF NOT EXISTS smartcar_tokens_previous_refresh_idx ON smartcar_tokens (previous_refresh_token)",
+]
+TOKEN_COLUMNS = "key, access_token, refresh_token, previous_refresh_token, expires_at, vehicle_ids"
+
+
+def session_key(session: str) -> str:
+    """Clave del registro de tokens para una sesión"""
+    return hashlib.sha256(session.encode()).hexdigest()
+
+
+class TokenRecord(BaseModel):
+    key: str
+    access_token: str
+    refresh_token: str
+    expires_at: datetime
+    vehicle_ids: List[str] = []
+    previous_refresh_token: Optional[str] = None
+
+    def expires_within(self, seconds: float) -> bool:
+        return self.expires_at - datetime.now() <= timedelta(seconds=seconds)
+
+    def tokens(self) -> Dict[str, Any]:
+        """Mismo formato que devuelve smartcar_config.refresh_access_token"""
+        return {
+            "access_token": self.access_token,
+            "refresh_token": self.refresh_token,
+            "expires_in": max(0, int((self.expires_at - datetime.now()).total_seconds())),
+            "expires_at": self.expires_at.isoformat(),
+        }
+
+
+def record_from_row(row: Any) -> TokenRecord:
+    vehicle_ids = row["vehicle_ids"]
+    return TokenRecord(**{**dict(row), "vehicle_ids": json.loads(vehicle_ids) if isinstance(vehicle_ids, str) else vehicle_ids})
+
+
+class TokenManager:
+    """Tokens de Smartcar guardados en el servidor por sesión y por vehículo
+
+    Cada conexión OAuth emite una sesión aleatoria (cookie o Bearer) que es la única forma de
+    usar los tokens guardados desde las rutas, y solo para los vehículos que autorizó. Los
+    tokens se renuevan antes de expirar; cada renovación se hace bajo un lock por clave, de modo
+    que pestañas o peticiones concurrentes nunca renuevan el mismo token dos veces.
+
+    Con persistencia, la tabla smartcar_tokens es la fuente de verdad entre workers: los
+    registros que no están en memoria se leen de ella y cada renovación bloquea la fila
+    (SELECT ... FOR UPDATE) y la relee, así que solo un worker rota el refresh token.
+    """
+
+    def __init__(self, refresh_ahead: float = SMARTCAR_TOKEN_REFRESH_AHEAD, persist: bool = SMARTCAR_TOKEN_PERSIST):
+        self.refresh_ahead = refresh_ahead
+        self.persist = persist
+        self._records: Dict[str, TokenRecord] = {}
+        self._by_vehicle: Dict[str, str] = {}
+        # Locks en uso por clave con su número de usuarios; se borran al quedar libres
+        self._locks: Dict[str, List[Any]] = {}
+        # Renovaciones fallidas seguidas por clave
+        self._failed: Dict[str, int] = {}
+        # Renovaciones recientes por refresh token, para deduplicar /api/smartcar/refresh
+        self._recent_refreshes = TTLCache(maxsize=1024, ttl=120)
+        # Vehículos que autoriza cada access token explícito (por hash del token)
+        self._token_vehicles = TTLCache(maxsize=4096, ttl=SMARTCAR_TOKEN_ACCESS_TTL)
+        self._flight = SingleFlight()
+        self._task: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.deduplicated = 0
+        self.failures = 0
+
+    @asynccontextmanager
+    async def _lock(self, key: str) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    # Alta de tokens
+    async def store(self, tokens: Dict[str, Any]) -> Tuple[str, TokenRecord]:
+        """Guarda los tokens del intercambio OAuth con los vehículos que autorizan y devuelve
+        la sesión nueva que da acceso a ellos"""
+        session = secrets.token_urlsafe(32)
+        key = session_key(session)
+        record = TokenRecord(
+            key=key,
+            access_token=tokens["access_token"],
+            refresh_token=tokens["refresh_token"],
+            expires_at=datetime.fromisoformat(tokens["expires_at"]),
+        )
+        try:
+            record.vehicle_ids = await SmartcarVehicleClient(record.access_token).get_vehicles()
+        except Exception as e:
+            print(f"Error al obtener los vehículos del token {key}: {e}")
+        self._put(record)
+        await self._save(record)
+        return session, record
+
+    def _put(self, record: TokenRecord) -> None:
+        self._records[record.key] = record
+        for vehicle_id in record.vehicle_ids:
+            self._by_vehicle[vehicle_id] = record.key
+
+    def _drop(self, key: str) -> Optional[TokenRecord]:
+        self._failed.pop(key, None)
+        record = self._records.pop(key, None)
+        if record is not None:
+            for vehicle_id in record.vehicle_ids:
+                if self._by_vehicle.get(vehicle_id) == key:
+                    del self._by_vehicle[vehicle_id]
+        return record
+
+    async def forget(self, session: str) -> bool:
+        """Cierra la sesión: olvida sus tokens en memoria y en la base de datos"""
+        key = session_key(session)
+        record = self._drop(key)
+        deleted = await self._delete(key)
+        return record is not None or deleted
+
+    # Resolución de tokens
+    async def get_access_token(self, session: str, vehicle_id: Optional[str] = None) -> Optional[str]:
+        """Token vigente de la sesión, renovado si está por expirar; None si la sesión no existe.
+        Lanza PermissionError si el vehículo no es de los que autorizó la sesión"""
+        key = session_key(session)
+        record = self._records.get(key) or await self._load("key = $1", key)
+        if record is None:
+            return None
+        if vehicle_id is not None and vehicle_id not in record.vehicle_ids:
+            raise PermissionError(f"El vehículo {vehicle_id} no pertenece a esta sesión")
+        return await self._current_token(record)
+
+    async def token_for_vehicle(self, vehicle_id: str) -> Optional[str]:
+        """Token guardado para un vehículo; solo para procesos internos como el sondeo de la flota"""
+        record = (self._records.get(self._by_vehicle.get(vehicle_id, ""))
+                  or await self._load("vehicle_ids ? $1 ORDER BY updated_at DESC LIMIT 1", vehicle_id))
+        if record is None:
+            return None
+        return await self._current_token(record)
+
+    async def authorize(self, access_token: str, vehicle_id: str) -> None:
+        """Comprueba que un access token enviado por el cliente da acceso al vehículo antes de
+        servirle datos de la caché compartida; lanza PermissionError si no es así"""
+        key = hashlib.sha256(access_token.encode()).hexdigest()
+        vehicles = self._token_vehicles.get(key)
+        if vehicles is MISSING:
+            async def load() -> frozenset:
+                ids = frozenset(await SmartcarVehicleClient(access_token).get_vehicles())
+                self._token_vehicles.set(key, ids)
+                return ids
+
+            vehicles = await self._flight.do(key, load)
+        if vehicle_id not in vehicles:
+            raise PermissionError(f"El token no da acceso al vehículo {vehicle_id}")
+
+    async def _current_token(self, record: TokenRecord) -> str:
+        if record.expires_within(self.refresh_ahead):
+            record = await self.refresh(record.key)
+        return record.access_token
+
+    # Renovación
+    async def refresh(self, key: str, force: bool = False) -> TokenRecord:
+        """Renueva el token de la clave; las llamadas concurrentes esperan a la misma renovación"""
+        record, _ = await self._refresh(key, force=force)
+        return record
+
+    async def _refresh(self, key: str, force: bool = False,
+                       rotated: Optional[str] = None) -> Tuple[TokenRecord, Dict[str, Any]]:
+        """Renueva bajo el lock de la clave (y el de la fila si hay persistencia) y devuelve el
+        registro con los tokens vigentes. Con rotated solo se renueva si el registro aún usa ese
+        refresh token; si otra petición ya lo rotó se devuelven los tokens nuevos"""
+        async with self._lock(key):
+            try:
+                if not self.persist:
+                    return await self._rotate(self._records[key], force, rotated)
+                async with async_db.connection() as conn:
+                    async with conn.transaction():
+                        row = await conn.fetchrow(f"SELECT {TOKEN_COLUMNS} FROM smartcar_tokens WHERE key = $1 FOR UPDATE", key)
+                        if row is None:
+                            # Sesión cerrada desde otro worker
+                            self._drop(key)
+                            raise KeyError(key)
+                        record = record_from_row(row)
+                        self._put(record)
+                        return await self._rotate(record, force, rotated, conn)
+            except Exception:
+                failed = self._failed.get(key, 0)
+                if failed >= SMARTCAR_TOKEN_MAX_FAILURES:
+                    # Token revocado o inválido: se descarta y el usuario debe volver a conectar
+                    print(f"Se descartan los tokens {key} tras {failed} renovaciones fallidas")
+                    self._drop(key)
+                    await self._delete(key)
+                raise
+
+    async def _rotate(self, record: TokenRecord, force: bool, rotated: Optional[str],
+                      conn=None) -> Tuple[TokenRecord, Dict[str, Any]]:
+        # Otra corrutina u otro worker pudo renovarlo mientras se esperaba el lock
+        needed = record.refresh_token == rotated if rotated is not None else force or record.expires_within(self.refresh_ahead)
+        if not needed:
+            self.deduplicated += 1
+            return record, record.tokens()
+        try:
+            tokens = await asyncio.to_thread(smartcar_config.refresh_access_token, record.refresh_token)
+        except Exception:
+            self.failures += 1
+            self._failed[record.key] = self._failed.get(record.key, 0) + 1
+            raise
+        self._failed.pop(record.key, None)
+        self.refreshes += 1
+        self._recent_refreshes.set(record.refresh_token, tokens)
+        record = record.model_copy(update={
+            "access_token": tokens["access_token"],
+            "refresh_token": tokens["refresh_token"],
+            "previous_refresh_token": record.refresh_token,
+            "expires_at": datetime.fromisoformat(tokens["expires_at"]),
+        })
+        self._put(record)
+        if conn is not None:
+            await self._upsert(conn, record)
+        return record, tokens
+
+    async def refresh_by_token(self, refresh_token: str) -> Dict[str, Any]:
+        """Renovación pedida por el cliente con su refresh token, deduplicada entre peticiones concurrentes"""
+        async with self._lock(f"refresh:{refresh_token}"):
+            key = next((r.key for r in self._records.values()
+                        if refresh_token in (r.refresh_token, r.previous_refresh_token)), None)
+            if key is None:
+                record = await self._load("refresh_token = $1 OR previous_refresh_token = $1", refresh_token)
+                key = record.key if record is not None else None
+            if key is not None:
+                _, tokens = await self._refresh(key, rotated=refresh_token)
+                return tokens
+            recent = self._recent_refreshes.get(refresh_token)
+            if recent is not MISSING:
+                self.deduplicated += 1
+                return recent
+            tokens = await asyncio.to_thread(smartcar_config.refresh_access_token, refresh_token)
+            self.refreshes += 1
+            self._recent_refreshes.set(refresh_token, tokens)
+            return tokens
+
+    async def refresh_expiring(self) -> int:
+        """Renueva todos los tokens que expiran dentro del margen configurado (con persistencia,
+        también los de las sesiones creadas en otros workers)"""
+        keys = {r.key for r in self._records.values() if r.expires_within(self.refresh_ahead)}
+        if self.persist:
+            try:
+                async with async_db.connection() as conn:
+                    rows = await conn.fetch("SELECT key FROM smartcar_tokens WHERE expires_at <= $1",
+                                            datetime.now() + timedelta(seconds=self.refresh_ahead))
+                keys.update(row["key"] for row in rows)
+            except Exception as e:
+                print(f"Error al consultar los tokens por vencer: {e}")
+        refreshed = 0
+        for key in sorted(keys):
+            try:
+                await self.refresh(key)
+                refreshed += 1
+            except Exception as e:
+                print(f"Error al renovar el token {key}: {e}")
+        return refreshed
+
+    async def run(self, interval: float = SMARTCAR_TOKEN_CHECK_INTERVAL) -> None:
+        while True:
+            await self.refresh_expiring()
+            await asyncio.sleep(interval)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # Persistencia opcional
+    async def ensure_table(self) -> None:
+        """Crea la tabla si la persistencia está habilitada; los registros se leen bajo demanda"""
+        if not self.persist:
+            return
+        async with async_db.connection() as conn:
+            for statement in SMARTCAR_TOKENS_TABLE:
+                await conn.execute(statement)
+
+    async def _load(self, where: str, *args: Any) -> Optional[TokenRecord]:
+        """Lee de la base de datos un registro que no está en memoria (creado en otro worker)"""
+        if not self.persist:
+            return None
+        try:
+            async with async_db.connection() as conn:
+                row = await conn.fetchrow(f"SELECT {TOKEN_COLUMNS} FROM smartcar_tokens WHERE {where}", *args)
+        except Exception as e:
+            print(f"Error al leer los tokens guardados: {e}")
+            return None
+        if row is None:
+            return None
+        record = record_from_row(row)
+        self._put(record)
+        return record
+
+    @staticmethod
+    async def _upsert(conn, record: TokenRecord) -> None:
+        await conn.execute(
+            "INSERT INTO smartcar_tokens (key, access_token, refresh_token, previous_refresh_token, expires_at, vehicle_ids) "
+            "VALUES ($1, $2, $3, $4, $5, $6::jsonb) ON CONFLICT (key) DO UPDATE SET "
+            "access_token = EXCLUDED.access_token, refresh_token = EXCLUDED.refresh_token, "
+            "previous_refresh_token = EXCLUDED.previous_refresh_token, expires_at = EXCLUDED.expires_at, "
+            "vehicle_ids = EXCLUDED.vehicle_ids, updated_at = now()",
+            record.key, record.access_token, record.refresh_token, record.previous_refresh_token,
+            record.expires_at, json.dumps(record.vehicle_ids)
+        )
+
+    async def _save(self, record: TokenRecord) -> None:
+        if not self.persist:
+            return
+        try:
+            async with async_db.connection() as conn:
+                await self._upsert(conn, record)
+        except Exception as e:
+            print(f"Error al guardar el token {record.key}: {e}")
+
+    async def _delete(self, key: str) -> bool:
+        if not self.persist:
+            return False
+        try:
+            async with async_db.connection() as conn:
+                return await conn.fetchval("DELETE FROM smartcar_tokens WHERE key = $1 RETURNING key", key) is not None
+        except Exception as e:
+            print(f"Error al borrar el token {key}: {e}")
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tokens": len(self._records),
+            "vehicles": len(self._by_vehicle),
+            "refreshes": self.refreshes,
+            "deduplicated": self.deduplicated,
+            "failures": self.failures,
+            "locks": len(self._locks),
+            "persist": self.persist,
+        }
+
+
+# Tokens de Smartcar compartidos por las rutas y el planificador de la flota
+token_manager = TokenManager()
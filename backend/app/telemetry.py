@@ -0,0 +1,140 @@
+import math
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from .cache import SingleFlight, TTLCache
+
+# Método de SmartcarVehicleClient que obtiene cada señal
+SIGNAL_METHODS = {
+    "info": "get_vehicle_info",
+    "odometer": "get_odometer",
+    "location": "get_location",
+    "fuel": "get_fuel",
+    "battery": "get_battery",
+    "tires": "get_tire_pressure",
+    "oil": "get_oil_status",
+    "engine": "get_engine_status",
+}
+
+# Sección de get_complete_vehicle_status → señal de la caché
+SECTION_SIGNALS = {
+    "info": "info",
+    "odometer": "odometer",
+    "location": "location",
+    "battery": "battery",
+    "fuel": "fuel",
+    "tire_pressure": "tires",
+    "oil_status": "oil",
+    "engine_status": "engine",
+}
+
+# Vigencia en segundos de cada señal: el odómetro y el aceite cambian despacio, la ubicación no
+DEFAULT_SIGNAL_TTLS = {
+    "info": 3600,
+    "odometer": 300,
+    "location": 10,
+    "fuel": 60,
+    "battery": 60,
+    "tires": 120,
+    "oil": 600,
+    "engine": 15,
+}
+# Vehículos conservados por señal
+TELEMETRY_CACHE_SIZE = int(os.environ.get("TELEMETRY_CACHE_SIZE", "4096"))
+
+
+def signal_ttls() -> Dict[str, float]:
+    """Vigencias por señal; cada una se puede ajustar con TELEMETRY_TTL_<SEÑAL> (p. ej. TELEMETRY_TTL_LOCATION)"""
+    return {
+        signal: float(os.environ.get(f"TELEMETRY_TTL_{signal.upper()}", ttl))
+        for signal, ttl in DEFAULT_SIGNAL_TTLS.items()
+    }
+
+
+class TelemetryCache:
+    """Caché de telemetría por vehículo y señal, con vigencia propia por señal y coalescencia
+
+    Además de la caché con vigencia guarda la última lectura conocida de cada señal, que no
+    expira: para los vehículos que se sondean en segundo plano esa lectura se sirve mientras
+    no supere la ventana de su sondeo, aunque la vigencia de la señal sea más corta.
+    """
+
+    def __init__(self, ttls: Optional[Dict[str, float]] = None, maxsize: int = TELEMETRY_CACHE_SIZE):
+        ttls = ttls or signal_ttls()
+        self.caches = {signal: TTLCache(maxsize=maxsize, ttl=ttl) for signal, ttl in ttls.items()}
+        self.last_known = {signal: TTLCache(maxsize=maxsize, ttl=math.inf) for signal in ttls}
+        self._polled: Dict[str, float] = {}  # vehicle_id → antigüedad máxima servible de lo sondeado
+        self.flight = SingleFlight()
+        self.upstream_calls = 0
+        self.polled_hits = 0
+
+    def track(self, vehicle_id: str, window: float) -> None:
+        """Marca un vehículo como sondeado: sus lecturas sirven hasta `window` segundos"""
+        self._polled[vehicle_id] = window
+
+    def untrack(self, vehicle_id: str) -> None:
+        self._polled.pop(vehicle_id, None)
+
+    async def get(
+        self,
+        client: Any,
+        vehicle_id: str,
+        signal: str,
+        force_refresh: bool = False,
+        max_age: Optional[float] = None,
+    ) -> Tuple[Any, float, bool]:
+        """Devuelve (valor, antigüedad en segundos, si vino de caché) para la señal del vehículo"""
+        cache = self.caches[signal]
+        if not force_refresh:
+            entry = cache.get_entry(vehicle_id, max_age)
+            if entry is None and vehicle_id in self._polled:
+                entry = self._polled_entry(vehicle_id, signal, max_age)
+            if entry is not None:
+                stored_at, value = entry
+                return value, time.monotonic() - stored_at, True
+
+        async def load() -> Any:
+            self.upstream_calls += 1
+            value = await getattr(client, SIGNAL_METHODS[signal])(vehicle_id)
+            self._store(vehicle_id, signal, value)
+            return value
+
+        return await self.flight.do((signal, vehicle_id), load), 0.0, False
+
+    def _polled_entry(self, vehicle_id: str, signal: str, max_age: Optional[float]) -> Optional[Tuple[float, Any]]:
+        window = self._polled[vehicle_id]
+        entry = self.last_known[signal].get_entry(vehicle_id, window if max_age is None else min(window, max_age))
+        if entry is not None:
+            self.polled_hits += 1
+        return entry
+
+    def _store(self, vehicle_id: str, signal: str, value: Any, stored_at: Optional[float] = None) -> None:
+        self.caches[signal].set(vehicle_id, value, stored_at)
+        self.last_known[signal].set(vehicle_id, value, stored_at)
+
+    def put(self, vehicle_id: str, signal: str, value: Any, stored_at: Optional[float] = None) -> None:
+        """Guarda una lectura obtenida por otra vía (sondeo en segundo plano, webhooks)"""
+        self._store(vehicle_id, signal, value, stored_at)
+
+    def peek(self, vehicle_id: str, signal: str) -> Optional[Tuple[float, Any]]:
+        """Última lectura conocida (momento de almacenamiento, valor) sin consultar Smartcar"""
+        return self.last_known[signal].get_entry(vehicle_id)
+
+    def invalidate(self, vehicle_id: str) -> None:
+        for cache in (*self.caches.values(), *self.last_known.values()):
+            cache.delete(vehicle_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "signals": {signal: cache.stats() for signal, cache in self.caches.items()},
+            "singleflight": self.flight.stats(),
+            "upstream_calls": self.upstream_calls,
+            "last_known": sum(len(cache) for cache in self.last_known.values()),
+            "polled_vehicles": len(self._polled),
+            "polled_hits": self.polled_hits,
+        }
+
+
+# Caché compartida por las rutas de telemetría de Smartcar
+telemetry_cache = TelemetryCache()
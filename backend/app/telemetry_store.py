@@ -0,0 +1,358 @@
+import asyncio
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from . import async_db
+from .telemetry import SECTION_SIGNALS
+
+# Historial de telemetría en PostgreSQL (requiere DATABASE_URL)
+TELEMETRY_HISTORY = (
+    os.environ.get("TELEMETRY_HISTORY", "true").lower() in ("1", "true", "yes")
+    and bool(os.environ.get("DATABASE_URL"))
+)
+# Lecturas acumuladas antes de escribir y espera máxima entre escrituras (segundos)
+TELEMETRY_BATCH_SIZE = int(os.environ.get("TELEMETRY_BATCH_SIZE", "500"))
+TELEMETRY_FLUSH_INTERVAL = float(os.environ.get("TELEMETRY_FLUSH_INTERVAL", "1"))
+# Lecturas pendientes máximas si la base de datos no responde (las más antiguas se descartan)
+TELEMETRY_MAX_PENDING = int(os.environ.get("TELEMETRY_MAX_PENDING", "50000"))
+# Escrituras fallidas seguidas que se reintentan antes de descartar las lecturas pendientes
+TELEMETRY_FLUSH_RETRIES = int(os.environ.get("TELEMETRY_FLUSH_RETRIES", "5"))
+# Cada cuánto se recalculan los agregados y se podan las particiones viejas (segundos)
+TELEMETRY_ROLLUP_INTERVAL = float(os.environ.get("TELEMETRY_ROLLUP_INTERVAL", "300"))
+# Días que se conservan las lecturas crudas; los agregados se conservan siempre
+TELEMETRY_RAW_RETENTION_DAYS = int(os.environ.get("TELEMETRY_RAW_RETENTION_DAYS", "90"))
+
+RESOLUTIONS = ("raw", "hour", "day")
+# Señales con historial (la información básica del vehículo no es una serie de tiempo)
+HISTORY_SIGNALS = ("odometer", "location", "fuel", "battery", "tires", "oil", "engine")
+
+# Una fila por métrica numérica de cada lectura, particionada por mes
+TELEMETRY_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS vehicle_telemetry (
+        vehicle_id TEXT NOT NULL,
+        signal TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        recorded_at TIMESTAMPTZ NOT NULL,
+        value DOUBLE PRECISION NOT NULL
+    ) PARTITION BY RANGE (recorded_at)
+    """,
+    "CREATE INDEX IF NOT EXISTS vehicle_telemetry_lookup_idx ON vehicle_telemetry (vehicle_id, signal, recorded_at)",
+    """
+    CREATE TABLE IF NOT EXISTS vehicle_telemetry_rollup (
+        vehicle_id TEXT NOT NULL,
+        signal TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        resolution TEXT NOT NULL,
+        bucket TIMESTAMPTZ NOT NULL,
+        samples INTEGER NOT NULL,
+        avg DOUBLE PRECISION NOT NULL,
+        min DOUBLE PRECISION NOT NULL,
+        max DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (vehicle_id, signal, resolution, bucket, metric)
+    )
+    """,
+]
+
+# Agregado de una hora con lecturas nuevas, recalculado desde todas sus lecturas crudas
+ROLLUP_HOURLY = """
+INSERT INTO vehicle_telemetry_rollup (vehicle_id, signal, metric, resolution, bucket, samples, avg, min, max)
+SELECT vehicle_id, signal, metric, 'hour', date_trunc('hour', recorded_at), count(*), avg(value), min(value), max(value)
+FROM vehicle_telemetry
+WHERE recorded_at >= $1 AND recorded_at < $1 + interval '1 hour'
+GROUP BY vehicle_id, signal, metric, date_trunc('hour', recorded_at)
+ON CONFLICT (vehicle_id, signal, resolution, bucket, metric)
+DO UPDATE SET samples = EXCLUDED.samples, avg = EXCLUDED.avg, min = EXCLUDED.min, max = EXCLUDED.max
+"""
+
+# Agregado de un día a partir de sus agregados por hora
+ROLLUP_DAILY = """
+INSERT INTO vehicle_telemetry_rollup (vehicle_id, signal, metric, resolution, bucket, samples, avg, min, max)
+SELECT vehicle_id, signal, metric, 'day', date_trunc('day', bucket), sum(samples),
+       sum(avg * samples) / sum(samples), min(min), max(max)
+FROM vehicle_telemetry_rollup
+WHERE resolution = 'hour' AND bucket >= $1 AND bucket < $1 + interval '1 day'
+GROUP BY vehicle_id, signal, metric, date_trunc('day', bucket)
+ON CONFLICT (vehicle_id, signal, resolution, bucket, metric)
+DO UPDATE SET samples = EXCLUDED.samples, avg = EXCLUDED.avg, min = EXCLUDED.min, max = EXCLUDED.max
+"""
+
+
+class TelemetryPoint(BaseModel):
+    t: str
+    values: Dict[str, Any]
+
+class TelemetryHistory(BaseModel):
+    vehicle_id: str
+    signal: str
+    resolution: str
+    start: str
+    end: str
+    points: List[TelemetryPoint]
+
+
+def numeric_metrics(value: Any) -> Dict[str, float]:
+    """Métricas numéricas de una lectura (modelo o dict); los booleanos se guardan como 0/1"""
+    data = value.model_dump() if isinstance(value, BaseModel) else dict(value or {})
+    metrics = {}
+    for name, field in data.items():
+        if isinstance(field, bool):
+            metrics[name] = 1.0 if field else 0.0
+        elif isinstance(field, (int, float)):
+            metrics[name] = float(field)
+    return metrics
+
+
+def reading_time(value: Any) -> datetime:
+    """Momento de la lectura según su timestamp, o el actual si no se puede interpretar"""
+    raw = value.get("timestamp") if isinstance(value, dict) else getattr(value, "timestamp", None)
+    try:
+        moment = datetime.fromisoformat(str(raw).replace("Z", "+00:00"))
+        return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return datetime.now(timezone.utc)
+
+
+def month_bounds(moment: datetime) -> Tuple[date, date]:
+    """Primer día del mes de la lectura y del mes siguiente (límites de la partición)"""
+    start = date(moment.year, moment.month, 1)
+    end = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start, end
+
+
+def partition_name(start: date) -> str:
+    return f"vehicle_telemetry_{start:%Y%m}"
+
+
+def choose_resolution(start: datetime, end: datetime) -> str:
+    """Resolución automática: crudo hasta 2 días, por hora hasta 60 días, diaria para rangos mayores"""
+    span = end - start
+    if span <= timedelta(days=2):
+        return "raw"
+    if span <= timedelta(days=60):
+        return "hour"
+    return "day"
+
+
+class TelemetryStore:
+    """Almacén de series de tiempo: inserciones por lotes (COPY), particiones mensuales y agregados"""
+
+    def __init__(self, batch_size: int = TELEMETRY_BATCH_SIZE, flush_interval: float = TELEMETRY_FLUSH_INTERVAL,
+                 enabled: bool = TELEMETRY_HISTORY):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._buffer: List[Tuple[str, str, str, datetime, float]] = []
+        self._partitions: set = set()
+        # Horas (UTC) con lecturas escritas desde el último agregado
+        self._pending_hours: set = set()
+        self._failures = 0
+        self._flush_needed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._last_rollup = 0.0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.retries = 0
+
+    # Escritura
+    def record(self, vehicle_id: str, signal: str, value: Any) -> None:
+        """Encola una lectura; se escribe en el siguiente lote"""
+        if not self.enabled or signal not in HISTORY_SIGNALS:
+            return
+        recorded_at = reading_time(value)
+        for metric, number in numeric_metrics(value).items():
+            self._buffer.append((vehicle_id, signal, metric, recorded_at, number))
+        if len(self._buffer) > TELEMETRY_MAX_PENDING:
+            excess = len(self._buffer) - TELEMETRY_MAX_PENDING
+            del self._buffer[:excess]
+            self.dropped += excess
+        if len(self._buffer) >= self.batch_size:
+            self._flush_needed.set()
+
+    async def sink(self, vehicle_id: str, sections: Dict[str, Any]) -> None:
+        """Destino para el planificador de la flota: guarda cada sección del estado completo"""
+        for section, value in sections.items():
+            self.record(vehicle_id, SECTION_SIGNALS[section], value)
+
+    async def flush(self) -> int:
+        """Escribe las lecturas pendientes en una sola operación COPY
+
+        Si la escritura falla, las lecturas vuelven al búfer para el siguiente intento; tras
+        TELEMETRY_FLUSH_RETRIES fallos seguidos se descartan.
+        """
+        if not self._buffer:
+            return 0
+        rows, self._buffer = self._buffer, []
+        try:
+            async with async_db.connection() as conn:
+                for start in {month_bounds(row[3])[0] for row in rows} - self._partitions:
+                    await self._ensure_partition(conn, start)
+                await conn.copy_records_to_table(
+                    "vehicle_telemetry",
+                    records=rows,
+                    columns=["vehicle_id", "signal", "metric", "recorded_at", "value"],
+                )
+            self.written += len(rows)
+            self.flushes += 1
+            self._failures = 0
+            self._pending_hours.update(row[3].astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+                                       for row in rows)
+            return len(rows)
+        except Exception as e:
+            self._failures += 1
+            print(f"Error al guardar el historial de telemetría: {e}")
+            if self._failures > TELEMETRY_FLUSH_RETRIES:
+                self._failures = 0
+                self.dropped += len(rows)
+                return 0
+            # Las lecturas fallidas van delante de las que llegaron mientras tanto
+            self._buffer = rows + self._buffer
+            if len(self._buffer) > TELEMETRY_MAX_PENDING:
+                excess = len(self._buffer) - TELEMETRY_MAX_PENDING
+                del self._buffer[:excess]
+                self.dropped += excess
+            self.retries += 1
+            return 0
+
+    async def _ensure_partition(self, conn, start: date) -> None:
+        start, end = month_bounds(datetime(start.year, start.month, 1))
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(start)} PARTITION OF vehicle_telemetry "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+        self._partitions.add(start)
+
+    async def ensure_schema(self) -> None:
+        """Crea las tablas, el índice y las particiones del mes actual y el siguiente"""
+        async with async_db.connection() as conn:
+            for statement in TELEMETRY_SCHEMA:
+                await conn.execute(statement)
+            this_month, next_month = month_bounds(datetime.now(timezone.utc))
+            await self._ensure_partition(conn, this_month)
+            await self._ensure_partition(conn, next_month)
+
+    # Mantenimiento
+    async def rollup(self) -> None:
+        """Recalcula los agregados de las horas y días con lecturas nuevas (también las que llegan
+        tarde) y elimina las particiones crudas fuera de retención"""
+        now = datetime.now(timezone.utc)
+        cutoff = month_bounds(now - timedelta(days=TELEMETRY_RAW_RETENTION_DAYS))[0]
+        hours, self._pending_hours = self._pending_hours, set()
+        # Las horas cuyas lecturas crudas ya se podaron conservan su agregado original
+        hours = sorted(hour for hour in hours if hour.date() >= cutoff)
+        days = sorted({hour.replace(hour=0) for hour in hours})
+        try:
+            async with async_db.connection() as conn:
+                if hours:
+                    await conn.executemany(ROLLUP_HOURLY, [(hour,) for hour in hours])
+                    await conn.executemany(ROLLUP_DAILY, [(day,) for day in days])
+                    hours = []
+                await self._drop_expired_partitions(conn, cutoff)
+        finally:
+            # Las horas que no llegaron a agregarse se reintentan en la siguiente pasada
+            self._pending_hours.update(hours)
+        self._last_rollup = time.monotonic()
+
+    async def _drop_expired_partitions(self, conn, cutoff: date) -> None:
+        partitions = await conn.fetch(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'vehicle_telemetry'::regclass"
+        )
+        for row in partitions:
+            name = row["relname"]
+            # Una partición se elimina entera cuando todo su mes quedó fuera de retención
+            if name < partition_name(cutoff):
+                await conn.execute(f"DROP TABLE IF EXISTS {name}")
+                self._partitions.discard(date(int(name[-6:-2]), int(name[-2:]), 1))
+
+    async def run(self) -> None:
+        """Bucle de escritura: vacía el búfer por tamaño o por tiempo y agrega periódicamente"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            await self.flush()
+            if time.monotonic() - self._last_rollup >= TELEMETRY_ROLLUP_INTERVAL:
+                try:
+                    await self.rollup()
+                except Exception as e:
+                    self._last_rollup = time.monotonic()
+                    print(f"Error al agregar el historial de telemetría: {e}")
+
+    def start(self) -> None:
+        if self.enabled and (self._task is None or self._task.done()):
+            self._last_rollup = time.monotonic()
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._pending_hours:
+            try:
+                await self.rollup()
+            except Exception as e:
+                print(f"Error al agregar el historial de telemetría: {e}")
+
+    # Consultas
+    async def history(self, vehicle_id: str, signal: str, start: datetime, end: datetime,
+                      resolution: str = "auto") -> TelemetryHistory:
+        """Serie de una señal en el rango [start, end), cruda o agregada por hora/día"""
+        if resolution == "auto":
+            resolution = choose_resolution(start, end)
+        async with async_db.connection() as conn:
+            if resolution == "raw":
+                rows = await conn.fetch(
+                    "SELECT recorded_at AS t, metric, value FROM vehicle_telemetry "
+                    "WHERE vehicle_id = $1 AND signal = $2 AND recorded_at >= $3 AND recorded_at < $4 "
+                    "ORDER BY recorded_at, metric",
+                    vehicle_id, signal, start, end
+                )
+            else:
+                rows = await conn.fetch(
+                    "SELECT bucket AS t, metric, samples, avg, min, max FROM vehicle_telemetry_rollup "
+                    "WHERE vehicle_id = $1 AND signal = $2 AND resolution = $3 AND bucket >= $4 AND bucket < $5 "
+                    "ORDER BY bucket, metric",
+                    vehicle_id, signal, resolution, start, end
+                )
+
+        points: Dict[datetime, Dict[str, Any]] = {}
+        for row in rows:
+            values = points.setdefault(row["t"], {})
+            if resolution == "raw":
+                values[row["metric"]] = row["value"]
+            else:
+                values[row["metric"]] = {"avg": row["avg"], "min": row["min"], "max": row["max"], "samples": row["samples"]}
+        return TelemetryHistory(
+            vehicle_id=vehicle_id,
+            signal=signal,
+            resolution=resolution,
+            start=start.isoformat(),
+            end=end.isoformat(),
+            points=[TelemetryPoint(t=t.isoformat(), values=values) for t, values in points.items()],
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "running": self._task is not None and not self._task.done(),
+            "pending": len(self._buffer),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "retries": self.retries,
+            "pending_hours": len(self._pending_hours),
+        }
+
+
+# Historial compartido por las rutas de Smartcar y el planificador de la flota
+telemetry_store = TelemetryStore()
@@ -0,0 +1,16 @@
+import re
+import unicodedata
+from typing import List
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def fold(text: str) -> str:
+    """Minúsculas y sin acentos: "Bujías" → "bujias" """
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def words(text: str) -> List[str]:
+    """Palabras alfanuméricas del texto ya sin acentos ("F-150 Raptor" → ["f", "150", "raptor"])"""
+    return _WORD.findall(fold(text))
@@ -0,0 +1,148 @@
+"""Emisor local de webhooks de Smartcar para pruebas de carga
+
+    cd backend && python -m app.webhook_replay --events 20000 --vehicles 5000 --concurrency 100
+
+Firma cada entrega con SMARTCAR_WEBHOOK_TOKEN igual que Smartcar. Sin --file genera eventos
+"schedule" sintéticos; con --file reenvía cuerpos capturados (un JSON por línea).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
+
+from .webhooks import SMARTCAR_WEBHOOK_TOKEN, sign
+
+
+def synthetic_event(vehicle_ids: List[str]) -> Dict[str, Any]:
+    """Evento "schedule" con odómetro, ubicación, batería y llantas de cada vehículo"""
+    now = datetime.now(timezone.utc).isoformat()
+    headers = {"sc-data-age": now, "sc-unit-system": "metric"}
+    vehicles = []
+    for vehicle_id in vehicle_ids:
+        vehicles.append({
+            "vehicleId": vehicle_id,
+            "requestId": str(uuid.uuid4()),
+            "data": [
+                {"path": "/odometer", "code": 200, "headers": headers,
+                 "body": {"distance": round(random.uniform(1000, 200000), 1)}},
+                {"path": "/location", "code": 200, "headers": headers,
+                 "body": {"latitude": round(random.uniform(14.5, 32.7), 5), "longitude": round(random.uniform(-117.1, -86.7), 5)}},
+                {"path": "/battery", "code": 200, "headers": headers,
+                 "body": {"percentRemaining": round(random.random(), 2), "range": round(random.uniform(0, 400), 1)}},
+                {"path": "/tires/pressure", "code": 200, "headers": headers,
+                 "body": {"frontLeft": 230, "frontRight": 231, "backLeft": 225, "backRight": 226}},
+            ],
+        })
+    return {
+        "version": "2.0",
+        "webhookId": "replay",
+        "eventName": "schedule",
+        "mode": "test",
+        "payload": {"vehicles": vehicles},
+    }
+
+
+def synthetic_bodies(events: int, vehicles: int, per_event: int) -> Iterator[bytes]:
+    ids = [f"replay-{i:06d}" for i in range(vehicles)]
+    for n in range(events):
+        start = (n * per_event) % vehicles
+        yield json.dumps(synthetic_event([ids[(start + i) % vehicles] for i in range(per_event)])).encode()
+
+
+def file_bodies(path: str, events: Optional[int]) -> Iterator[bytes]:
+    """Recorre el archivo, repitiéndolo hasta completar `events` entregas si se indica"""
+    sent = 0
+    while True:
+        sent_before = sent
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+                    sent += 1
+                    if events is not None and sent >= events:
+                        return
+        if events is None or sent == sent_before:
+            return
+
+
+async def replay(url: str, token: str, bodies: Iterator[bytes], concurrency: int, rate: float) -> Dict[str, Any]:
+    """Envía las entregas con `concurrency` conexiones y, si rate > 0, a lo sumo `rate` por segundo"""
+    statuses: Dict[int, int] = {}
+    latencies: List[float] = []
+    errors = 0
+    last_error: Optional[str] = None
+    started = time.monotonic()
+    bodies = iter(bodies)
+    sent = 0
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        nonlocal errors, last_error, sent
+        for body in bodies:
+            if rate > 0:
+                delay = started + sent / rate - time.monotonic()
+                sent += 1
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            begin = time.monotonic()
+            try:
+                response = await client.post(url, content=body, headers={
+                    "Content-Type": "application/json",
+                    "SC-Signature": sign(token, body),
+                })
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            except httpx.HTTPError as e:
+                errors += 1
+                last_error = str(e)
+            latencies.append(time.monotonic() - begin)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+
+    elapsed = time.monotonic() - started
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else 0.0
+
+    return {
+        "deliveries": len(latencies),
+        "seconds": round(elapsed, 3),
+        "deliveries_per_second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "statuses": statuses,
+        "errors": errors,
+        "last_error": last_error,
+        "latency_ms": {"p50": percentile(0.5), "p99": percentile(0.99), "max": percentile(1.0)},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Envía webhooks firmados al receptor de Smartcar")
+    parser.add_argument("--url", default="http://localhost:8000/api/smartcar/webhooks")
+    parser.add_argument("--token", default=SMARTCAR_WEBHOOK_TOKEN, help="Application Management Token")
+    parser.add_argument("--events", type=int, default=10000, help="Entregas a enviar")
+    parser.add_argument("--vehicles", type=int, default=1000, help="Vehículos distintos (modo sintético)")
+    parser.add_argument("--per-event", type=int, default=1, help="Vehículos por entrega (modo sintético)")
+    parser.add_argument("--concurrency", type=int, default=50, help="Peticiones simultáneas")
+    parser.add_argument("--rate", type=float, default=0, help="Entregas por segundo (0 = sin límite)")
+    parser.add_argument("--file", help="Cuerpos capturados a reenviar, un JSON por línea")
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("Defina SMARTCAR_WEBHOOK_TOKEN o use --token")
+
+    if args.file:
+        bodies = file_bodies(args.file, args.events)
+    else:
+        bodies = synthetic_bodies(args.events, args.vehicles, args.per_event)
+    result = asyncio.run(replay(args.url, args.token, bodies, args.concurrency, args.rate))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
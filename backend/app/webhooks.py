@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import hmac
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from .fleet import Sink, cache_sink
+from .smartcar_client import STATUS_SECTIONS, _section
+
+# Application Management Token de Smartcar: firma los webhooks (cabecera SC-Signature)
+SMARTCAR_WEBHOOK_TOKEN = os.environ.get("SMARTCAR_WEBHOOK_TOKEN")
+# Lecturas por vehículo en espera; si la cola está llena el webhook responde 503 y Smartcar reintenta
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "10000"))
+# Lecturas que procesa cada consumidor por lote y número de consumidores
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", "200"))
+WEBHOOK_CONSUMERS = int(os.environ.get("WEBHOOK_CONSUMERS", "2"))
+
+# Ruta de la API de Smartcar → sección del estado completo (la misma forma que entrega el sondeo)
+PATH_SECTIONS = {path: (section, convert) for section, (path, _, convert, _) in STATUS_SECTIONS.items()}
+
+Reading = Tuple[str, Dict[str, Any]]  # (vehicle_id, {sección: valor})
+
+
+def sign(token: str, body: bytes) -> str:
+    """Firma HMAC-SHA256 en hexadecimal, como la calcula Smartcar para SC-Signature"""
+    return hmac.new(token.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(token: str, body: bytes, signature: Optional[str]) -> bool:
+    return bool(signature) and hmac.compare_digest(sign(token, body), signature)
+
+
+def parse_event(event: Dict[str, Any]) -> List[Reading]:
+    """Lecturas de un evento "schedule": una entrada por vehículo con las señales válidas"""
+    readings = []
+    for vehicle in (event.get("payload") or {}).get("vehicles") or []:
+        sections = {}
+        for item in vehicle.get("data") or []:
+            target = PATH_SECTIONS.get(item.get("path"))
+            body = item.get("body")
+            if target is None or not isinstance(body, dict) or item.get("code") not in (None, 200):
+                continue
+            section, convert = target
+            data_age = (item.get("headers") or {}).get("sc-data-age")
+            value = _section(lambda: convert({"timestamp": data_age, **body} if data_age else body))
+            if "error" not in value:
+                sections[section] = value
+        if vehicle.get("vehicleId") and sections:
+            readings.append((vehicle["vehicleId"], sections))
+    return readings
+
+
+class WebhookPipeline:
+    """Cola acotada entre el receptor de webhooks y los consumidores que actualizan la telemetría
+
+    El receptor solo verifica, interpreta y encola, así que responde enseguida; los consumidores
+    sacan lotes de la cola y los entregan a los mismos sinks que usa el sondeo de la flota.
+    """
+
+    def __init__(self, maxsize: int = WEBHOOK_QUEUE_SIZE, batch_size: int = WEBHOOK_BATCH_SIZE,
+                 consumers: int = WEBHOOK_CONSUMERS, sinks: Optional[List[Sink]] = None):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.consumers = consumers
+        self.sinks: List[Sink] = sinks if sinks is not None else [cache_sink]
+        self._tasks: List[asyncio.Task] = []
+        self.received = 0
+        self.rejected = 0
+        self.oversized = 0
+        self.processed = 0
+        self.batches = 0
+        self.errors = 0
+
+    def submit(self, readings: List[Reading]) -> bool:
+        """Encola todas las lecturas de una entrega o ninguna si no caben ahora
+
+        Lanza ValueError si la entrega supera el tamaño de la cola: no cabría en ningún reintento.
+        """
+        if self.queue.maxsize and len(readings) > self.queue.maxsize:
+            self.oversized += len(readings)
+            raise ValueError(f"La entrega tiene {len(readings)} lecturas y la cola admite {self.queue.maxsize}")
+        if self.queue.maxsize and self.queue.maxsize - self.queue.qsize() < len(readings):
+            self.rejected += len(readings)
+            return False
+        for reading in readings:
+            self.queue.put_nowait(reading)
+        self.received += len(readings)
+        return True
+
+    async def _next_batch(self) -> List[Reading]:
+        batch = [await self.queue.get()]
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def process(self, batch: List[Reading]) -> None:
+        for vehicle_id, sections in batch:
+            for sink in self.sinks:
+                try:
+                    await sink(vehicle_id, sections)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Error al procesar el webhook del vehículo {vehicle_id}: {e}")
+        self.processed += len(batch)
+        self.batches += 1
+
+    async def consume(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self.process(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def start(self) -> None:
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.consumers:
+            self._tasks.append(asyncio.ensure_future(self.consume()))
+
+    async def drain(self) -> None:
+        """Espera a que se procese todo lo encolado"""
+        await self.queue.join()
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "configured": bool(SMARTCAR_WEBHOOK_TOKEN),
+            "consumers": len([t for t in self._tasks if not t.done()]),
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "received": self.received,
+            "rejected": self.rejected,
+            "oversized": self.oversized,
+            "processed": self.processed,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+
+# Cola compartida por el receptor de webhooks de la API
+webhook_pipeline = WebhookPipeline()
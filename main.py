@@ -1,10 +1,26 @@
-from fastapi import FastAPI, Request
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import requests
-import os
 
-app = FastAPI()
+from backend.app.product_mirror import product_mirror
+from backend.app.shopify import ShopifyError, shopify_client
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Copia local de los productos: se carga del disco y se mantiene al día en segundo plano
+    try:
+        await asyncio.to_thread(product_mirror.load)
+    except Exception as e:
+        print(f"⚠️ Advertencia: no se pudo cargar la copia local de productos: {e}")
+    product_mirror.start()
+    yield
+    await product_mirror.stop()
+    # Cerrar las conexiones keep-alive hacia Shopify al apagar
+    await shopify_client.close()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -14,49 +30,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-SHOPIFY_TOKEN = os.getenv("SHOPIFY_TOKEN")
-SHOPIFY_URL = "https://autologic.myshopify.com/api/2023-10/graphql.json"  # Ajusta a tu tienda
-
 class QueryInput(BaseModel):
     query: str
 
 @app.post("/api/shopify-search")
 async def buscar_producto(q: QueryInput):
-    graphql_query = {
-        "query": f"""
-        query {{
-          products(first: 3, query: "{q.query}") {{
-            edges {{
-              node {{
-                title
-                handle
-                images(first: 1) {{ edges {{ node {{ originalSrc }} }} }}
-                variants(first: 1) {{
-                  edges {{ node {{ price {{ amount }} }} }}
-                }}
-              }}
-            }}
-          }}
-        }}
-        """
-    }
-
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Storefront-Access-Token": SHOPIFY_TOKEN,
-    }
-
-    response = requests.post(SHOPIFY_URL, json=graphql_query, headers=headers)
-    data = response.json()
-
-    productos = []
-    for edge in data.get("data", {}).get("products", {}).get("edges", []):
-        node = edge["node"]
-        productos.append({
-            "nombre": node["title"],
-            "precio": node["variants"]["edges"][0]["node"]["price"]["amount"],
-            "imagen": node["images"]["edges"][0]["node"]["originalSrc"] if node["images"]["edges"] else "",
-            "url": f"https://autologic.mx/products/{node['handle']}"
-        })
-
-    return {"productos": productos}
\ No newline at end of file
+    # Primero el índice local de productos; Shopify solo si no hay coincidencias locales
+    productos = product_mirror.search(q.query)
+    if productos:
+        return {"productos": productos}
+
+    # Cliente HTTP asíncrono compartido: no bloquea el event loop y reutiliza conexiones;
+    # las búsquedas repetidas se responden desde la caché sin llamar a Shopify
+    try:
+        productos = await shopify_client.search(q.query)
+    except ShopifyError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    return {"productos": productos}
+
+@app.get("/api/shopify-search/stats")
+async def estadisticas_busqueda():
+    return {**shopify_client.stats(), "mirror": product_mirror.stats()}
@@ -0,0 +1,256 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from backend.app.catalog import CatalogIndex, read_catalog_csv
+
+
+ROWS = [
+    {"id": 1, "year": 2015, "make": "Nissan", "model": "Versa", "engine": "1.6L"},
+    {"id": 2, "year": 2015, "make": "Nissan", "model": "March", "engine": "1.6L"},
+    {"id": 3, "year": 2016, "make": "Nissan", "model": "Versa", "engine": None},
+    {"id": 4, "year": 2016, "make": "Chevrolet", "model": "Aveo", "engine": "1.6L"},
+    {"id": 5, "year": 2016, "make": "Chevrolet", "model": "Aveo", "engine": "1.5L"},
+]
+
+
+def make_index(rows):
+    return CatalogIndex(loader=lambda: (rows, "test"))
+
+
+def test_catalog_cascade_is_presorted():
+    index = make_index(ROWS)
+    assert index.years() == [2016, 2015]
+    assert index.makes() == ["Chevrolet", "Nissan"]
+    assert index.makes(2015) == ["Nissan"]
+    assert index.models(2015, "Nissan") == ["March", "Versa"]
+    assert index.models(make="Nissan") == ["March", "Versa"]
+    assert index.engines(2016, "Chevrolet", "Aveo") == ["1.5L", "1.6L"]
+    assert index.engines(2016, "Nissan", "Versa") == []
+    assert index.makes(1990) == []
+
+
+def test_catalog_reload_bumps_version_and_revision():
+    index = make_index(ROWS)
+    first = index.info()
+    unchanged = index.reload(ROWS)
+    assert unchanged["version"] == first["version"] + 1
+    assert unchanged["changed"] is False
+
+    changed = index.reload(ROWS + [{"id": 6, "year": 2017, "make": "Kia", "model": "Rio", "engine": "1.6L"}])
+    assert changed["changed"] is True
+    assert index.years()[0] == 2017
+
+
+def test_catalog_reads_bundled_csv():
+    rows = read_catalog_csv()
+    assert rows
+    assert all(isinstance(r["year"], int) for r in rows)
+    assert "Tsuru" in make_index(rows).models(make="Nissan")
+
+
+def test_vehicle_search_folds_accents_tolerates_typos_and_ranks():
+    rows = read_catalog_csv()
+    index = make_index(rows)
+
+    def top(query):
+        found = index.search(query, limit=3)
+        return [(v["year"], v["make"], v["model"]) for v in found]
+
+    assert top("chevy aveo 2012") == [(2012, "Chevrolet", "Aveo")]
+    assert top("vocho")[0][1:] == ("Volkswagen", "Sedan")
+    assert top("tsuro")[0][2] == "Tsuru"
+    assert top("chevrolet avoe")[0][2] == "Aveo"
+    assert top("mazda 3")[0][2] == "Mazda3"
+    # El modelo Chevy va antes que los Chevrolet encontrados por el apodo
+    assert top("chevy")[0][2] == "Chevy"
+    # Nombre comercial en México (mexicanName) y acentos
+    assert any(v["mexican_name"] == "Aveo / Sonic" for v in index.search("sonic"))
+    assert top("Jétta") == top("jetta") != []
+    assert index.search("zzzz") == []
+
+
+def test_vehicle_search_index_is_rebuilt_on_reload():
+    index = make_index(ROWS)
+    assert index.search("rio") == []
+    index.reload(ROWS + [{"id": 6, "year": 2017, "make": "Kia", "model": "Rio", "engine": "1.6L"}])
+    assert index.search("rio")[0]["model"] == "Rio"
+
+
+def test_facets_filter_with_bitsets_and_count_other_facets():
+    rows = [
+        {"id": 1, "year": 2020, "make": "Nissan", "model": "Versa", "fuel_type": "Gasolina", "drive_type": "FWD", "is_imported": False},
+        {"id": 2, "year": 2021, "make": "Ford", "model": "Lobo", "fuel_type": "Gasolina", "drive_type": "4WD", "is_imported": True},
+        {"id": 3, "year": 2021, "make": "Ford", "model": "Ranger", "fuel_type": "Diésel", "drive_type": "4WD", "is_imported": True},
+        {"id": 4, "year": 2022, "make": "Jeep", "model": "Compass", "fuel_type": "Gasolina", "drive_type": "AWD", "is_imported": True},
+    ]
+    index = make_index(rows)
+
+    result = index.facets({"fuel_type": ["gasolina"], "drive_type": ["4WD", "AWD"]})
+    assert result["total"] == 2
+    assert [v["model"] for v in result["vehicles"]] == ["Compass", "Lobo"]
+    # Cada faceta se cuenta con los filtros de las demás
+    assert result["facets"]["drive_type"] == {"4WD": 1, "AWD": 1, "FWD": 1}
+    assert result["facets"]["fuel_type"] == {"Diésel": 1, "Gasolina": 2}
+    assert result["facets"]["is_imported"] == {"true": 2}
+
+    assert index.facets({"fuel_type": ["diesel"]})["vehicles"][0]["model"] == "Ranger"
+    assert index.facets({}, limit=2, offset=1)["vehicles"][0]["model"] == "Lobo"
+    assert index.facets({"make": ["Kia"]})["total"] == 0
+
+
+def test_catalog_routes_answer_304_for_current_revision(monkeypatch):
+    from fastapi.testclient import TestClient
+    from backend.app import async_db, main
+
+    index = make_index(ROWS)
+    index.reload()
+    monkeypatch.setattr(main, "catalog_index", index)
+
+    async def no_db(*args, **kwargs):
+        raise AssertionError("un 304 no debe consultar la base de datos")
+
+    monkeypatch.setattr(async_db, "get_vehicle_by_attributes", no_db)
+    http = TestClient(main.app)
+
+    first = http.get("/api/vehicles/makes", params={"year": 2015})
+    etag = first.headers["etag"]
+    assert first.json() == ["Nissan"]
+    assert etag == f'"{index.info()["revision"]}"'
+    assert "max-age" in first.headers["cache-control"]
+
+    cached = http.get("/api/vehicles/makes", params={"year": 2015}, headers={"If-None-Match": etag})
+    assert cached.status_code == 304 and cached.content == b""
+    assert cached.headers["etag"] == etag
+    details = http.get("/api/vehicles/details", params={"year": 2015, "make": "Nissan", "model": "Versa"},
+                       headers={"If-None-Match": f'W/{etag}, "otra"'})
+    assert details.status_code == 304
+
+    index.reload(ROWS + [{"id": 6, "year": 2015, "make": "Kia", "model": "Rio", "engine": "1.6L"}])
+    fresh = http.get("/api/vehicles/makes", params={"year": 2015}, headers={"If-None-Match": etag})
+    assert fresh.status_code == 200
+    assert fresh.json() == ["Kia", "Nissan"]
+    assert fresh.headers["etag"] != etag
+
+
+def test_selector_returns_cascade_and_vehicle_in_one_call():
+    index = make_index(ROWS)
+    state = index.selector(2016, "Chevrolet")
+    assert state["years"] == [2016, 2015]
+    assert state["makes"] == ["Chevrolet", "Nissan"]
+    assert state["models"] == ["Aveo"]
+    assert state["engines"] == [] and state["vehicle"] is None
+
+    state = index.selector(2016, "Chevrolet", "Aveo", "1.5L")
+    assert state["engines"] == ["1.5L", "1.6L"]
+    assert state["vehicle"]["id"] == 5
+    assert index.selector(2016, "Chevrolet", "Aveo")["vehicle"]["id"] == 4
+    assert index.selector(make="Nissan")["makes"] == []
+    assert index.selector(2015, "Nissan", "Versa", "2.0L")["vehicle"] is None
+
+
+def test_reload_async_builds_the_snapshot_off_the_event_loop(monkeypatch):
+    import asyncio
+    import threading
+    from backend.app import catalog
+
+    index = make_index(ROWS)
+    built_in = []
+    original = catalog.CatalogIndex._build
+
+    def recording_build(self, rows=None, source="manual"):
+        built_in.append(threading.current_thread() is threading.main_thread())
+        original(self, rows, source)
+
+    async def fake_rows():
+        return ROWS, "test"
+
+    monkeypatch.setattr(catalog, "load_catalog_rows_async", fake_rows)
+    monkeypatch.setattr(catalog.CatalogIndex, "_build", recording_build)
+    info = asyncio.run(index.reload_async())
+    assert info["vehicles"] == len(ROWS) and built_in == [False]
+
+
+def test_workers_reload_when_the_shared_revision_changes(monkeypatch):
+    import asyncio
+    from backend.app import catalog
+
+    revisions = ["r1"]
+    rows = list(ROWS)
+
+    async def db_revision():
+        return revisions[-1]
+
+    async def fake_rows():
+        return list(rows), "db"
+
+    monkeypatch.setattr(catalog, "_read_db_revision", db_revision)
+    monkeypatch.setattr(catalog, "load_catalog_rows_async", fake_rows)
+    worker = make_index(ROWS)
+
+    async def scenario():
+        await worker.reload_async()
+        unchanged = await worker.check_revision()
+        # Otro proceso importa y cambia la revisión compartida
+        rows.append({"id": 6, "year": 2017, "make": "Kia", "model": "Rio", "engine": "1.6L"})
+        revisions.append("r2")
+        return unchanged, await worker.check_revision()
+
+    unchanged, reloaded = asyncio.run(scenario())
+    assert (unchanged, reloaded) == (False, True)
+    assert worker.years()[0] == 2017 and worker.info()["db_revision"] == "r2"
+
+
+def test_catalog_reload_requires_the_admin_key(monkeypatch):
+    from fastapi.testclient import TestClient
+    from backend.app import auth, main
+
+    monkeypatch.setattr(auth, "ADMIN_API_KEY", "clave-servicio")
+    monkeypatch.setattr(main, "catalog_index", make_index(ROWS))
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    http = TestClient(main.app)
+    assert http.post("/api/vehicles/catalog/reload").status_code == 401
+    reloaded = http.post("/api/vehicles/catalog/reload", headers={"X-Admin-Key": "clave-servicio"})
+    assert reloaded.status_code == 200 and "revision" in reloaded.json()
+
+
+def test_database_routes_etag_follows_the_shared_revision():
+    index = make_index(ROWS)
+    assert index.etag(from_db=True) == index.etag()
+    index.db_revision = "r1"
+    db_etag = index.etag(from_db=True)
+    assert db_etag == '"db-r1"' and index.etag() != db_etag
+    # Una importación cambia la revisión compartida aunque el índice aún no se haya recargado
+    index.db_revision = "r2"
+    assert index.etag(from_db=True) != db_etag
+
+
+def test_catalog_routes_answer_503_and_build_in_background_when_not_loaded(monkeypatch):
+    import time
+    import threading
+    from fastapi.testclient import TestClient
+    from backend.app import main
+    from backend.app import catalog as catalog_module
+
+    loop_threads = []
+
+    async def rows_async():
+        return ROWS, "test"
+
+    def loader():
+        loop_threads.append(threading.current_thread())
+        return ROWS, "test"
+
+    index = CatalogIndex(loader=loader)
+    monkeypatch.setattr(catalog_module, "load_catalog_rows_async", rows_async)
+    monkeypatch.setattr(main, "catalog_index", index)
+    http = TestClient(main.app)
+    # Sin snapshot la ruta no construye el índice en el event loop: responde 503 y lo programa
+    pending = http.get("/api/vehicles/years")
+    assert pending.status_code == 503 and pending.headers["retry-after"] == "5"
+    for _ in range(100):
+        if index.loaded:
+            break
+        time.sleep(0.01)
+    assert http.get("/api/vehicles/years").json() == [2016, 2015]
+    assert loop_threads == []
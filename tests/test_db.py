@@ -0,0 +1,108 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from backend.app.db import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    vehicle = {"id": 42, "year": 2015, "make": "Nissan", "model": "Versa", "engine": None}
+    cursor = encode_cursor(vehicle)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (2015, "Nissan", "Versa", "", 42)
+
+
+def test_invalid_cursor_is_rejected():
+    with pytest.raises(ValueError):
+        decode_cursor("no-es-un-cursor")
+
+
+class RecordingCursor:
+    """Cursor de psycopg2 simulado: guarda las sentencias y el contenido enviado por COPY"""
+
+    def __init__(self, index_exists=True, duplicates=()):
+        self.statements = []
+        self.copied = []
+        self.index_exists = index_exists
+        self.duplicates = list(duplicates)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+    def copy_expert(self, sql, f):
+        self.statements.append(sql)
+        self.copied.append(f.read())
+
+    def fetchone(self):
+        if "to_regclass" in self.statements[-1]:
+            return ("vehicles_natural_key_idx" if self.index_exists else None,)
+        if "catalog_revision" in self.statements[-1]:
+            return ("rev-2",)
+        return (5, 4, 1, 2)
+
+    def fetchall(self):
+        return self.duplicates
+
+
+class RecordingConnection:
+    def __init__(self, **cursor):
+        self.cur = RecordingCursor(**cursor)
+        self.committed = False
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+def test_catalog_import_streams_csv_through_copy_and_reports_diff(tmp_path):
+    from backend.app.catalog_import import STAGING_TABLE, copy_columns, import_catalog
+
+    path = tmp_path / "vehicles.csv"
+    path.write_text("year,make,model,trim,engine,bodyType\n2023,Nissan,Versa,Advance,1.6L,Sedan\n", encoding="utf-8")
+    conn = RecordingConnection()
+    result = import_catalog([str(path)], conn=conn)
+
+    assert conn.committed
+    copy = next(s for s in conn.cur.statements if s.startswith("COPY"))
+    assert copy.startswith(f'COPY {STAGING_TABLE} ("year", "make", "model", "trim", "engine", "body_type")')
+    # El encabezado se consume en Python; los datos llegan intactos a COPY
+    assert conn.cur.copied == ["2023,Nissan,Versa,Advance,1.6L,Sedan\n"]
+    merge = next(s for s in conn.cur.statements if "IS DISTINCT FROM" in s)
+    # Solo se actualizan las columnas que trae el archivo: sin transmisión en el encabezado no se toca
+    assert '"body_type" = EXCLUDED."body_type"' in merge and '"transmission" = EXCLUDED' not in merge
+    assert {k: result[k] for k in ("rows", "skipped", "inserted", "updated", "unchanged")} == {
+        "rows": 5, "skipped": 1, "inserted": 1, "updated": 2, "unchanged": 1,
+    }
+    # La misma transacción cambia la revisión que sondean los workers del API
+    assert "INSERT INTO catalog_revision" in conn.cur.statements[-1] and result["revision"] == "rev-2"
+    with pytest.raises(ValueError):
+        copy_columns(["year", "color"])
+
+
+def test_catalog_import_reports_duplicate_vehicles_before_creating_the_index(tmp_path):
+    from backend.app.catalog_import import DuplicateVehiclesError, import_catalog
+
+    path = tmp_path / "vehicles.csv"
+    path.write_text("year,make,model\n2023,Nissan,Versa\n", encoding="utf-8")
+    conn = RecordingConnection(index_exists=False, duplicates=[(2020, "Nissan", "March", "", "1.6L", [7, 9], 1)])
+    with pytest.raises(DuplicateVehiclesError, match=r"1 vehículos repetidos[\s\S]*2020 Nissan March '' '1.6L': ids \[7, 9\]"):
+        import_catalog([str(path)], conn=conn)
+    assert not conn.committed
+    assert not any(s.startswith("CREATE UNIQUE INDEX") or s.startswith("COPY") for s in conn.cur.statements)
+
+    clean = RecordingConnection(index_exists=False)
+    import_catalog([str(path)], conn=clean)
+    assert any(s.startswith("CREATE UNIQUE INDEX") for s in clean.cur.statements)
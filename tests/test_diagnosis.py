@@ -0,0 +1,318 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("SMARTCAR_CLIENT_ID", "dummy")
+os.environ.setdefault("SMARTCAR_CLIENT_SECRET", "dummy")
+os.environ.setdefault("SMARTCAR_REDIRECT_URI", "http://localhost")
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from fastapi.testclient import TestClient
+
+from backend.app import diagnosis
+from backend.app.diagnosis_batch import BatchJobManager, LocalBatchBackend
+from backend.app.diagnosis_stream import IncrementalDiagnosisParser
+from backend.app.diagnosis_cache import DiagnosisCache, diagnosis_cache, diagnosis_cache_key
+from backend.app.main import app
+
+DIAGNOSTIC_JSON = (
+    '{"analysis": "Catalizador con baja eficiencia", "possible_causes": ["Catalizador dañado"], '
+    '"recommended_actions": ["Revisar sensores de oxígeno"], "severity": "Medio", '
+    '"parts": [{"name": "Catalizador", "description": "Convertidor catalítico", "urgency": "Media"}]}'
+)
+
+REQUEST = {
+    "vehicle": {"year": 2015, "make": "Nissan", "model": "Versa"},
+    "symptoms": "Luz de check engine encendida",
+    "code": "P0420",
+}
+
+
+class FakeMessages:
+    def __init__(self, text=DIAGNOSTIC_JSON, delay=0.0):
+        self.text = text
+        self.delay = delay
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        self.last_kwargs = kwargs
+        if "sin respuesta" in kwargs["messages"][0]["content"]:
+            return SimpleNamespace(content=[SimpleNamespace(text="no es JSON")])
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        usage = SimpleNamespace(input_tokens=20, output_tokens=300, cache_creation_input_tokens=0, cache_read_input_tokens=900)
+        return SimpleNamespace(content=[SimpleNamespace(text=self.text)], usage=usage)
+
+    def stream(self, **kwargs):
+        self.calls += 1
+        return FakeStream(self.text)
+
+
+class FakeStream:
+    def __init__(self, text, chunk_size=7):
+        self.chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    async def text_stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def get_final_message(self):
+        return SimpleNamespace(usage=None)
+
+
+@pytest.fixture
+def fake_messages(monkeypatch):
+    fake = FakeMessages()
+    monkeypatch.setattr(diagnosis.client, "messages", fake)
+    diagnosis_cache.memory.clear()
+    return fake
+
+
+def test_diagnose_returns_parsed_response(fake_messages):
+    fake_messages.text = "Aquí está el diagnóstico:\n" + DIAGNOSTIC_JSON
+    response = TestClient(app).post("/api/diagnose", json=REQUEST)
+    assert response.status_code == 200
+    assert response.json()["severity"] == "Medio"
+    assert fake_messages.calls == 1
+
+
+def test_diagnose_timeout_returns_504(fake_messages, monkeypatch):
+    fake_messages.delay = 1
+    monkeypatch.setattr(diagnosis, "DIAGNOSE_TIMEOUT", 0.01)
+    response = TestClient(app).post("/api/diagnose", json=REQUEST)
+    assert response.status_code == 504
+
+
+def test_run_diagnosis_bounds_concurrency(fake_messages, monkeypatch):
+    fake_messages.delay = 0.02
+
+    async def scenario():
+        monkeypatch.setattr(diagnosis, "_semaphore", asyncio.Semaphore(2))
+        request = diagnosis.DiagnosticRequest(**REQUEST)
+        await asyncio.gather(*(diagnosis.run_diagnosis(request) for _ in range(6)))
+
+    asyncio.run(scenario())
+    assert fake_messages.calls == 6
+    assert fake_messages.max_active == 2
+
+
+def test_cache_key_normalizes_request():
+    a = diagnosis.DiagnosticRequest(**REQUEST)
+    b = diagnosis.DiagnosticRequest(
+        vehicle={"year": 2015, "make": "NISSAN ", "model": "versa"},
+        symptoms="  luz de CHECK   engine encendida",
+        code="p0420 ",
+    )
+    assert diagnosis_cache_key(a) == diagnosis_cache_key(b)
+    assert diagnosis_cache_key(a) != diagnosis_cache_key(a.model_copy(update={"language": "en"}))
+    # La clave sigue al idioma de la respuesta: solo "es" se responde en español
+    upper, missing = a.model_copy(update={"language": "ES"}), a.model_copy(update={"language": None})
+    assert diagnosis.response_language(upper.language) == diagnosis.response_language(None) == "inglés"
+    assert diagnosis_cache_key(a) != diagnosis_cache_key(upper)
+    assert diagnosis_cache_key(a) != diagnosis_cache_key(missing)
+    assert diagnosis_cache_key(upper) == diagnosis_cache_key(missing)
+
+
+def test_cache_coalesces_and_reuses_results(fake_messages):
+    fake_messages.delay = 0.02
+    cache = DiagnosisCache(maxsize=8, ttl=60, persist=False)
+    request = diagnosis.DiagnosticRequest(**REQUEST)
+
+    async def scenario():
+        results = await asyncio.gather(*(cache.get_or_compute(request) for _ in range(5)))
+        results.append(await cache.get_or_compute(request))
+        return results
+
+    results = asyncio.run(scenario())
+    assert fake_messages.calls == 1
+    assert all(r == results[0] for r in results)
+    stats = cache.stats()
+    assert stats["singleflight"]["coalesced"] == 4
+    assert stats["memory"]["hits"] == 1
+
+
+def test_cache_cancels_upstream_call_when_every_waiter_leaves(fake_messages):
+    fake_messages.delay = 1
+    cache = DiagnosisCache(maxsize=8, ttl=60, persist=False)
+    request = diagnosis.DiagnosticRequest(**REQUEST)
+
+    async def scenario():
+        first, second = (asyncio.ensure_future(cache.get_or_compute(request)) for _ in range(2))
+        await asyncio.sleep(0.02)
+        # Un cliente se desconecta: la llamada sigue para el otro
+        first.cancel()
+        await asyncio.sleep(0.02)
+        still_running = fake_messages.active
+        # Se desconecta el último: la llamada a Claude se cancela y libera su lugar
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        await asyncio.sleep(0.02)
+        return still_running
+
+    assert asyncio.run(scenario()) == 1
+    assert fake_messages.active == 0
+    assert cache.stats()["singleflight"]["cancelled"] == 1
+    assert len(cache.memory) == 0
+
+
+def test_incremental_parser_emits_fields_as_they_complete():
+    parser = IncrementalDiagnosisParser()
+    text = "```json\n" + DIAGNOSTIC_JSON + "\n```"
+    events = []
+    for i in range(0, len(text), 5):
+        events.extend(parser.feed(text[i:i + 5]))
+    assert [name for name, _ in events] == ["analysis", "possible_cause", "recommended_action", "severity", "part"]
+    assert events[-1][1] == {"index": 0, "value": {"name": "Catalizador", "description": "Convertidor catalítico", "urgency": "Media"}}
+    assert parser.finished
+    assert parser.result["severity"] == "Medio"
+
+
+def test_stream_endpoint_sends_sse_events(fake_messages):
+    with TestClient(app).stream("POST", "/api/diagnose/stream", json=REQUEST) as response:
+        assert response.headers["content-type"].startswith("text/event-stream")
+        body = "".join(response.iter_text())
+    names = [line[len("event: "):] for line in body.splitlines() if line.startswith("event: ")]
+    assert names[0] == "analysis"
+    assert names[-1] == "result"
+    assert fake_messages.calls == 1
+
+
+def test_batch_deduplicates_and_reports_errors_per_item(fake_messages):
+    broken = dict(REQUEST, symptoms="sin respuesta")
+    payload = {"requests": [REQUEST, broken, dict(REQUEST, symptoms=REQUEST["symptoms"].upper())]}
+    response = TestClient(app).post("/api/diagnose/batch", json=payload)
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["unique"], data["duplicates"]) == (2, 1)
+    assert [r["status"] for r in data["results"]] == ["ok", "error", "ok"]
+    assert fake_messages.calls == 2
+
+
+class SlowPollBackend(LocalBatchBackend):
+    """Como la API de lotes, la consulta cede el event loop antes de responder"""
+
+    async def poll(self, provider_id):
+        await asyncio.sleep(0.01)
+        return await super().poll(provider_id)
+
+
+def test_local_batch_job_submit_and_poll(fake_messages):
+    async def scenario():
+        jobs = BatchJobManager(backend=SlowPollBackend())
+        requests = [diagnosis.DiagnosticRequest(**REQUEST)] * 3
+        submitted = await jobs.submit(requests)
+        assert submitted.status == "in_progress"
+        await asyncio.sleep(0.05)
+        # Dos consultas simultáneas del lote ya terminado reciben el mismo resultado
+        both = await asyncio.gather(jobs.poll(submitted.job_id), jobs.poll(submitted.job_id))
+        assert both[0] == both[1]
+        while (status := await jobs.poll(submitted.job_id)).status != "ended":
+            await asyncio.sleep(0.01)
+        return status
+
+    status = asyncio.run(scenario())
+    assert status.backend == "local"
+    assert (status.total, status.unique) == (3, 1)
+    assert all(r.status == "ok" for r in status.results)
+    assert fake_messages.calls == 1
+
+
+def test_batch_jobs_allow_larger_batches_and_expire(fake_messages, monkeypatch):
+    from backend.app import diagnosis_batch, main
+    monkeypatch.setattr(main, "batch_jobs", BatchJobManager(backend=LocalBatchBackend()))
+    payload = {"requests": [REQUEST] * (diagnosis_batch.DIAGNOSE_BATCH_MAX_ITEMS + 1)}
+    client = TestClient(app)
+    assert client.post("/api/diagnose/batch", json=payload).status_code == 413
+    assert client.post("/api/diagnose/batch/jobs", json=payload).status_code == 200
+
+    async def scenario():
+        jobs = BatchJobManager(backend=LocalBatchBackend(), maxsize=2)
+        requests = [diagnosis.DiagnosticRequest(**REQUEST)] * (diagnosis_batch.DIAGNOSE_BATCH_MAX_ITEMS + 1)
+        submitted = [await jobs.submit(requests) for _ in range(3)]
+        with pytest.raises(KeyError):
+            await jobs.poll(submitted[0].job_id)
+        return await jobs.poll(submitted[-1].job_id)
+
+    assert asyncio.run(scenario()).total == diagnosis_batch.DIAGNOSE_BATCH_MAX_ITEMS + 1
+
+
+def test_system_prompt_is_precompiled_and_cache_marked(fake_messages):
+    before = diagnosis.get_prompt_cache_stats()["cache_read_input_tokens"]
+    asyncio.run(diagnosis.run_diagnosis(diagnosis.DiagnosticRequest(**REQUEST)))
+    system = fake_messages.last_kwargs["system"]
+    assert system is diagnosis.get_system_prompt("es")
+    assert system[0]["cache_control"] == {"type": "ephemeral"}
+    assert "español" in system[0]["text"]
+    assert "inglés" in diagnosis.get_system_prompt("en")[0]["text"]
+    assert diagnosis.get_prompt_cache_stats()["cache_read_input_tokens"] == before + 900
+
+
+def test_dtc_lookup_by_code_prefix_and_range():
+    from backend.app.dtc import dtc_database
+    client = TestClient(app)
+    response = client.get("/api/dtc/p0420")
+    assert response.status_code == 200
+    assert response.json()["verified"] is True
+    assert client.get("/api/dtc/P1234").json()["verified"] is False
+    assert client.get("/api/dtc/XYZ").status_code == 400
+    misfires = [entry.code for entry in dtc_database.range("P0301", "P0304")]
+    assert misfires == ["P0301", "P0302", "P0303", "P0304"]
+    assert all(entry.code.startswith("P03") for entry in dtc_database.prefix("P03"))
+
+
+def test_code_only_request_is_answered_without_model(fake_messages):
+    response = TestClient(app).post("/api/diagnose", json=dict(REQUEST, symptoms=""))
+    assert response.status_code == 200
+    assert "P0420" in response.json()["analysis"]
+    assert fake_messages.calls == 0
+
+    asyncio.run(diagnosis.run_diagnosis(diagnosis.DiagnosticRequest(**REQUEST)))
+    assert "Definición verificada del código" in fake_messages.last_kwargs["messages"][0]["content"]
+
+
+def test_diagnose_attaches_store_products_in_one_shopify_request(fake_messages, monkeypatch):
+    import json
+    import httpx
+    from backend.app import main
+    from backend.app.shopify import ShopifyClient
+
+    bodies = []
+
+    def storefront(request):
+        body = json.loads(request.content)
+        bodies.append(body)
+        data = {
+            f"p{i}": {"edges": [{"node": {"title": f"{body['variables'][f'q{i}']} OEM", "handle": f"pieza-{i}",
+                                          "images": {"edges": []}, "variants": {"edges": []}}}]}
+            for i in range(len(body["variables"]) - 1)
+        }
+        return httpx.Response(200, json={"data": data})
+
+    shop = ShopifyClient(url="https://tienda.test/graphql.json", token="token")
+    shop._client = httpx.AsyncClient(transport=httpx.MockTransport(storefront))
+    monkeypatch.setattr(main, "shopify_client", shop)
+
+    response = TestClient(app).post("/api/diagnose", json=dict(REQUEST, symptoms=""))
+    parts = response.json()["parts"]
+    assert len(parts) > 1 and len(bodies) == 1
+    assert all(part["products"][0]["nombre"] == f"{part['name'].lower()} OEM" for part in parts)
+    # Sin productos cuando el cliente no los pide
+    plain = TestClient(app).post("/api/diagnose?include_products=false", json=dict(REQUEST, symptoms=""))
+    assert "products" not in plain.json()["parts"][0]
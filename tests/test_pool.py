@@ -0,0 +1,99 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+from psycopg2 import extensions
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from backend.app.pool import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        if self.conn.broken:
+            raise Exception("conexión rota")
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+def make_pool(**kwargs):
+    created = []
+
+    def connect(dsn):
+        conn = FakeConnection()
+        created.append(conn)
+        return conn
+
+    return ConnectionPool("fake", connect=connect, **kwargs), created
+
+
+def test_pool_reuses_connections():
+    pool, created = make_pool(min_size=1, max_size=2)
+    pool.open()
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert first is second
+    assert len(created) == 1
+    stats = pool.stats()
+    assert stats["in_use"] == 0
+    assert stats["idle"] == 1
+    assert stats["borrowed"] == 2
+
+
+def test_pool_is_bounded_and_times_out():
+    pool, _ = make_pool(min_size=0, max_size=1, timeout=0.05)
+    conn = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    pool.putconn(conn)
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_pool_waiter_gets_returned_connection():
+    pool, _ = make_pool(min_size=0, max_size=1, timeout=2)
+    conn = pool.getconn()
+    threading.Timer(0.05, pool.putconn, args=(conn,)).start()
+    assert pool.getconn() is conn
+    stats = pool.stats()
+    assert stats["waits"] == 1
+    assert stats["wait_time_max"] > 0
+
+
+def test_pool_replaces_unhealthy_connection():
+    pool, created = make_pool(min_size=1, max_size=1, max_idle=0)
+    pool.open()
+    created[0].broken = True
+    time.sleep(0.01)
+    with pool.connection() as conn:
+        assert conn is not created[0]
+    assert created[0].closed
+    assert pool.stats()["discarded"] == 1
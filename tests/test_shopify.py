@@ -0,0 +1,148 @@
+import asyncio
+import json
+import os
+import sys
+
+import httpx
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import main as shopify_main
+from backend.app.shopify import SEARCH_QUERY, ShopifyClient
+
+PRODUCT = {
+    "title": "Balatas delanteras cerámicas",
+    "handle": "balatas-delanteras",
+    "images": {"edges": [{"node": {"originalSrc": "https://cdn.shopify.com/balatas.jpg"}}]},
+    "variants": {"edges": [{"node": {"price": {"amount": "899.0"}}}]},
+}
+
+
+def storefront(requests):
+    """Storefront API simulada: registra cada petición y responde un producto"""
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json={"data": {"products": {"edges": [{"node": PRODUCT}]}}})
+    return handler
+
+
+def test_shopify_search_uses_variables_and_caches_normalized_queries(monkeypatch):
+    requests = []
+    client = ShopifyClient(url="https://tienda.test/graphql.json", token="token")
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(storefront(requests)))
+    monkeypatch.setattr(shopify_main, "shopify_client", client)
+    http = TestClient(shopify_main.app)
+
+    first = http.post("/api/shopify-search", json={"query": 'Balatas "Delanteras'})
+    second = http.post("/api/shopify-search", json={"query": '  balatas   "delanteras '})
+
+    assert first.status_code == 200
+    assert first.json() == second.json()
+    assert first.json()["productos"][0] == {
+        "nombre": "Balatas delanteras cerámicas",
+        "precio": "899.0",
+        "imagen": "https://cdn.shopify.com/balatas.jpg",
+        "url": "https://autologic.mx/products/balatas-delanteras",
+    }
+    # Una sola petición, con la búsqueda como variable y no dentro del texto GraphQL
+    assert len(requests) == 1
+    assert requests[0]["query"] == SEARCH_QUERY
+    assert requests[0]["variables"] == {"query": 'balatas "delanteras', "first": 3}
+
+
+BULK_EXPORT = [
+    {"id": "gid://shopify/Product/1", "title": "Bujías de iridio NGK", "handle": "bujias-iridio",
+     "productType": "Encendido", "vendor": "NGK", "tags": ["motor"], "updatedAt": "2024-05-01T00:00:00Z"},
+    {"__parentId": "gid://shopify/Product/1", "price": "320.00"},
+    {"id": "gid://shopify/Product/2", "title": "Balatas delanteras cerámicas", "handle": "balatas-delanteras",
+     "productType": "Frenos", "vendor": "Brembo", "tags": [], "updatedAt": "2024-05-02T00:00:00Z"},
+    {"__parentId": "gid://shopify/Product/2", "originalSrc": "https://cdn.shopify.com/balatas.jpg"},
+    {"__parentId": "gid://shopify/Product/2", "price": {"amount": "899.0"}},
+    {"id": "gid://shopify/Product/3", "title": "Disco de freno ventilado", "handle": "disco-freno",
+     "productType": "Frenos", "vendor": "Brembo", "tags": [], "updatedAt": "2024-05-03T00:00:00Z"},
+]
+
+
+def test_product_mirror_indexes_bulk_export_and_syncs_incrementally(tmp_path, monkeypatch):
+    from backend.app.product_mirror import ProductMirror
+
+    export = tmp_path / "export.jsonl"
+    export.write_text("\n".join(json.dumps(line) for line in BULK_EXPORT), encoding="utf-8")
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        node = {"id": "gid://shopify/Product/4", "title": "Bomba de agua", "handle": "bomba-agua",
+                "updatedAt": "2024-06-01T00:00:00Z", "images": {"edges": []}, "variants": {"edges": []}}
+        return httpx.Response(200, json={"data": {"products": {
+            "pageInfo": {"hasNextPage": False, "endCursor": None}, "edges": [{"node": node}]}}})
+
+    client = ShopifyClient(url="https://tienda.test/graphql.json", token="token")
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    mirror = ProductMirror(path=str(tmp_path / "mirror.jsonl"), client=client)
+    assert mirror.import_bulk(str(export)) == 3
+
+    # Sin acentos, en singular o plural y por prefijo
+    assert mirror.search("bujia")[0]["precio"] == "320.00"
+    assert [p["nombre"] for p in mirror.search("BALATA del")] == ["Balatas delanteras cerámicas"]
+    # Primero la palabra en el título, después en el tipo de producto
+    assert [p["nombre"] for p in mirror.search("frenos")] == ["Disco de freno ventilado", "Balatas delanteras cerámicas"]
+    assert mirror.search("amortiguador") == []
+
+    # La sincronización solo pide lo actualizado después de la última fecha conocida
+    assert asyncio.run(mirror.sync()) == 1
+    assert requests[0]["variables"]["query"] == "updated_at:>'2024-05-03T00:00:00Z'"
+    reloaded = ProductMirror(path=mirror.path, client=client)
+    assert reloaded.load() == 4 and reloaded.search("bomba")[0]["url"].endswith("/bomba-agua")
+
+    # /api/shopify-search responde desde la copia local sin llamar a Shopify
+    monkeypatch.setattr(shopify_main, "product_mirror", reloaded)
+    monkeypatch.setattr(shopify_main, "shopify_client", client)
+    response = TestClient(shopify_main.app).post("/api/shopify-search", json={"query": "bujías"})
+    assert response.json()["productos"][0]["nombre"] == "Bujías de iridio NGK"
+    assert len(requests) == 1
+
+
+def test_product_mirror_background_sync_reconciles_deleted_products(tmp_path):
+    from backend.app.product_mirror import ProductMirror, read_bulk_export
+
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        node = dict(BULK_EXPORT[-1], images={"edges": []}, variants={"edges": []})
+        return httpx.Response(200, json={"data": {"products": {
+            "pageInfo": {"hasNextPage": False, "endCursor": None}, "edges": [{"node": node}]}}})
+
+    client = ShopifyClient(url="https://tienda.test/graphql.json", token="token")
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    mirror = ProductMirror(path=str(tmp_path / "mirror.jsonl"), client=client)
+    mirror.apply(read_bulk_export(json.dumps(line) for line in BULK_EXPORT))
+
+    async def scenario():
+        task = asyncio.ensure_future(mirror.run(interval=0.01, full_interval=3600))
+        while mirror.syncs < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+    # La primera sincronización es completa y descarta los productos que Shopify ya no publica
+    assert requests[0]["variables"]["query"] is None
+    assert requests[1]["variables"]["query"] is not None
+    assert mirror.stats()["products"] == 1 and mirror.stats()["full_syncs"] == 1
+    assert mirror.search("bujia") == []
+
+
+def test_product_mirror_concurrent_saves_publish_a_complete_file(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from backend.app.product_mirror import ProductMirror, read_bulk_export
+
+    mirror = ProductMirror(path=str(tmp_path / "mirror.jsonl"), client=ShopifyClient(url="https://tienda.test", token=None))
+    mirror.apply(read_bulk_export(json.dumps(line) for line in BULK_EXPORT))
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda _: mirror.save(), range(32)))
+
+    # Cada guardado usa su propio temporal: el archivo publicado siempre está completo
+    assert ProductMirror(path=mirror.path, client=mirror.client).load() == 3
+    assert [p.name for p in tmp_path.iterdir()] == ["mirror.jsonl"]
@@ -0,0 +1,492 @@
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("SMARTCAR_CLIENT_ID", "dummy")
+os.environ.setdefault("SMARTCAR_CLIENT_SECRET", "dummy")
+os.environ.setdefault("SMARTCAR_REDIRECT_URI", "http://localhost")
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from backend.app import smartcar_client
+from backend.app import smartcar_http
+from backend.app.smartcar_client import SmartcarVehicleClient, VehicleRegistry, vehicle_registry
+
+DELAY = 0.05
+META = SimpleNamespace(data_age="2025-01-01T00:00:00Z")
+
+
+RESPONSES = {
+    "attributes": SimpleNamespace(id="veh-1", make="Nissan", model="Leaf", year="2020", meta=META),
+    "vin": SimpleNamespace(vin="1N4AZ0CP0FC000000", meta=META),
+    "odometer": SimpleNamespace(distance=15000.0, meta=META),
+    "location": SimpleNamespace(latitude=19.43, longitude=-99.13, meta=META),
+    "battery": SimpleNamespace(percent_remaining=0.8, range=200.0, meta=META),
+    "fuel": Exception("El vehículo no tiene tanque de combustible"),
+    "tire_pressure": SimpleNamespace(front_left=230, front_right=230, back_left=220, back_right=220, meta=META),
+    "engine_oil": SimpleNamespace(life_remaining=0.6, meta=META),
+    "engine": Exception("No soportado"),
+}
+
+
+def respond(name):
+    value = RESPONSES[name]
+    if isinstance(value, Exception):
+        raise value
+    return value
+
+
+class FakeVehicle:
+    """Vehículo del SDK simulado: cada llamada tarda DELAY segundos"""
+
+    batch_calls = 0
+    batch_error = None
+
+    def __init__(self, vehicle_id, access_token, options=None):
+        self.vehicle_id = vehicle_id
+        self.access_token = access_token
+
+    def __getattr__(self, name):
+        if name not in RESPONSES:
+            raise AttributeError(name)
+
+        def call():
+            time.sleep(DELAY)
+            return respond(name)
+        return call
+
+    def batch(self, paths):
+        FakeVehicle.batch_calls += 1
+        time.sleep(DELAY)
+        if FakeVehicle.batch_error:
+            raise FakeVehicle.batch_error
+        # Igual que el SDK: cada atributo devuelve la respuesta o lanza el error de esa ruta
+        return SimpleNamespace(**{name: (lambda name=name: respond(name)) for name in RESPONSES if name != "engine"})
+
+
+def run_status(monkeypatch, batch_error=None):
+    monkeypatch.setattr(smartcar_client.smartcar, "Vehicle", FakeVehicle)
+    monkeypatch.setattr(FakeVehicle, "batch_calls", 0)
+    monkeypatch.setattr(FakeVehicle, "batch_error", batch_error)
+    vehicle_registry.clear()
+    started = time.monotonic()
+    result = asyncio.run(SmartcarVehicleClient("token").get_complete_vehicle_status("veh-1"))
+    return result, time.monotonic() - started
+
+
+def test_complete_status_uses_one_batch_request(monkeypatch):
+    result, elapsed = run_status(monkeypatch)
+    assert FakeVehicle.batch_calls == 1
+    assert result["info"]["vin"] == "1N4AZ0CP0FC000000"
+    assert result["odometer"]["distance"] == 15000.0
+    assert "error" in result["fuel"] and "error" in result["engine_status"]
+    assert elapsed < DELAY * 3
+
+
+def test_complete_status_falls_back_to_concurrent_calls(monkeypatch):
+    result, elapsed = run_status(monkeypatch, batch_error=Exception("batch no disponible"))
+    assert result["battery"]["percent_remaining"] == 0.8
+    assert result["tire_pressure"]["back_left"] == 220
+    # Las señales se consultan en paralelo: mucho menos que la suma de las llamadas
+    assert elapsed < DELAY * 5
+
+
+def test_registry_reuses_handles_and_evicts_on_token_change(monkeypatch):
+    monkeypatch.setattr(smartcar_client.smartcar, "Vehicle", FakeVehicle)
+    registry = VehicleRegistry(maxsize=2)
+    first = registry.get("veh-1", "token-a")
+    assert registry.get("veh-1", "token-a") is first
+    renewed = registry.get("veh-1", "token-b")
+    assert renewed is not first and renewed.access_token == "token-b"
+    registry.get("veh-2", "token-a")
+    registry.get("veh-3", "token-a")
+    stats = registry.stats()
+    assert (stats["hits"], stats["token_changes"], stats["evictions"], stats["size"]) == (1, 1, 1, 2)
+
+
+def test_sdk_requests_go_through_shared_session(monkeypatch):
+    calls = []
+
+    def fake_request(method, url, **kwargs):
+        calls.append((method, url, kwargs["timeout"]))
+        return SimpleNamespace(ok=True, status_code=200, headers={}, text="{}")
+
+    monkeypatch.setattr(smartcar_http.session, "request", fake_request)
+    assert smartcar_client.smartcar.helpers.requester is smartcar_http.requester
+    smartcar_client.smartcar.helpers.requester("GET", "https://api.smartcar.com/v2.0/vehicles")
+    assert calls == [("GET", "https://api.smartcar.com/v2.0/vehicles", smartcar_http.SMARTCAR_HTTP_TIMEOUT)]
+
+
+def test_telemetry_cache_coalesces_and_reports_age(monkeypatch):
+    from fastapi.testclient import TestClient
+    from backend.app.main import app
+    from backend.app.telemetry import TelemetryCache, telemetry_cache
+
+    monkeypatch.setattr(smartcar_client.smartcar, "Vehicle", FakeVehicle)
+    monkeypatch.setattr(smartcar_client.smartcar, "get_vehicles",
+                        lambda access_token: {"vehicles": ["veh-9"] if access_token == "token" else ["veh-otro"]})
+    vehicle_registry.clear()
+    cache = TelemetryCache(ttls={"odometer": 300, "location": 10})
+    client = SmartcarVehicleClient("token")
+
+    async def scenario():
+        results = await asyncio.gather(*(cache.get(client, "veh-1", "odometer") for _ in range(5)))
+        return results, await cache.get(client, "veh-1", "odometer", max_age=0), await cache.get(client, "veh-1", "odometer")
+
+    results, expired, cached = asyncio.run(scenario())
+    assert cache.upstream_calls == 2
+    assert cache.stats()["singleflight"]["coalesced"] == 4
+    assert expired[2] is False and cached[2] is True
+
+    telemetry_cache.invalidate("veh-9")
+    http = TestClient(app)
+    first = http.get("/api/smartcar/vehicles/veh-9/location", params={"access_token": "token"})
+    second = http.get("/api/smartcar/vehicles/veh-9/location", params={"access_token": "token"})
+    forced = http.get("/api/smartcar/vehicles/veh-9/location", params={"access_token": "token", "force_refresh": True})
+    assert first.headers["X-Cache"] == "MISS" and second.headers["X-Cache"] == "HIT"
+    assert forced.headers["X-Cache"] == "MISS" and "Age" in second.headers
+    assert second.json()["latitude"] == 19.43
+    # Un token válido pero ajeno al vehículo no recibe la lectura en caché
+    foreign = http.get("/api/smartcar/vehicles/veh-9/location", params={"access_token": "ajeno"})
+    assert foreign.status_code == 403
+
+
+def test_fleet_scheduler_prioritizes_critical_and_feeds_cache(monkeypatch):
+    from backend.app.fleet import FleetScheduler, FleetVehicleRequest, TokenBucket
+    from backend.app.telemetry import telemetry_cache
+
+    monkeypatch.setattr(smartcar_client.smartcar, "Vehicle", FakeVehicle)
+    vehicle_registry.clear()
+
+    scheduler = FleetScheduler(rate=100, burst=1)
+    for vehicle_id, critical in (("flota-1", False), ("flota-2", True), ("flota-3", False)):
+        scheduler.register(FleetVehicleRequest(vehicle_id=vehicle_id, access_token="token", interval=60, critical=critical))
+    assert scheduler.next_ready().vehicle_id == "flota-2"
+    assert scheduler.next_ready().vehicle_id == "flota-1"
+    scheduler.unregister("flota-3")
+    assert scheduler.next_ready() is None
+
+    async def scenario():
+        bucket = TokenBucket(rate=50, capacity=1)
+        started = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        waited = time.monotonic() - started
+
+        telemetry_cache.invalidate("flota-4")
+        scheduler.register(FleetVehicleRequest(vehicle_id="flota-4", access_token="token"))
+        scheduler.start()
+        while scheduler.polls == 0:
+            await asyncio.sleep(0.01)
+        await scheduler.stop()
+        return waited
+
+    waited = asyncio.run(scenario())
+    assert waited >= 0.03
+    assert telemetry_cache.peek("flota-4", "odometer")[1]["distance"] == 15000.0
+    assert [v.polls for v in scheduler.vehicles() if v.vehicle_id == "flota-4"] == [1]
+
+
+def test_polled_readings_outlive_signal_ttls_within_the_poll_window():
+    from backend.app.telemetry import TelemetryCache
+
+    class Upstream:
+        calls = 0
+
+        async def get_location(self, vehicle_id):
+            Upstream.calls += 1
+            return {"latitude": 1.0}
+
+    cache = TelemetryCache(ttls={"location": 0.01})
+    cache.put("veh-1", "location", {"latitude": 19.43})
+    cache.put("veh-2", "location", {"latitude": 20.67})
+    cache.track("veh-1", window=60)
+    time.sleep(0.02)
+
+    async def scenario():
+        polled = await cache.get(Upstream(), "veh-1", "location")
+        untracked = await cache.get(Upstream(), "veh-2", "location")
+        too_old = await cache.get(Upstream(), "veh-1", "location", max_age=0.001)
+        return polled, untracked, too_old
+
+    polled, untracked, too_old = asyncio.run(scenario())
+    assert polled[0] == {"latitude": 19.43} and polled[2] is True
+    assert untracked[2] is False and too_old[2] is False
+    assert Upstream.calls == 2
+    # La ruta de la flota sigue viendo la última lectura aunque la vigencia haya pasado
+    assert cache.peek("veh-2", "location")[1] == {"latitude": 1.0}
+
+
+def test_telemetry_store_batches_readings_into_monthly_partitions(monkeypatch):
+    from contextlib import asynccontextmanager
+    from datetime import datetime, timedelta, timezone
+    from backend.app import async_db, telemetry_store as store_module
+    from backend.app.smartcar_client import VehicleFuel, VehicleEngineStatus
+
+    class FakeConnection:
+        def __init__(self):
+            self.statements, self.copies, self.rollups = [], [], []
+            self.failures = 0
+
+        async def execute(self, sql, *args):
+            self.statements.append(sql)
+
+        async def executemany(self, sql, args):
+            self.rollups.append((sql, [a[0] for a in args]))
+
+        async def fetch(self, sql, *args):
+            return []
+
+        async def copy_records_to_table(self, table, records, columns):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("base de datos no disponible")
+            self.copies.append((table, list(records)))
+
+    conn = FakeConnection()
+
+    @asynccontextmanager
+    async def fake_connection():
+        yield conn
+
+    monkeypatch.setattr(async_db, "connection", fake_connection)
+    store = store_module.TelemetryStore(enabled=True)
+    store.record("veh-1", "fuel", VehicleFuel(percent_remaining=0.5, range=300.0, timestamp="2025-01-31T23:59:00Z"))
+    store.record("veh-1", "engine", VehicleEngineStatus(running=True, timestamp="2025-02-01T00:01:00+00:00"))
+    store.record("veh-1", "info", {"make": "Nissan", "year": 2020})
+    assert asyncio.run(store.flush()) == 3
+
+    table, rows = conn.copies[0]
+    assert table == "vehicle_telemetry"
+    assert sorted((r[1], r[2], r[4]) for r in rows) == [("engine", "running", 1.0), ("fuel", "percent_remaining", 0.5), ("fuel", "range", 300.0)]
+    assert sum("PARTITION OF vehicle_telemetry" in sql for sql in conn.statements) == 2
+    assert any("vehicle_telemetry_202502" in sql for sql in conn.statements)
+
+    # Una escritura fallida se reintenta y la lectura tardía se agrega en su propia hora
+    late = datetime.now(timezone.utc).replace(minute=30, second=0, microsecond=0) - timedelta(days=3)
+    store.record("veh-1", "fuel", VehicleFuel(percent_remaining=0.4, timestamp=late.isoformat()))
+    conn.failures = 1
+    assert asyncio.run(store.flush()) == 0
+    assert store.stats()["pending"] == 1 and store.stats()["retries"] == 1
+    assert asyncio.run(store.flush()) == 1
+    asyncio.run(store.rollup())
+    (hourly, hours), (daily, days) = conn.rollups
+    assert "'hour'" in hourly and hours == [late.replace(minute=0)]
+    assert "'day'" in daily and days == [late.replace(hour=0, minute=0)]
+    assert store.stats()["pending_hours"] == 0
+
+    now = datetime(2025, 3, 1)
+    assert store_module.choose_resolution(now - timedelta(hours=6), now) == "raw"
+    assert store_module.choose_resolution(now - timedelta(days=30), now) == "hour"
+    assert store_module.choose_resolution(now - timedelta(days=180), now) == "day"
+
+
+def test_token_manager_refreshes_once_for_concurrent_requests(monkeypatch):
+    from datetime import datetime, timedelta
+    from backend.app.smartcar_tokens import TokenManager, TokenRecord
+
+    calls = []
+
+    def refresh_access_token(refresh_token):
+        calls.append(refresh_token)
+        time.sleep(DELAY)
+        return {
+            "access_token": f"access-{len(calls)}",
+            "refresh_token": f"refresh-{len(calls)}",
+            "expires_in": 7200,
+            "expires_at": (datetime.now() + timedelta(hours=2)).isoformat(),
+        }
+
+    monkeypatch.setattr(smartcar_client.smartcar_config, "refresh_access_token", refresh_access_token)
+    manager = TokenManager(refresh_ahead=600, persist=False)
+    manager._put(TokenRecord(
+        key="ana", access_token="old", refresh_token="refresh-0",
+        expires_at=datetime.now() + timedelta(seconds=30), vehicle_ids=["veh-1"],
+    ))
+
+    async def scenario():
+        tokens = await asyncio.gather(*(manager.token_for_vehicle("veh-1") for _ in range(5)))
+        # Dos pestañas que piden renovar con el mismo refresh token reciben la misma respuesta
+        renewed = await asyncio.gather(*(manager.refresh_by_token("refresh-1") for _ in range(3)))
+        return tokens, renewed
+
+    tokens, renewed = asyncio.run(scenario())
+    assert tokens == ["access-1"] * 5
+    assert calls == ["refresh-0", "refresh-1"]
+    assert all(r["access_token"] == "access-2" for r in renewed)
+    assert manager._records["ana"].refresh_token == "refresh-2"
+    assert manager.stats()["refreshes"] == 2
+
+
+def test_persisted_tokens_are_shared_and_refreshed_once_across_workers(monkeypatch):
+    import json
+    from contextlib import asynccontextmanager
+    from datetime import datetime, timedelta
+    from backend.app import async_db
+    from backend.app.smartcar_tokens import TokenManager, TokenRecord, session_key
+
+    calls = []
+
+    def refresh_access_token(refresh_token):
+        calls.append(refresh_token)
+        if refresh_token == "revocado":
+            raise ValueError("invalid_grant")
+        return {"access_token": f"access-{len(calls)}", "refresh_token": f"refresh-{len(calls)}",
+                "expires_in": 7200, "expires_at": (datetime.now() + timedelta(hours=2)).isoformat()}
+
+    # Tabla smartcar_tokens compartida; FOR UPDATE toma el lock de la fila hasta el fin de la transacción
+    table, row_locks = {}, {}
+
+    class FakeConnection:
+        def __init__(self):
+            self.held = []
+
+        @asynccontextmanager
+        async def transaction(self):
+            try:
+                yield
+            finally:
+                for lock in self.held:
+                    lock.release()
+                self.held = []
+
+        async def fetchrow(self, sql, *args):
+            if "FOR UPDATE" in sql:
+                lock = row_locks.setdefault(args[0], asyncio.Lock())
+                await lock.acquire()
+                self.held.append(lock)
+            if "key = $1" in sql:
+                return table.get(args[0])
+            return next((row for row in table.values() if args[0] in (row["refresh_token"], row["previous_refresh_token"])), None)
+
+        async def fetch(self, sql, *args):
+            return [{"key": key} for key, row in table.items() if row["expires_at"] <= args[0]]
+
+        async def execute(self, sql, *args):
+            if sql.startswith("INSERT"):
+                columns = ["key", "access_token", "refresh_token", "previous_refresh_token", "expires_at", "vehicle_ids"]
+                table[args[0]] = dict(zip(columns, args))
+
+        async def fetchval(self, sql, *args):
+            return (table.pop(args[0], None) or {}).get("key")
+
+    @asynccontextmanager
+    async def fake_connection():
+        yield FakeConnection()
+
+    monkeypatch.setattr(async_db, "connection", fake_connection)
+    monkeypatch.setattr(smartcar_client.smartcar_config, "refresh_access_token", refresh_access_token)
+    worker_a, worker_b = TokenManager(refresh_ahead=600, persist=True), TokenManager(refresh_ahead=600, persist=True)
+    expiring = datetime.now() + timedelta(seconds=30)
+
+    async def scenario():
+        await worker_a._save(TokenRecord(key=session_key("sesion-ana"), access_token="old", refresh_token="refresh-0",
+                                         expires_at=expiring, vehicle_ids=["veh-1"]))
+        await worker_a._save(TokenRecord(key="revocada", access_token="old", refresh_token="revocado",
+                                         expires_at=expiring, vehicle_ids=["veh-2"]))
+        # La sesión creada en un worker se lee en otro; la renovación se hace una sola vez
+        tokens = await asyncio.gather(worker_a.get_access_token("sesion-ana", "veh-1"),
+                                      worker_b.get_access_token("sesion-ana", "veh-1"))
+        # Quien renueva con el refresh token ya rotado recibe los tokens vigentes
+        renewed = await worker_b.refresh_by_token("refresh-0")
+        for _ in range(5):
+            await worker_a.refresh_expiring()
+        return tokens, renewed
+
+    tokens, renewed = asyncio.run(scenario())
+    assert tokens == ["access-1", "access-1"]
+    assert renewed["access_token"] == "access-1" and renewed["refresh_token"] == "refresh-1"
+    assert calls.count("refresh-0") == 1
+    assert json.loads(table[session_key("sesion-ana")]["vehicle_ids"]) == ["veh-1"]
+    # Tras SMARTCAR_TOKEN_MAX_FAILURES fallos seguidos los tokens se descartan
+    assert calls.count("revocado") == 5 and "revocada" not in table
+    assert worker_a.stats()["locks"] == 0 and worker_b.stats()["locks"] == 0
+
+
+def test_stored_tokens_require_the_session_that_owns_the_vehicle(monkeypatch):
+    from datetime import datetime, timedelta
+    from fastapi.testclient import TestClient
+    from backend.app import main
+    from backend.app.smartcar_tokens import TokenManager, TokenRecord, session_key
+
+    monkeypatch.setattr(smartcar_client.smartcar, "Vehicle", FakeVehicle)
+    manager = TokenManager(persist=False)
+    manager._put(TokenRecord(
+        key=session_key("sesion-ana"), access_token="token-ana", refresh_token="refresh-ana",
+        expires_at=datetime.now() + timedelta(hours=2), vehicle_ids=["veh-ana"],
+    ))
+    monkeypatch.setattr(main, "token_manager", manager)
+    http = TestClient(main.app)
+
+    assert http.get("/api/smartcar/vehicles/veh-ana/odometer").status_code == 401
+    assert http.get("/api/smartcar/vehicles/veh-ana/odometer", params={"user": "sesion-ana"}).status_code == 401
+    assert http.get("/api/smartcar/vehicles/veh-ana/odometer", headers={"Authorization": "Bearer otra"}).status_code == 401
+    assert http.get("/api/smartcar/vehicles/veh-luis/all", headers={"Authorization": "Bearer sesion-ana"}).status_code == 403
+    assert http.get("/api/smartcar/vehicles/veh-luis/history", params={"signal": "location"}).status_code == 401
+    assert http.get("/api/smartcar/vehicles/veh-luis/history", params={"signal": "location"},
+                    headers={"Authorization": "Bearer sesion-ana"}).status_code == 403
+    http.cookies.set("autologic_session", "sesion-ana")
+    own = http.get("/api/smartcar/vehicles/veh-ana/all")
+    assert own.status_code == 200 and own.json()["odometer"]["distance"] == 15000.0
+
+    assert http.delete("/api/smartcar/session").json() == {"logged_out": True}
+    assert http.get("/api/smartcar/vehicles/veh-ana/all", headers={"Authorization": "Bearer sesion-ana"}).status_code == 401
+
+
+def test_webhooks_verify_signature_and_feed_consumers(monkeypatch):
+    import json
+    from fastapi.testclient import TestClient
+    from backend.app import main
+    from backend.app.webhook_replay import synthetic_event
+    from backend.app.webhooks import WebhookPipeline, sign
+
+    received = []
+
+    async def collect(vehicle_id, sections):
+        received.append((vehicle_id, sections))
+
+    pipeline = WebhookPipeline(maxsize=3, batch_size=2, consumers=1, sinks=[collect])
+    monkeypatch.setattr(main, "SMARTCAR_WEBHOOK_TOKEN", "amt")
+    monkeypatch.setattr(main, "webhook_pipeline", pipeline)
+    http = TestClient(main.app)
+
+    def deliver(event, token="amt"):
+        body = json.dumps(event).encode()
+        return http.post("/api/smartcar/webhooks", content=body, headers={"SC-Signature": sign(token, body)})
+
+    challenge = deliver({"eventName": "verify", "payload": {"challenge": "abc"}})
+    assert challenge.json() == {"challenge": sign("amt", b"abc")}
+    assert deliver(synthetic_event(["veh-1"]), token="otro").status_code == 401
+    assert deliver(synthetic_event(["veh-1", "veh-2"])).json() == {"accepted": 2}
+    # La entrega que no cabe completa en la cola se rechaza para que Smartcar la reintente
+    assert deliver(synthetic_event(["veh-3", "veh-4"])).status_code == 503
+    # La que excede el tamaño de la cola no cabría nunca: 413 en lugar de 503
+    assert deliver(synthetic_event(["veh-5", "veh-6", "veh-7", "veh-8"])).status_code == 413
+
+    async def consume():
+        pipeline.start()
+        await pipeline.drain()
+        await pipeline.stop()
+
+    asyncio.run(consume())
+    assert [vehicle_id for vehicle_id, _ in received] == ["veh-1", "veh-2"]
+    sections = received[0][1]
+    assert set(sections) == {"odometer", "location", "battery", "tire_pressure"}
+    assert sections["tire_pressure"]["front_left"] == 230
+    assert pipeline.stats()["batches"] == 1 and pipeline.stats()["rejected"] == 2
+    assert pipeline.stats()["oversized"] == 4
+
+
+def test_fleet_routes_require_the_admin_key(monkeypatch):
+    from fastapi.testclient import TestClient
+    from backend.app import auth, main
+
+    http = TestClient(main.app)
+    monkeypatch.setattr(auth, "ADMIN_API_KEY", None)
+    assert http.get("/api/fleet/stats").status_code == 503
+    monkeypatch.setattr(auth, "ADMIN_API_KEY", "clave-servicio")
+    assert http.get("/api/fleet/vehicles").status_code == 401
+    assert http.post("/api/fleet/vehicles", json={"vehicle_id": "veh-1"}, headers={"X-Admin-Key": "otra"}).status_code == 401
+    assert http.get("/api/fleet/vehicles/veh-1/telemetry").status_code == 401
+    assert http.get("/api/fleet/stats", headers={"X-Admin-Key": "clave-servicio"}).status_code == 200